@@ -0,0 +1,224 @@
+"""
+Out-of-core aggregation over the CMS prescription drug profiles (PUF).
+
+The full PUF is large enough that loading it into memory just to run a
+groupby is wasteful. `aggregate_puf` streams the file in batches of
+`chunksize` rows, aggregates each batch, and combines the partial
+aggregates, so that memory use is bounded by the batch size and the
+number of groups rather than the size of the file.
+
+Example
+-------
+>>> from aggregate import aggregate_puf
+>>> agg = aggregate_puf("../data/2010_PD_Profiles_PUF.csv",
+...                     by=["DRUG_MAJOR_CLASS", "BENE_AGE_CAT_CD"])
+"""
+import os # file sizes and modification times for the cache key
+import hashlib # hash the query signature
+import json # serialize the query signature
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+import pyarrow.dataset as ds
+
+from read_data import OptionUndefinedError, _read_data, _write_data
+
+
+# measures that are aggregated by default: total number of prescription drug events,
+# and the average total drug cost weighted by the number of events
+DEFAULT_SUMS = ["PDE_CNT"]
+DEFAULT_WEIGHTED_MEANS = {"AVE_TOT_DRUG_COST": "PDE_CNT"}
+
+
+def _file_format(path):
+    """
+    Figure out the file format of the PUF file from its extension.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".csv":
+        return "csv"
+    elif ext == ".feather":
+        return "feather"
+    else:
+        raise OptionUndefinedError()
+
+
+def _iter_chunks(path, columns, chunksize):
+    """
+    Iterate over the PUF file in DataFrames of at most `chunksize` rows,
+    only reading the columns in `columns`.
+
+    CSV files can be either the raw CMS file (comma-separated) or the file
+    written by `read_data.download_puf` (tab-separated, with a `#` in front
+    of the first column name). Feather files are streamed record batch by
+    record batch, reading only the requested columns, so that the file is
+    never in memory as a whole.
+    """
+    file_format = _file_format(path)
+
+    if file_format == "csv":
+        with open(path, "r") as f:
+            header = f.readline()
+        sep = "\t" if "\t" in header else ","
+        names = [h.strip().strip("#") for h in header.split(sep)]
+        usecols = [names.index(c) for c in columns]
+
+        reader = pd.read_csv(path, sep=sep, header=None, skiprows=1, usecols=usecols,
+                             chunksize=chunksize)
+        for chunk in reader:
+            chunk.columns = [names[i] for i in sorted(usecols)]
+            yield chunk
+
+    else:
+        dataset = ds.dataset(path, format="feather")
+        for batch in dataset.to_batches(columns=columns, batch_size=chunksize):
+            if batch.num_rows > 0:
+                yield batch.to_pandas()
+
+
+def _partial_aggregate(chunk, by, sums, weighted_means):
+    """
+    Aggregate a single batch. Weighted means are carried as the sum of
+    `value * weight` and only divided by the weights in `_finalize`, so that
+    partial aggregates can be combined by summing them.
+    """
+    partial = pd.DataFrame(index=chunk.index)
+    partial["n_rows"] = 1
+    for col in sums:
+        partial[col] = chunk[col]
+    for col, weight in weighted_means.items():
+        partial[col + "_wsum"] = chunk[col] * chunk[weight]
+        partial[col + "_weight"] = chunk[weight].where(chunk[col].notnull(), 0)
+
+    for col in by:
+        partial[col] = chunk[col]
+
+    return partial.groupby(by, dropna=False).sum()
+
+
+def _combine(partials):
+    """
+    Combine a list of partial aggregates into one.
+    """
+    partials = [p for p in partials if p is not None]
+    if len(partials) == 0:
+        return None
+    elif len(partials) == 1:
+        return partials[0]
+    combined = pd.concat(partials)
+    return combined.groupby(level=list(range(combined.index.nlevels)), dropna=False).sum()
+
+
+def _finalize(agg, sums, weighted_means):
+    """
+    Turn the combined partial aggregates into the final table.
+    """
+    out = agg[["n_rows"] + list(sums)].copy()
+    for col in weighted_means:
+        out[col] = agg[col + "_wsum"] / agg[col + "_weight"]
+    return out.reset_index()
+
+
+def _query_signature(path, by, sums, weighted_means):
+    """
+    Make a hash that identifies a query. The file's size and modification
+    time are part of the signature, so a re-downloaded file invalidates
+    all cached results.
+    """
+    stat = os.stat(path)
+    query = {"path": os.path.abspath(path), "size": stat.st_size, "mtime": stat.st_mtime,
+             "by": list(by), "sums": list(sums),
+             "weighted_means": sorted(weighted_means.items())}
+    return hashlib.sha1(json.dumps(query, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def aggregate_puf(path, by, sums=None, weighted_means=None, chunksize=1000000, n_jobs=1,
+                  cache_dir=None):
+    """
+    Group the prescription drug profiles by the columns in `by` and aggregate
+    the measures, reading the file in bounded-memory batches.
+
+    Parameters
+    ----------
+    path : string
+        Path to the PUF file, either the raw CMS CSV file (`2010_PD_Profiles_PUF.csv`)
+        or a `puf.csv`/`puf.feather` file written by `read_data.download_puf`.
+
+    by : list of strings
+        The columns to group by, e.g. ["DRUG_MAJOR_CLASS", "BENE_AGE_CAT_CD", "PLAN_TYPE"]
+
+    sums : list of strings, optional, default: ["PDE_CNT"]
+        The columns to sum within each group
+
+    weighted_means : dict, optional, default: {"AVE_TOT_DRUG_COST": "PDE_CNT"}
+        Columns to average within each group (keys), weighted by another
+        column (values)
+
+    chunksize : int, optional, default: 1000000
+        The number of rows to read per batch
+
+    n_jobs : int, optional, default: 1
+        The number of processes used to aggregate batches. If 1, everything
+        runs in the current process.
+
+    cache_dir : string, optional, default: None
+        If given, results are cached in this directory by query signature,
+        and a repeated query is read from the cache instead of the PUF file.
+
+    Returns
+    -------
+    agg : pd.DataFrame
+        One row per group with the group columns, the number of rows
+        (`n_rows`) in the group, and one column per measure
+    """
+    if sums is None:
+        sums = DEFAULT_SUMS
+    if weighted_means is None:
+        weighted_means = DEFAULT_WEIGHTED_MEANS
+
+    by = list(by)
+    sums = list(sums)
+
+    if cache_dir is not None:
+        cache_name = "puf_agg_" + _query_signature(path, by, sums, weighted_means)
+        if os.path.isfile(os.path.join(cache_dir, cache_name + ".feather")):
+            return _read_data(os.path.join(cache_dir, ""), cache_name, "feather")
+
+    # only read the columns the query needs
+    columns = []
+    for col in by + sums + list(weighted_means.keys()) + list(weighted_means.values()):
+        if col not in columns:
+            columns.append(col)
+
+    chunks = _iter_chunks(path, columns, chunksize)
+
+    agg = None
+    if n_jobs == 1:
+        for chunk in chunks:
+            agg = _combine([agg, _partial_aggregate(chunk, by, sums, weighted_means)])
+    else:
+        # keep at most two batches per worker in flight, so that reading
+        # ahead doesn't defeat the point of reading in batches
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            pending = []
+            for chunk in chunks:
+                pending.append(pool.submit(_partial_aggregate, chunk, by, sums, weighted_means))
+                if len(pending) >= 2 * n_jobs:
+                    agg = _combine([agg] + [p.result() for p in pending])
+                    pending = []
+            agg = _combine([agg] + [p.result() for p in pending])
+
+    if agg is None:
+        raise ValueError("No rows found in %s."%path)
+
+    agg = _finalize(agg, sums, weighted_means)
+
+    if cache_dir is not None:
+        try:
+            os.stat(cache_dir)
+        except FileNotFoundError:
+            os.mkdir(cache_dir)
+        _write_data(agg, os.path.join(cache_dir, ""), cache_name, "feather")
+
+    return agg
@@ -0,0 +1,242 @@
+"""
+Find unusual values and price spikes in the Part D spending data.
+
+The year-over-year notebooks look for big increases in `unit_cost_wavg` and
+`total_spending` by eye. This script does the same for all drugs and metrics
+at once: the spending files are put into one (drug x year) array per metric,
+and for every drug and metric we compute
+
+* the median and the median absolute deviation (MAD) over the years,
+* the robust z-score of every year, `0.6745 * (x - median) / MAD`
+  (Iglewicz and Hoaglin), which isn't pulled along by the outlier itself
+  the way a mean and standard deviation would be,
+* for `unit_cost_wavg`, the relative change to the previous year.
+
+Years with `|robust z| > z_threshold` are flagged as "spike", and years in
+which the unit cost went up by more than `jump_threshold` as
+"unit_cost_jump". The flags are written to `spending_flags`, ranked by score
+within each kind of flag.
+
+    python anomalies.py -d ../data/ --z-threshold 5 --jump-threshold 1
+"""
+import argparse # argument parsing for command line options
+import warnings # silence warnings about drugs with no data
+
+import numpy as np
+import pandas as pd
+
+import metrics # stage timing and metrics, see `metrics.configure`
+from read_data import PARTD_METRIC_COLUMNS, _write_data, load_spending
+
+
+# the metrics to look for spikes in; all columns of the spending files
+METRICS = list(PARTD_METRIC_COLUMNS.values())
+
+# scales the MAD so that the robust z-score of normally distributed data
+# is comparable to the usual z-score
+MAD_SCALE = 0.6745
+
+FLAG_COLUMNS = ["flag", "rank", "drugname_brand", "drugname_generic", "metric", "year",
+                "value", "previous_value", "median", "mad", "robust_z", "pct_change", "score"]
+
+
+def _drug_year_arrays(spending, metric_columns):
+    """
+    Put the stacked spending data into a (drug x year) array per metric.
+
+    Returns
+    -------
+    drugs : pd.DataFrame
+        Brand and generic name of every row of the arrays
+    years : np.ndarray
+        The year of every column of the arrays
+    arrays : dict of np.ndarray
+        The arrays, keyed by metric; missing values are NaN
+    """
+    names = ["drugname_brand", "drugname_generic"]
+    drug_ids = spending.groupby(names, sort=False, observed=True).ngroup().values
+    _, first = np.unique(drug_ids, return_index=True)
+    drugs = spending[names].iloc[first].reset_index(drop=True)
+
+    years, year_ids = np.unique(spending["year"].values, return_inverse=True)
+
+    arrays = {}
+    for metric in metric_columns:
+        array = np.full((len(drugs), len(years)), np.nan)
+        array[drug_ids, year_ids] = spending[metric].values.astype(float)
+        arrays[metric] = array
+    return drugs, years, arrays
+
+
+def robust_zscores(array, min_years=3):
+    """
+    Robust z-scores of each row of `array` (drugs x years), based on the
+    median and the median absolute deviation (MAD) of the row.
+
+    Parameters
+    ----------
+    array : np.ndarray
+        The values, NaN where missing
+
+    min_years : int, optional, default: 3
+        Rows with fewer non-missing values get no z-scores (NaN).
+
+    Returns
+    -------
+    z : np.ndarray
+        The z-scores, same shape as `array`; NaN if the value is missing, the
+        row has too few values, or the MAD is zero
+    median : np.ndarray
+        Median per row
+    mad : np.ndarray
+        MAD per row
+    """
+    with warnings.catch_warnings():
+        # rows without any values give "All-NaN slice" warnings
+        warnings.simplefilter("ignore", RuntimeWarning)
+        median = np.nanmedian(array, axis=1)
+        mad = np.nanmedian(np.abs(array - median[:, None]), axis=1)
+
+    usable = (np.sum(~np.isnan(array), axis=1) >= min_years) & (mad > 0)
+    z = np.full(array.shape, np.nan)
+    z[usable] = MAD_SCALE * (array[usable] - median[usable, None]) / mad[usable, None]
+    return z, median, mad
+
+
+def pct_change(array):
+    """
+    Relative change of each value to the previous column (year) of `array`;
+    NaN for the first year and where either value is missing or the previous
+    value is not positive.
+    """
+    change = np.full(array.shape, np.nan)
+    previous = array[:, :-1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        change[:, 1:] = np.where(previous > 0, array[:, 1:] / previous - 1, np.nan)
+    return change
+
+
+def _flag_table(flag, mask, drugs, years, metric, array, z, median, mad, change, score):
+    rows, cols = np.nonzero(mask)
+    previous = np.full(len(rows), np.nan)
+    has_previous = cols > 0
+    previous[has_previous] = array[rows[has_previous], cols[has_previous] - 1]
+
+    flags = drugs.iloc[rows].reset_index(drop=True)
+    flags["flag"] = flag
+    flags["metric"] = metric
+    flags["year"] = years[cols]
+    flags["value"] = array[rows, cols]
+    flags["previous_value"] = previous
+    flags["median"] = median[rows]
+    flags["mad"] = mad[rows]
+    flags["robust_z"] = z[rows, cols]
+    flags["pct_change"] = change[rows, cols]
+    flags["score"] = score[rows, cols]
+    return flags
+
+
+@metrics.timed()
+def detect_anomalies(data_dir="../data/", file_format="feather", metric_columns=None,
+                     z_threshold=3.5, jump_threshold=0.5, min_years=3, output_format=None):
+    """
+    Flag unusual values of each drug and metric over the years, and years in
+    which the unit cost of a drug jumped, and write them to `spending_flags`.
+
+    Parameters
+    ----------
+    data_dir : string, optional, default: "../data/"
+        The directory that contains the spending files.
+
+    file_format : string, optional, default: "feather"
+        The file format of the spending files, "csv" or "feather".
+
+    metric_columns : list of strings, optional, default: None
+        The metrics to look for spikes in. If None, all metrics in `METRICS`.
+
+    z_threshold : float, optional, default: 3.5
+        Flag values with an absolute robust z-score above this as "spike".
+
+    jump_threshold : float, optional, default: 0.5
+        Flag years in which `unit_cost_wavg` rose by more than this fraction
+        over the previous year (0.5 = +50%) as "unit_cost_jump".
+
+    min_years : int, optional, default: 3
+        Drugs with fewer years of data for a metric get no robust z-scores
+        for that metric.
+
+    output_format : string, optional, default: None
+        The file format for `spending_flags`. If None, same as `file_format`.
+
+    Returns
+    -------
+    flags : pd.DataFrame
+        One row per flag, ordered by flag and rank (highest score first);
+        the score is `|robust_z|` for spikes and `pct_change` for jumps
+    """
+    if metric_columns is None:
+        metric_columns = METRICS
+    if output_format is None:
+        output_format = file_format
+
+    spending = load_spending(data_dir, file_format)
+
+    with metrics.stage("detect"):
+        drugs, years, arrays = _drug_year_arrays(spending, metric_columns)
+        metrics.record_read(rows=len(spending))
+
+        tables = []
+        for metric in metric_columns:
+            array = arrays[metric]
+            z, median, mad = robust_zscores(array, min_years=min_years)
+            change = pct_change(array)
+            abs_z = np.abs(z)
+            with np.errstate(invalid="ignore"):
+                spikes = abs_z > z_threshold
+            tables.append(_flag_table("spike", spikes, drugs, years, metric, array,
+                                      z, median, mad, change, abs_z))
+            if metric == "unit_cost_wavg":
+                with np.errstate(invalid="ignore"):
+                    jumps = change > jump_threshold
+                tables.append(_flag_table("unit_cost_jump", jumps, drugs, years, metric, array,
+                                          z, median, mad, change, change))
+
+        flags = pd.concat(tables, ignore_index=True)
+        flags = flags.sort_values(["flag", "score"], ascending=[True, False], kind="mergesort")
+        flags["rank"] = flags.groupby("flag").cumcount() + 1
+        flags = flags[FLAG_COLUMNS].reset_index(drop=True)
+
+    _write_data(flags, data_dir, "spending_flags", output_format)
+
+    return flags
+
+
+# if script is called from the command, line, code below is executed.
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Flag unusual spending values and unit cost jumps.")
+
+    parser.add_argument("-d", "--data-dir", action="store", required=False, default="../data/",
+                        dest="data_dir", help="Optional path to the data directory. Default: '../data/'")
+    parser.add_argument("-f", "--file-format", action="store", required=False, default="feather",
+                        dest="file_format", help="File format of the data files. {'csv' | 'feather'}")
+    parser.add_argument("-m", "--metrics", nargs="+", required=False, default=None,
+                        dest="metrics", help="Metrics to look for spikes in. Default: all")
+    parser.add_argument("-z", "--z-threshold", action="store", type=float, default=3.5,
+                        dest="z_threshold", help="Robust z-score above which a value is a spike. Default: 3.5")
+    parser.add_argument("-j", "--jump-threshold", action="store", type=float, default=0.5,
+                        dest="jump_threshold", help="Relative rise of the unit cost that is flagged. " +
+                                                    "Default: 0.5 (+50%%)")
+    parser.add_argument("--min-years", action="store", type=int, default=3,
+                        dest="min_years", help="Minimum years of data for a z-score. Default: 3")
+
+    clargs = parser.parse_args()
+
+    for metric in clargs.metrics or []:
+        if metric not in METRICS:
+            parser.error("Unknown metric '%s', must be one of %s."%(metric, METRICS))
+
+    flags = detect_anomalies(clargs.data_dir, file_format=clargs.file_format,
+                             metric_columns=clargs.metrics, z_threshold=clargs.z_threshold,
+                             jump_threshold=clargs.jump_threshold, min_years=clargs.min_years)
+    print(flags.groupby("flag").size().to_string())
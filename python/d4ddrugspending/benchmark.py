@@ -0,0 +1,276 @@
+"""
+Offline benchmarks for the stages in `read_data.py`.
+
+The raw inputs are replaced with seeded synthetic files from `synthetic_data.py`,
+and `read_data._download_data` is replaced with a function that does nothing,
+so the benchmarks don't need network access. For every stage, we record the
+wall time (best of `--repeat` runs) and the peak memory allocated while the
+stage runs, as traced by `tracemalloc`. The reshape of the Part D workbook
+is also measured on its own, on an in-memory workbook with a configurable
+number of years, to see how its peak memory compares to the workbook size.
+
+Usage:
+
+    python benchmark.py --scale 0.1 --repeat 3 --output bench.json
+
+Results for different commits can be compared by diffing the JSON output.
+"""
+import os # temporary data directory
+import sys # path of the Python interpreter
+import subprocess # time the command line startup
+import time # wall time
+import json # write results
+import shutil # remove temporary data
+import tempfile # temporary data directory
+import tracemalloc # peak memory
+import resource # peak resident set size of the whole run
+import argparse # argument parsing for command line options
+
+import numpy as np
+import pandas as pd
+
+import read_data
+import synthetic_data
+
+
+# the stages in the order in which they need to run; `make_drug_table` needs
+# the output of all the others
+STAGES = ["download_partd", "download_rxnorm", "download_puf", "download_drug_class_ids",
+          "make_drug_table"]
+
+
+def _no_download(url, data_dir="../data/", data_name="dataset", zipped_data=False):
+    """
+    Stand-in for `read_data._download_data`: the synthetic input files are
+    already where the real ones would have been extracted to.
+    """
+    return
+
+
+def _run_stage(stage, data_dir, file_format):
+    if stage == "download_partd":
+        read_data.download_partd(data_dir, output_format=file_format, overwrite=True)
+    elif stage == "download_puf":
+        read_data.download_puf(data_dir, all_columns=False, output_format=file_format)
+    elif stage == "make_drug_table":
+        read_data.make_drug_table(data_dir, data_local=True, file_format=file_format)
+    else:
+        getattr(read_data, stage)(data_dir, output_format=file_format)
+    return
+
+
+def time_stage(stage, data_dir, file_format="feather", repeat=3):
+    """
+    Run `stage` `repeat` times and return the best wall time in seconds and
+    the largest peak of traced memory in bytes.
+    """
+    times, peaks = [], []
+    for _ in range(repeat):
+        tracemalloc.start()
+        start = time.perf_counter()
+        _run_stage(stage, data_dir, file_format)
+        times.append(time.perf_counter() - start)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    return min(times), max(peaks)
+
+
+def time_startup(repeat=5):
+    """
+    Time how long `python read_data.py --help` takes, best of `repeat` runs.
+    This is dominated by interpreter startup and module imports, and is what
+    cron-driven checks and shell completion pay on every call.
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "read_data.py")
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, script, "--help"], stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def _wide_partd(n_generic, n_years, seed=0):
+    """
+    Make an in-memory stand-in for the parsed Part D workbook with `n_years`
+    years of metric columns, and the matching release schema.
+    """
+    rng = np.random.RandomState(seed)
+    schema = dict(read_data.PARTD_RELEASES[max(read_data.PARTD_RELEASES)])
+    schema["years"] = list(range(2011, 2011 + n_years))
+
+    names = synthetic_data.make_drug_names(n_generic, seed=seed)
+    n_metrics = len(read_data.PARTD_METRIC_COLUMNS)
+    values = rng.lognormal(3, 2, size=(len(names), n_years * n_metrics))
+    values[rng.rand(*values.shape) < 0.1] = np.nan
+
+    headers = [h.title() for h in read_data.PARTD_METRIC_COLUMNS] * n_years
+    partd = pd.DataFrame(values, columns=headers)
+    partd.insert(0, "Generic Name", names["drugname_generic"].values)
+    partd.insert(0, "Brand Name", names["drugname_brand"].values)
+    return partd, schema
+
+
+def reshape_memory(n_generic=1500, n_years=5, repeat=3, seed=0):
+    """
+    Measure the wide-to-long reshape of the Part D workbook in `download_partd`
+    (`read_data._partd_year_tables`) on its own, for a workbook with
+    `n_generic` generic drugs and `n_years` years.
+
+    Returns
+    -------
+    result : dict
+        The best wall time in seconds, the peak memory traced during the
+        reshape and the size of the wide frame in megabytes, and their ratio
+    """
+    partd, schema = _wide_partd(n_generic, n_years, seed=seed)
+    name_cols, groups = read_data._partd_column_groups(partd.columns, schema)
+    drugnames = partd.iloc[:, name_cols]
+    drugnames.columns = ["drugname_brand", "drugname_generic"]
+    wide_mb = partd.memory_usage(deep=True).sum() / 1024.0**2
+
+    times, peaks = [], []
+    for _ in range(repeat):
+        tracemalloc.start()
+        start = time.perf_counter()
+        read_data._partd_year_tables(partd, drugnames, groups, schema["years"])
+        times.append(time.perf_counter() - start)
+        peaks.append(tracemalloc.get_traced_memory()[1] / 1024.0**2)
+        tracemalloc.stop()
+
+    return {"n_drugs": len(partd), "n_years": n_years, "seconds": min(times),
+            "wide_mb": wide_mb, "peak_mb": max(peaks), "peak_ratio": max(peaks) / wide_mb}
+
+
+def run_benchmarks(scale=0.1, repeat=3, stages=None, file_format="feather", seed=0, data_dir=None,
+                   reshape_years=5):
+    """
+    Generate synthetic inputs at `scale` and time each stage in `stages`.
+
+    Parameters
+    ----------
+    scale : float, optional, default: 0.1
+        Size of the synthetic inputs relative to the real data, see
+        `synthetic_data.make_all`.
+
+    repeat : int, optional, default: 3
+        The number of times each stage is run.
+
+    stages : list of strings, optional, default: None
+        The stages to run, a subset of `STAGES`. If None, run all of them.
+        Stages are always run in the order of `STAGES`.
+
+    file_format : string, optional, default: "feather"
+        The file format for the output files, "csv" or "feather".
+
+    seed : int, optional, default: 0
+        The seed for the synthetic data.
+
+    data_dir : string, optional, default: None
+        Directory for the synthetic data. If None, a temporary directory is
+        used and removed afterwards.
+
+    reshape_years : int, optional, default: 5
+        The number of years in the workbook for the separate benchmark of
+        the Part D reshape (see `reshape_memory`), to see how the reshape
+        scales with bigger releases.
+
+    Returns
+    -------
+    results : dict
+        The parameters of the run, the startup time of the command line
+        interface in seconds, for each stage the wall time in seconds
+        and the peak traced memory in megabytes, and the peak RSS of the
+        process in megabytes; if `download_partd` runs, also the results
+        of `reshape_memory`
+    """
+    if stages is None:
+        stages = STAGES
+
+    tmp_dir = None
+    if data_dir is None:
+        tmp_dir = tempfile.mkdtemp(prefix="d4d_bench_")
+        data_dir = tmp_dir
+    data_dir = os.path.join(data_dir, "")
+
+    download_data = read_data._download_data
+    read_data._download_data = _no_download
+
+    results = {"scale": scale, "repeat": repeat, "file_format": file_format, "seed": seed,
+               "startup_seconds": time_startup(), "stages": {}}
+    try:
+        start = time.perf_counter()
+        synthetic_data.make_all(data_dir, scale=scale, seed=seed)
+        results["generate_seconds"] = time.perf_counter() - start
+
+        if "download_partd" in stages:
+            results["partd_reshape"] = reshape_memory(n_generic=max(int(1500 * scale), 10),
+                                                      n_years=reshape_years, repeat=repeat,
+                                                      seed=seed)
+
+        for stage in STAGES:
+            # stages that weren't selected still need to run once to produce
+            # the inputs of later stages
+            if stage not in stages:
+                if stage != "make_drug_table" and "make_drug_table" in stages:
+                    _run_stage(stage, data_dir, file_format)
+                continue
+            seconds, peak = time_stage(stage, data_dir, file_format, repeat)
+            results["stages"][stage] = {"seconds": seconds, "peak_mb": peak / 1024.0**2}
+        # tracemalloc only sees memory allocated through Python (which includes
+        # numpy and pandas), so also record the peak RSS of the whole process
+        results["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    finally:
+        read_data._download_data = download_data
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+    return results
+
+
+# if script is called from the command, line, code below is executed.
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the data wrangling pipeline " +
+                                                 "on synthetic data.")
+
+    parser.add_argument("-s", "--scale", action="store", type=float, required=False, default=0.1,
+                        dest="scale", help="Size of the synthetic data relative to the real " +
+                                           "data. Default: 0.1")
+    parser.add_argument("-r", "--repeat", action="store", type=int, required=False, default=3,
+                        dest="repeat", help="Number of runs per stage. Default: 3")
+    parser.add_argument("--stages", action="store", nargs="+", required=False, default=None,
+                        dest="stages", choices=STAGES, help="Stages to run. Default: all")
+    parser.add_argument("-f", "--output-format", action="store", required=False, default="feather",
+                        dest="output_format", help="File format for output files. {'csv' | 'feather'}")
+    parser.add_argument("--seed", action="store", type=int, required=False, default=0,
+                        dest="seed", help="Seed for the synthetic data. Default: 0")
+    parser.add_argument("-d", "--data-dir", action="store", required=False, default=None,
+                        dest="data_dir", help="Keep the synthetic data in this directory " +
+                                              "instead of a temporary one.")
+    parser.add_argument("--reshape-years", action="store", type=int, required=False, default=5,
+                        dest="reshape_years", help="Number of years in the workbook for the " +
+                                                   "Part D reshape benchmark. Default: 5")
+    parser.add_argument("-o", "--output", action="store", required=False, default=None,
+                        dest="output", help="Optional JSON file to write the results to.")
+
+    clargs = parser.parse_args()
+
+    results = run_benchmarks(scale=clargs.scale, repeat=clargs.repeat, stages=clargs.stages,
+                             file_format=clargs.output_format, seed=clargs.seed,
+                             data_dir=clargs.data_dir, reshape_years=clargs.reshape_years)
+
+    print("%-25s %10.3f"%("startup (--help)", results["startup_seconds"]))
+    print("%-25s %10s %10s"%("stage", "seconds", "peak MB"))
+    for stage, res in results["stages"].items():
+        print("%-25s %10.3f %10.1f"%(stage, res["seconds"], res["peak_mb"]))
+    if "partd_reshape" in results:
+        res = results["partd_reshape"]
+        print("%-25s %10.3f %10.1f  (%.1fx the %.1f MB workbook, %i years)"%(
+            "partd reshape", res["seconds"], res["peak_mb"], res["peak_ratio"], res["wide_mb"],
+            res["n_years"]))
+
+    if clargs.output is not None:
+        with open(clargs.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,425 @@
+"""
+A small build graph over the stages in `read_data.py`, so that stages whose
+inputs haven't changed are skipped.
+
+Every stage produces one or more artifacts in `data_dir`. After a stage runs,
+we record in `<data_dir>/.build/<stage>.json`:
+
+* a hash of the stage's code (the source of the functions it calls),
+* a hash of its inputs: the parameters and URL for the download stages, the
+  content hashes of the upstream artifacts for `drug_table` and `serving`,
+  and the content hash of the drug name dictionary for the stages that use it,
+* the content hashes of the artifacts it wrote.
+
+A stage re-runs only if one of these changed, or if one of its artifacts is
+missing or was modified since. File hashes are cached by size and modification
+time in `<data_dir>/.build/hashes.json`, so checking an up-to-date data
+directory doesn't read the (large) data files again and takes well under a
+second.
+
+The download stages can't know whether CMS or the NIH changed a file without
+asking them; with `check_remote=True`, the ETag, Last-Modified and
+Content-Length headers of the source URL are part of the stage's inputs.
+
+The last stage, `serving`, precomputes the tables for the Shiny dashboards
+(see `materialize.py`) in `<data_dir>/serving/`.
+
+Usage:
+
+    python build.py                  # build everything that's out of date
+    python build.py drug_table -n    # show what would run
+"""
+import os # file system
+import json # build records
+import inspect # source of the stage functions
+import hashlib # content hashes
+import argparse # argument parsing for command line options
+from collections import OrderedDict
+
+import namedict
+import read_data
+import materialize
+
+
+# URLs of the download stages; the Part D URL comes from `read_data.PARTD_RELEASES`
+URLS = {"puf": read_data.PUF_URL, "rxnorm": read_data.RXNORM_URL,
+        "drug_classes": read_data.DRUG_CLASSES_URL}
+
+# the stages in the order in which they need to run, with the functions that
+# make up their code, and the upstream stages they depend on
+STAGES = OrderedDict([
+    ("partd", {"code": [read_data.download_partd, read_data._partd_release,
+                        read_data._partd_column_groups,
+                        read_data._partd_header_key, read_data._partd_year_tables,
+                        namedict.load_dictionary, namedict.update_dictionary,
+                        namedict.local_dictionary, namedict.all_names,
+                        namedict.name_tokens, namedict.ids, namedict.encode, namedict.encode_names],
+               "deps": []}),
+    ("puf", {"code": [read_data.download_puf], "deps": []}),
+    ("rxnorm", {"code": [read_data.download_rxnorm], "deps": []}),
+    ("drug_classes", {"code": [read_data.download_drug_class_ids], "deps": []}),
+    ("drug_table", {"code": [read_data.make_drug_table, namedict.load_dictionary,
+                             namedict.update_dictionary, namedict.local_dictionary,
+                             namedict.all_names, namedict.name_tokens, namedict.ids],
+                    "deps": ["partd", "puf", "rxnorm", "drug_classes"]}),
+    ("serving", {"code": [materialize.materialize_serving_tables, materialize.table_names,
+                          materialize.spending_overall, materialize.add_generic_num,
+                          materialize.out_of_pocket_long, materialize.top_generics,
+                          materialize.top_by_year, materialize.class_totals,
+                          materialize._write_table, read_data.load_spending],
+                 "deps": ["partd", "drug_table"]}),
+])
+STAGE_ORDER = list(STAGES.keys())
+
+# functions used by all stages
+COMMON_CODE = [read_data._download_data, read_data._read_data, read_data._check_data,
+               read_data._write_data]
+
+
+def _build_dir(data_dir):
+    return os.path.join(data_dir, ".build")
+
+
+def _sha1_file(path, blocksize=1 << 20):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class HashCache(object):
+    """
+    Content hashes of files, cached by path, size and modification time so
+    that unchanged files aren't read again.
+    """
+    def __init__(self, data_dir):
+        self.path = os.path.join(_build_dir(data_dir), "hashes.json")
+        try:
+            with open(self.path, "r") as f:
+                self.hashes = json.load(f)
+        except (IOError, ValueError):
+            self.hashes = {}
+        self.changed = False
+
+    def hash(self, path):
+        """
+        Return the SHA1 hash of the file at `path`, or None if it doesn't exist.
+        """
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        key = os.path.abspath(path)
+        entry = self.hashes.get(key)
+        if entry is not None and entry["size"] == stat.st_size and \
+                entry["mtime_ns"] == stat.st_mtime_ns:
+            return entry["sha1"]
+        sha1 = _sha1_file(path)
+        self.hashes[key] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha1": sha1}
+        self.changed = True
+        return sha1
+
+    def save(self):
+        if self.changed:
+            try:
+                os.stat(os.path.dirname(self.path))
+            except FileNotFoundError:
+                os.makedirs(os.path.dirname(self.path))
+            with open(self.path, "w") as f:
+                json.dump(self.hashes, f)
+            self.changed = False
+        return
+
+
+def code_version(stage):
+    """
+    Hash of the source code of the functions that make up `stage`.
+    """
+    h = hashlib.sha1()
+    for func in STAGES[stage]["code"] + COMMON_CODE:
+        # decorated functions keep a reference to the function they wrap
+        func = getattr(func, "__wrapped__", func)
+        h.update(inspect.getsource(func).encode("utf-8"))
+    return h.hexdigest()
+
+
+def outputs(stage, release=None):
+    """
+    The names of the artifacts `stage` produces: data sets in `data_dir`
+    without file extension, or, for files that are always in the same format,
+    paths relative to `data_dir` with the extension (see `artifact_path`).
+    """
+    if stage == "partd":
+        years = read_data._partd_release(release)[1]["years"]
+        return ["drugnames"] + ["spending-%i"%year for year in years]
+    elif stage == "puf":
+        return ["puf"]
+    elif stage == "rxnorm":
+        return ["rxnorm"]
+    elif stage == "drug_classes":
+        return ["drug_major_class", "drug_class"]
+    elif stage == "drug_table":
+        return ["drugnames_withclasses"]
+    elif stage == "serving":
+        names = [name + ".feather" for name in materialize.table_names()] + ["manifest.json"]
+        return [materialize.SERVING_DIR + "/" + name for name in names]
+    else:
+        raise KeyError("Unknown stage %s."%stage)
+
+
+def artifact_path(data_dir, name, file_format):
+    """
+    The path of the artifact `name` (see `outputs`) in `data_dir`.
+    """
+    if os.path.splitext(name)[1] == "":
+        name = name + "." + file_format
+    return os.path.join(data_dir, name)
+
+
+def _remote_version(url):
+    """
+    Ask the server for the headers that change when the file at `url` changes.
+    """
+    # only needed for check_remote=True, so we don't pay for the import otherwise
+    import requests
+    response = requests.head(url, allow_redirects=True, timeout=30)
+    return {h: response.headers.get(h) for h in ["ETag", "Last-Modified", "Content-Length"]}
+
+
+def stage_inputs(stage, data_dir, file_format, cache, release=None, check_remote=False):
+    """
+    Describe everything `stage` reads: its parameters, source URL, and the
+    content hashes of the upstream artifacts and the drug name dictionary.
+    """
+    inputs = {"file_format": file_format}
+    if stage == "partd":
+        inputs["release"], inputs["schema"] = read_data._partd_release(release)
+        url = inputs["schema"]["url"]
+    elif stage in ("drug_table", "serving"):
+        url = None
+    else:
+        url = URLS[stage]
+        inputs["url"] = url
+
+    if stage == "puf":
+        # `make_drug_table` only needs three columns of the PUF
+        inputs["all_columns"] = False
+
+    if check_remote and url is not None:
+        inputs["remote"] = _remote_version(url)
+
+    for dep in STAGES[stage]["deps"]:
+        for name in outputs(dep, release if dep == "partd" else None):
+            inputs[name] = cache.hash(artifact_path(data_dir, name, file_format))
+
+    # both stages extend the global drug name dictionary (see `namedict.py`)
+    # of feather data directories
+    if stage in ("partd", "drug_table") and file_format == "feather":
+        inputs[namedict.DICTIONARY_NAME] = cache.hash(os.path.join(data_dir,
+                                                                   namedict.DICTIONARY_NAME + ".feather"))
+
+    return inputs
+
+
+def _record_path(data_dir, stage):
+    return os.path.join(_build_dir(data_dir), stage + ".json")
+
+
+def _load_record(data_dir, stage):
+    try:
+        with open(_record_path(data_dir, stage), "r") as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def is_stale(stage, data_dir, file_format, cache, release=None, check_remote=False):
+    """
+    Figure out whether `stage` needs to run.
+
+    Returns
+    -------
+    reason : string or None
+        Why the stage needs to run, or None if it is up to date
+    """
+    record = _load_record(data_dir, stage)
+    if record is None:
+        return "never built"
+    if record["code"] != code_version(stage):
+        return "code changed"
+
+    inputs = stage_inputs(stage, data_dir, file_format, cache, release, check_remote)
+    if not check_remote:
+        inputs.pop("remote", None)
+        record["inputs"].pop("remote", None)
+    if json.loads(json.dumps(inputs)) != record["inputs"]:
+        return "inputs changed"
+
+    for name in outputs(stage, release):
+        sha1 = cache.hash(artifact_path(data_dir, name, file_format))
+        if sha1 is None:
+            return "%s missing"%name
+        if sha1 != record["outputs"].get(name):
+            return "%s modified"%name
+
+    return None
+
+
+def _run(stage, data_dir, file_format, release=None):
+    if stage == "partd":
+        read_data.download_partd(data_dir, output_format=file_format, release=release,
+                                 overwrite=True)
+    elif stage == "puf":
+        read_data.download_puf(data_dir, all_columns=False, output_format=file_format)
+    elif stage == "rxnorm":
+        read_data.download_rxnorm(data_dir, output_format=file_format)
+    elif stage == "drug_classes":
+        read_data.download_drug_class_ids(data_dir, output_format=file_format)
+    elif stage == "drug_table":
+        read_data.make_drug_table(data_dir, data_local=True, file_format=file_format)
+    elif stage == "serving":
+        materialize.materialize_serving_tables(data_dir, file_format=file_format)
+    return
+
+
+def _with_deps(targets):
+    """
+    Add all upstream stages of `targets`, and sort them in run order.
+    """
+    needed = set()
+    todo = list(targets)
+    while len(todo) > 0:
+        stage = todo.pop()
+        if stage in needed:
+            continue
+        needed.add(stage)
+        todo.extend(STAGES[stage]["deps"])
+    return [s for s in STAGE_ORDER if s in needed]
+
+
+def build(targets=None, data_dir="../data/", file_format="feather", release=None,
+          force=False, check_remote=False, dry_run=False, snapshot=False):
+    """
+    Bring the artifacts of `targets` and everything upstream of them up to date.
+
+    Parameters
+    ----------
+    targets : list of strings, optional, default: None
+        Stages to build, from `STAGE_ORDER`. If None, build all stages.
+
+    data_dir : string, optional, default: "../data/"
+        The data directory
+
+    file_format : string, optional, default: "feather"
+        The file format of the artifacts, "csv" or "feather".
+
+    release : int, optional, default: None
+        The CMS Part D release, see `read_data.PARTD_RELEASES`. If None, the
+        most recent one.
+
+    force : bool, optional, default: False
+        If True, run all stages regardless of whether they are up to date.
+
+    check_remote : bool, optional, default: False
+        If True, ask the servers whether the source files of the download
+        stages have changed.
+
+    dry_run : bool, optional, default: False
+        If True, only report which stages would run.
+
+    snapshot : bool, optional, default: False
+        If True, keep a snapshot (see `snapshots.py`) of the artifacts of
+        every stage that ran.
+
+    Returns
+    -------
+    ran : list of (string, string) tuples
+        The stages that ran (or would have run), with the reason
+    """
+    if targets is None:
+        targets = STAGE_ORDER
+
+    data_dir = os.path.join(data_dir, "")
+    try:
+        os.makedirs(_build_dir(data_dir))
+    except FileExistsError:
+        pass
+
+    cache = HashCache(data_dir)
+    ran = []
+    try:
+        for stage in _with_deps(targets):
+            reason = "forced" if force else is_stale(stage, data_dir, file_format, cache,
+                                                     release, check_remote)
+            if reason is None:
+                continue
+            ran.append((stage, reason))
+            if dry_run:
+                continue
+
+            _run(stage, data_dir, file_format, release)
+
+            record = {"code": code_version(stage),
+                      "inputs": stage_inputs(stage, data_dir, file_format, cache,
+                                             release, check_remote),
+                      "outputs": {name: cache.hash(artifact_path(data_dir, name, file_format))
+                                  for name in outputs(stage, release)}}
+            with open(_record_path(data_dir, stage), "w") as f:
+                json.dump(record, f, indent=2)
+
+            if snapshot:
+                # imported here, because `snapshots` itself imports this module
+                import snapshots
+                try:
+                    snapshots.snapshot(data_dir, stage, release=release if stage == "partd" else None,
+                                       file_format=file_format, cache=cache)
+                except snapshots.SnapshotExistsError as e:
+                    # snapshots are immutable, so the first build of a release is kept
+                    print("%s Keeping the existing snapshot."%e)
+    finally:
+        cache.save()
+
+    return ran
+
+
+# if script is called from the command, line, code below is executed.
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Bring the drug spending data up to date, " +
+                                                 "skipping stages whose inputs haven't changed.")
+
+    parser.add_argument("targets", nargs="*", default=None,
+                        help="Stages to build (with their upstream stages), any of " +
+                             "%s. Default: all"%STAGE_ORDER)
+    parser.add_argument("-d", "--data-dir", action="store", required=False, default="../data/",
+                        dest="data_dir", help="Optional path to the data directory. Default: '../data/'")
+    parser.add_argument("-f", "--output-format", action="store", required=False, default="feather",
+                        dest="output_format", help="File format for output files. {'csv' | 'feather'}")
+    parser.add_argument("--partd-release", action="store", type=int, required=False, default=None,
+                        choices=sorted(read_data.PARTD_RELEASES), dest="partd_release",
+                        help="CMS Part D release. Default: most recent.")
+    parser.add_argument("--force", action="store_true", dest="force",
+                        help="Run all stages, even if they are up to date.")
+    parser.add_argument("--check-remote", action="store_true", dest="check_remote",
+                        help="Ask the servers whether the source files have changed.")
+    parser.add_argument("--snapshot", action="store_true", dest="snapshot",
+                        help="Keep a snapshot of the artifacts of every stage that ran.")
+    parser.add_argument("-n", "--dry-run", action="store_true", dest="dry_run",
+                        help="Only show which stages would run.")
+
+    clargs = parser.parse_args()
+
+    for target in clargs.targets:
+        if target not in STAGES:
+            parser.error("Unknown stage '%s', must be one of %s."%(target, STAGE_ORDER))
+
+    ran = build(clargs.targets or None, data_dir=clargs.data_dir, file_format=clargs.output_format,
+                release=clargs.partd_release, force=clargs.force,
+                check_remote=clargs.check_remote, dry_run=clargs.dry_run,
+                snapshot=clargs.snapshot)
+
+    if len(ran) == 0:
+        print("Everything is up to date.")
+    for stage, reason in ran:
+        print("%s %s (%s)"%("would run" if clargs.dry_run else "ran", stage, reason))
@@ -0,0 +1,236 @@
+"""
+Fast per-drug lookups over the output of `read_data.py`.
+
+`DrugIndex` loads `drugnames_withclasses` (or `drugnames`, if the drug table
+hasn't been made yet) and all `spending-<year>` files once, and builds:
+
+* a hash index from normalized brand and generic names to drugs, for point
+  lookups,
+* a sorted list of all names, for prefix lookups with binary search,
+* one plain Python record per drug with its RXCUI codes, drug classes and
+  spending per year, so that answering a query doesn't touch pandas at all.
+
+Point lookups are cached in an LRU cache. For load testing, `serve` wraps an
+index in a small local HTTP server, which handles each request in a thread:
+
+    python drugindex.py serve --port 8000
+    curl 'http://localhost:8000/drug?name=lipitor'
+    curl 'http://localhost:8000/prefix?q=ator&limit=10'
+"""
+import json # HTTP responses
+import bisect # prefix lookups
+import argparse # argument parsing for command line options
+import functools # LRU cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from read_data import _data_exists, _read_data, load_spending, spending_years
+
+
+# the columns of the spending files that are returned for each year
+SPENDING_COLUMNS = ["claim_count", "total_spending", "user_count", "total_spending_per_user",
+                    "unit_count", "unit_cost_wavg", "user_count_non_lowincome",
+                    "out_of_pocket_avg_non_lowincome", "user_count_lowincome",
+                    "out_of_pocket_avg_lowincome"]
+
+# columns of `drugnames_withclasses` with several values separated by `|`,
+# and the value that means "none"
+LIST_COLUMNS = {"RXCUI": "0.0", "drug_major_class": "0", "dmc_name": "0",
+                "drug_class": "0", "dc_name": "0"}
+
+
+def _normalize(name):
+    return " ".join(str(name).split()).lower()
+
+
+def _split(value, missing):
+    if value is None or value != value or value == missing:
+        return []
+    return str(value).split("|")
+
+
+class DrugIndex(object):
+    """
+    In-memory index for looking up drugs by brand or generic name.
+
+    Parameters
+    ----------
+    data_dir : string, optional, default: "../data/"
+        The directory with the output of `read_data.py`
+
+    file_format : string, optional, default: "feather"
+        The file format of the data files, "csv" or "feather"
+
+    cache_size : int, optional, default: 4096
+        Number of point lookups to keep in the LRU cache
+
+    Attributes
+    ----------
+    records : list of dicts
+        One record per drug (i.e. brand and generic name combination)
+
+    names : list of strings
+        All normalized brand and generic names, sorted
+    """
+    def __init__(self, data_dir="../data/", file_format="feather", cache_size=4096):
+        if _data_exists(data_dir, "drugnames_withclasses", file_format):
+            drugnames = _read_data(data_dir, "drugnames_withclasses", file_format)
+        else:
+            drugnames = _read_data(data_dir, "drugnames", file_format)
+
+        self.records = []
+        self._by_key = {}
+        self._by_name = {}
+        for row in drugnames.to_dict("records"):
+            brand = _normalize(row["drugname_brand"])
+            generic = _normalize(row["drugname_generic"])
+            if (brand, generic) in self._by_key:
+                continue
+            record = {"drugname_brand": brand, "drugname_generic": generic, "spending": {}}
+            for col, missing in LIST_COLUMNS.items():
+                if col in row:
+                    record[col] = _split(row[col], missing)
+            self._by_key[(brand, generic)] = len(self.records)
+            self.records.append(record)
+            for name in set([brand, generic]):
+                self._by_name.setdefault(name, []).append(self._by_key[(brand, generic)])
+
+        if len(spending_years(data_dir, file_format)) > 0:
+            spending = load_spending(data_dir, file_format)
+            columns = ["drugname_brand", "drugname_generic", "year"] + SPENDING_COLUMNS
+            for row in spending[columns].itertuples(index=False):
+                idx = self._by_key.get((_normalize(row[0]), _normalize(row[1])))
+                if idx is None:
+                    continue
+                self.records[idx]["spending"][int(row[2])] = \
+                    {col: (None if v != v else float(v)) for col, v in zip(SPENDING_COLUMNS, row[3:])}
+
+        self.names = sorted(self._by_name)
+        self._cached_lookup = functools.lru_cache(maxsize=cache_size)(self._lookup)
+
+    def __len__(self):
+        return len(self.records)
+
+    def _lookup(self, normalized_name):
+        return tuple(self.records[i] for i in self._by_name.get(normalized_name, []))
+
+    def lookup(self, name):
+        """
+        Find all drugs whose brand or generic name is `name` (case-insensitive).
+        Results are cached; the records are shared, so don't modify them.
+
+        Returns
+        -------
+        records : tuple of dicts
+            The matching drugs, each with names, RXCUI codes, drug classes and
+            a `spending` dict keyed by year
+        """
+        # normalize first, so that spellings of the same name share a cache entry
+        return self._cached_lookup(_normalize(name))
+
+    def prefix(self, prefix, limit=20):
+        """
+        Find up to `limit` brand or generic names that start with `prefix`
+        (case-insensitive), in alphabetical order.
+        """
+        prefix = _normalize(prefix)
+        start = bisect.bisect_left(self.names, prefix)
+        matches = []
+        for name in self.names[start:]:
+            if not name.startswith(prefix) or len(matches) >= limit:
+                break
+            matches.append(name)
+        return matches
+
+    def cache_info(self):
+        """
+        Hits, misses and size of the LRU cache for point lookups.
+        """
+        return self._cached_lookup.cache_info()
+
+
+def _make_handler(index):
+    class DrugIndexHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = parse_qs(url.query)
+            if url.path == "/drug" and "name" in params:
+                body = list(index.lookup(params["name"][0]))
+            elif url.path == "/prefix" and "q" in params:
+                try:
+                    limit = int(params.get("limit", ["20"])[0])
+                except ValueError:
+                    limit = -1
+                if limit < 0:
+                    self.send_error(400, "The limit must be a non-negative integer.")
+                    return
+                body = index.prefix(params["q"][0], limit=limit)
+            else:
+                self.send_error(404, "Use /drug?name=<name> or /prefix?q=<prefix>&limit=<n>")
+                return
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            # don't log every request, it would dominate a load test
+            return
+
+    return DrugIndexHandler
+
+
+def serve(index, host="127.0.0.1", port=8000):
+    """
+    Serve lookups in `index` over HTTP until interrupted.
+    """
+    server = ThreadingHTTPServer((host, port), _make_handler(index))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return
+
+
+# if script is called from the command, line, code below is executed.
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Look up drugs by brand or generic name.")
+
+    parser.add_argument("-d", "--data-dir", action="store", required=False, default="../data/",
+                        dest="data_dir", help="Optional path to the data directory. Default: '../data/'")
+    parser.add_argument("-f", "--file-format", action="store", required=False, default="feather",
+                        dest="file_format", help="File format of the data files. {'csv' | 'feather'}")
+
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    lookup_parser = subparsers.add_parser("lookup", help="Look up a drug by name.")
+    lookup_parser.add_argument("name", help="Brand or generic name.")
+
+    prefix_parser = subparsers.add_parser("prefix", help="List names starting with a prefix.")
+    prefix_parser.add_argument("prefix", help="The prefix.")
+    prefix_parser.add_argument("-n", "--limit", action="store", type=int, default=20,
+                               dest="limit", help="Maximum number of names. Default: 20")
+
+    serve_parser = subparsers.add_parser("serve", help="Serve lookups over HTTP.")
+    serve_parser.add_argument("--host", action="store", default="127.0.0.1", dest="host",
+                              help="Host to bind to. Default: 127.0.0.1")
+    serve_parser.add_argument("-p", "--port", action="store", type=int, default=8000,
+                              dest="port", help="Port to listen on. Default: 8000")
+
+    clargs = parser.parse_args()
+
+    index = DrugIndex(clargs.data_dir, file_format=clargs.file_format)
+
+    if clargs.command == "lookup":
+        print(json.dumps(list(index.lookup(clargs.name)), indent=2))
+    elif clargs.command == "prefix":
+        print("\n".join(index.prefix(clargs.prefix, limit=clargs.limit)))
+    else:
+        print("Serving %i drugs on http://%s:%i/"%(len(index), clargs.host, clargs.port))
+        serve(index, host=clargs.host, port=clargs.port)
@@ -0,0 +1,398 @@
+"""
+The ATC and USP drug classifications as array-backed trees.
+
+`datawrangling/parse_atc_codes.py` flattens KEGG's ATC hierarchy (br08303)
+into a wide table with one column per level (A-F), and the USP classification
+(br08302) is tidied into `usp_drug_classification.csv` in the same way, so
+every consumer has to scan and group these tables to walk the hierarchy.
+`Hierarchy` instead stores the nodes in depth-first order in a few NumPy
+arrays:
+
+* `codes`, `names`, `levels`: one entry per node,
+* `parents`: the parent of each node (-1 for top-level nodes),
+* `child_offsets`, `children`: the children of node `i` are
+  `children[child_offsets[i]:child_offsets[i + 1]]`,
+* `subtree_end`: the descendants of node `i` are the nodes `i + 1` to
+  `subtree_end[i] - 1`, since they directly follow it in depth-first order,
+* `ancestor_ids`: a (node x level) matrix with the ancestor of each node at
+  every level (the node itself at its own level, -1 below it),
+
+and a hash index from codes to nodes. Looking up the ancestors or
+descendants of a code, or mapping a whole column of codes to one level
+(e.g. from substances to therapeutic subgroups) is then an index lookup and
+an array slice, without any string splitting.
+
+Trees are built by streaming the KEGG files (or the CSV files made from them)
+line by line, and can be saved to and loaded from `.npz` files:
+
+    python hierarchy.py atc br08303.keg -o atc-tree.npz
+    python hierarchy.py usp usp_drug_classification.csv -o usp-tree.npz
+"""
+import re # strip HTML from the KEGG files
+import csv # stream the CSV files
+import argparse # argument parsing for command line options
+
+import numpy as np
+import pandas as pd
+
+
+# the levels of the ATC classification, as in KEGG br08303 (lines A-F)
+ATC_LEVELS = ["anatomical_group", "therapeutic_subgroup", "pharmacological_subgroup",
+              "chemical_subgroup", "substance", "kegg_drug"]
+
+# the levels of the USP classification, as in KEGG br08302 (lines A-D)
+USP_LEVELS = ["usp_category", "usp_class", "usp_drug", "drug_example"]
+
+# the columns of `usp_drug_classification.csv` with the name and code of each level
+USP_COLUMNS = [("usp_category", None), ("usp_class", None), ("usp_drug", "kegg_id_drug"),
+               ("drug_example", "kegg_id_drug_example")]
+
+# HTML tags in the KEGG files; `parse_atc_codes.py` cuts off the first "<"
+_TAGS = re.compile(r"<[^>]*>|^[a-z]+>")
+
+
+def _split_code(text):
+    """
+    Split a KEGG entry like "A01AA01 Sodium fluoride" into code and name.
+    """
+    parts = _TAGS.sub("", text.strip()).strip().split(None, 1)
+    if len(parts) == 0:
+        return "", ""
+    return parts[0], parts[1].strip() if len(parts) > 1 else ""
+
+
+def _keg_lines(path, n_levels):
+    """
+    Stream the node lines of a KEGG BRITE hierarchy file: lines starting
+    with A, B, C, ... are nodes on the first, second, third, ... level.
+
+    Yields
+    ------
+    level, text : int, string
+    """
+    letters = "ABCDEFGHIJ"[:n_levels]
+    with open(path, "r") as f:
+        for line in f:
+            if len(line) > 1 and line[0] in letters:
+                yield letters.index(line[0]), line[1:]
+
+
+class _Builder(object):
+    """
+    Collects nodes in depth-first order and keeps track of the current path.
+    """
+    def __init__(self):
+        self.codes, self.names, self.levels, self.parents, self.ends = [], [], [], [], []
+        self.stack = []
+
+    def _pop(self):
+        self.ends[self.stack.pop()] = len(self.codes)
+
+    def add(self, level, code, name):
+        while len(self.stack) > 0 and self.levels[self.stack[-1]] >= level:
+            self._pop()
+        self.parents.append(self.stack[-1] if len(self.stack) > 0 else -1)
+        self.codes.append(code)
+        self.names.append(name)
+        self.levels.append(level)
+        self.ends.append(-1)
+        self.stack.append(len(self.codes) - 1)
+
+    def add_path(self, path, previous):
+        """
+        Add the nodes of `path` (a list of (code, name) tuples from the top
+        level down, with None for missing levels) that aren't shared with the
+        `previous` path.
+        """
+        new = False
+        for level, node in enumerate(path):
+            if node is None:
+                break
+            if new or previous is None or level >= len(previous) or previous[level] != node:
+                new = True
+                self.add(level, node[0], node[1])
+
+    def finish(self, level_names):
+        while len(self.stack) > 0:
+            self._pop()
+        return Hierarchy(np.array(self.codes, dtype=str), np.array(self.names, dtype=str),
+                         np.array(self.levels, dtype=np.int8), np.array(self.parents, dtype=np.int32),
+                         np.array(self.ends, dtype=np.int32), level_names)
+
+
+class Hierarchy(object):
+    """
+    A classification tree stored in arrays, see the module docstring.
+
+    Use `from_atc_keg`, `from_usp_keg`, `from_atc_csv`, `from_usp_csv` or
+    `load` to make one.
+
+    Parameters
+    ----------
+    codes, names : np.ndarray of strings
+        Code and name of each node, in depth-first order
+
+    levels : np.ndarray of int
+        The level of each node (0 for the top level)
+
+    parents : np.ndarray of int
+        The position of the parent of each node, -1 for top-level nodes
+
+    subtree_end : np.ndarray of int
+        One past the position of the last descendant of each node
+
+    level_names : list of strings
+        The name of each level
+
+    Attributes
+    ----------
+    index : dict
+        Position of the (first) node with each code. KEGG drug IDs can appear
+        under several ATC codes; `nodes(code)` returns all of them.
+    """
+    def __init__(self, codes, names, levels, parents, subtree_end, level_names):
+        self.codes = codes
+        self.names = names
+        self.levels = levels
+        self.parents = parents
+        self.subtree_end = subtree_end
+        self.level_names = list(level_names)
+        n = len(codes)
+
+        # children in CSR form; a stable sort keeps them in depth-first order
+        order = np.argsort(parents, kind="mergesort")
+        self.children = order[np.count_nonzero(parents < 0):].astype(np.int32)
+        counts = np.bincount(parents[parents >= 0], minlength=n)
+        self.child_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+        # every node's ancestors by level; parents are on lower levels, so
+        # filling the matrix level by level only reads finished rows
+        self.ancestor_ids = np.full((n, len(self.level_names)), -1, dtype=np.int32)
+        for level in range(len(self.level_names)):
+            nodes = np.nonzero(levels == level)[0]
+            has_parent = parents[nodes] >= 0
+            self.ancestor_ids[nodes[has_parent]] = self.ancestor_ids[parents[nodes[has_parent]]]
+            self.ancestor_ids[nodes, level] = nodes
+
+        self.index = {}
+        for i, code in enumerate(codes.tolist()):
+            self.index.setdefault(code, i)
+        self._code_index = pd.Index(list(self.index.keys()), dtype=object)
+        self._code_nodes = np.fromiter(self.index.values(), dtype=np.int64, count=len(self.index))
+
+    def __len__(self):
+        return len(self.codes)
+
+    @classmethod
+    def from_atc_keg(cls, path):
+        """
+        Read the KEGG ATC file (br08303.keg) line by line. Lines starting
+        with A-F are nodes on the six levels, like "E A01AA01 Sodium fluoride".
+        """
+        builder = _Builder()
+        for level, text in _keg_lines(path, len(ATC_LEVELS)):
+            code, name = _split_code(text)
+            if code != "":
+                builder.add(level, code, name)
+        return builder.finish(ATC_LEVELS)
+
+    @classmethod
+    def from_usp_keg(cls, path):
+        """
+        Read the KEGG USP file (br08302.keg) line by line, the same way as
+        `datawrangling/usp_drug_classification_tidying_script.py`: categories
+        (A) and classes (B) have no codes, so their names are used as codes;
+        drugs (C) are identified by their KEGG ID ("[DG:DG01234]") if they
+        have one, and drug examples (D) by their KEGG ID.
+        """
+        builder = _Builder()
+        for level, text in _keg_lines(path, len(USP_LEVELS)):
+            text = text.strip()
+            if level < 2:
+                code, name = text, text
+            elif level == 2:
+                name = text.split("[")[0].strip()
+                kegg_id = re.search(r"\[[A-Z]+:(\w+)\]", text)
+                code = kegg_id.group(1) if kegg_id is not None else name
+            else:
+                code, name = _split_code(text)
+                name = name.split("(")[0].strip()
+            if code != "":
+                builder.add(level, code, name)
+        return builder.finish(USP_LEVELS)
+
+    @classmethod
+    def from_atc_csv(cls, path):
+        """
+        Read `atc-codes.csv`, the output of `datawrangling/parse_atc_codes.py`:
+        one row per path through the tree, columns A-F, entries like
+        "A01 STOMATOLOGICAL PREPARATIONS".
+        """
+        builder = _Builder()
+        previous = None
+        with open(path, "r") as f:
+            reader = csv.reader(f)
+            next(reader)
+            for row in reader:
+                path_ = [_split_code(cell) if cell.strip() != "" else None for cell in row]
+                builder.add_path(path_, previous)
+                previous = path_
+        return builder.finish(ATC_LEVELS)
+
+    @classmethod
+    def from_usp_csv(cls, path):
+        """
+        Read `usp_drug_classification.csv`, the output of
+        `datawrangling/usp_drug_classification_tidying_script.py`. Categories
+        and classes have no codes, so their names are used as codes; drugs
+        without a KEGG ID are identified by their name.
+        """
+        builder = _Builder()
+        previous = None
+        with open(path, "r") as f:
+            for row in csv.DictReader(f):
+                path_ = []
+                for name_col, code_col in USP_COLUMNS:
+                    name = row[name_col].strip()
+                    code = row[code_col].strip() if code_col is not None else ""
+                    path_.append((code if code != "" else name, name) if name != "" else None)
+                builder.add_path(path_, previous)
+                previous = path_
+        return builder.finish(USP_LEVELS)
+
+    def save(self, path):
+        """
+        Save the tree to a `.npz` file.
+        """
+        np.savez_compressed(path, codes=self.codes, names=self.names, levels=self.levels,
+                            parents=self.parents, subtree_end=self.subtree_end,
+                            level_names=np.array(self.level_names, dtype=str))
+        return
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a tree saved with `save`.
+        """
+        with np.load(path, allow_pickle=False) as f:
+            return cls(f["codes"], f["names"], f["levels"], f["parents"], f["subtree_end"],
+                       f["level_names"].tolist())
+
+    def _level(self, level):
+        if isinstance(level, str):
+            return self.level_names.index(level)
+        return level
+
+    def node(self, code):
+        """
+        The position of the (first) node with `code`; raises KeyError if
+        there is none.
+        """
+        return self.index[code]
+
+    def nodes(self, code):
+        """
+        The positions of all nodes with `code`.
+        """
+        return np.nonzero(self.codes == code)[0]
+
+    def ancestors(self, code):
+        """
+        The codes of the ancestors of `code`, from the top level down.
+        """
+        i = self.index[code]
+        ids = self.ancestor_ids[i, :self.levels[i]]
+        return self.codes[ids[ids >= 0]]
+
+    def descendants(self, code):
+        """
+        The codes of all descendants of `code`, in depth-first order.
+        """
+        i = self.index[code]
+        return self.codes[i + 1:self.subtree_end[i]]
+
+    def children_of(self, code):
+        """
+        The codes of the direct children of `code`.
+        """
+        i = self.index[code]
+        return self.codes[self.children[self.child_offsets[i]:self.child_offsets[i + 1]]]
+
+    def lookup(self, codes):
+        """
+        The positions of the nodes with `codes` (an array or Series), -1 for
+        codes that aren't in the tree.
+        """
+        # columns of drug codes repeat a lot, so only look up the unique ones
+        inverse, uniques = pd.factorize(np.asarray(codes, dtype=object))
+        found = self._code_index.get_indexer(pd.Index(uniques, dtype=object))
+        ids = np.where(found >= 0, self._code_nodes[found], -1)
+        return np.where(inverse >= 0, ids[inverse], -1)
+
+    def map_to_level(self, codes, level):
+        """
+        Map every code in `codes` to its ancestor at `level` (a level name
+        or number); codes at `level` map to themselves.
+
+        Returns
+        -------
+        mapped : np.ndarray of objects
+            The codes at `level`, None for codes that aren't in the tree or
+            are above `level`
+        """
+        target = self._ancestors_at(self.lookup(codes), self._level(level))
+        mapped = np.full(len(target), None, dtype=object)
+        mapped[target >= 0] = self.codes[target[target >= 0]]
+        return mapped
+
+    def _ancestors_at(self, ids, level):
+        target = np.full(len(ids), -1, dtype=np.int64)
+        target[ids >= 0] = self.ancestor_ids[ids[ids >= 0], level]
+        return target
+
+    def rollup(self, codes, values, level):
+        """
+        Sum `values` over the ancestors at `level` of `codes`, e.g. spending
+        per substance to spending per therapeutic subgroup.
+
+        Returns
+        -------
+        totals : pd.Series
+            The sums, indexed by the codes at `level`, in tree order; codes
+            that can't be mapped are left out
+        """
+        target = self._ancestors_at(self.lookup(codes), self._level(level))
+        valid = target >= 0
+        sums = np.bincount(target[valid], weights=np.asarray(values, dtype=float)[valid],
+                           minlength=len(self))
+        ids = np.unique(target[valid])
+        return pd.Series(sums[ids], index=pd.Index(self.codes[ids], name=self.level_names[self._level(level)]))
+
+
+# if script is called from the command, line, code below is executed.
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Export the ATC or USP classification as an " +
+                                                 "array-backed tree.")
+
+    parser.add_argument("classification", choices=["atc", "usp"], help="The classification.")
+    parser.add_argument("input", help="KEGG file (br08303.keg, br08302.keg) or the CSV file made " +
+                                      "from it (atc-codes.csv, usp_drug_classification.csv).")
+    parser.add_argument("-o", "--output", action="store", required=True, dest="output",
+                        help="The .npz file to write the tree to.")
+
+    clargs = parser.parse_args()
+
+    if clargs.classification == "atc":
+        if clargs.input.endswith(".csv"):
+            tree = Hierarchy.from_atc_csv(clargs.input)
+        else:
+            tree = Hierarchy.from_atc_keg(clargs.input)
+    else:
+        if clargs.input.endswith(".csv"):
+            tree = Hierarchy.from_usp_csv(clargs.input)
+        else:
+            tree = Hierarchy.from_usp_keg(clargs.input)
+
+    tree.save(clargs.output)
+    print("Wrote %i nodes."%len(tree))
@@ -0,0 +1,278 @@
+"""
+Materialize the pre-aggregated tables served by the Shiny dashboards in `R/apps/`.
+
+The dashboards used to load hand-built files (`testing-top100-byuser.feather`,
+made with `combine_data.R`) and compute per-brand indicators on every
+session start. This script runs after `read_data.py` and writes small,
+sorted, uncompressed Feather files plus a `manifest.json` describing them,
+so that dashboard startup is a handful of memory-mapped reads.
+
+Tables
+------
+* `spending`: all years of Part D spending, one row per brand, generic and year,
+  with `generic_num` ranking the brands within each generic by total users
+* `spending_overall`: one row per generic and year, summed over all brands
+* `top<N>_byuser`, `top<N>_byspending` (plus `_overall` versions): the rows of
+  the two tables above for the N generics with the most users/highest spending
+  over all years
+* `top<N>_byuser_oop`, `top<N>_byspending_oop`: the average out-of-pocket
+  costs of the same drugs in long format, one row per drug, year and
+  low-income subsidy status
+* `top_by_year`: the top N generics per year, ranked by users and by spending
+* `class_totals`: spending per drug major class and year (only if
+  `drugnames_withclasses` exists)
+
+The tables are the `serving` stage of `build.py`, which writes them to
+`<data_dir>/serving/` after `download_partd` and `make_drug_table` ran:
+
+    python build.py serving
+    python read_data.py materialize -o ../../R/apps/shinydashboard-medicared/serving/
+
+`R/apps/shinydashboard-medicared/global.R` reads them from `serving/` in the
+app directory (see the README there for deploying the app).
+"""
+import os # check whether files exist
+import json # write the manifest
+import time # timestamp for the manifest
+import argparse # argument parsing for command line options
+
+import numpy as np
+import pandas as pd
+
+import pyarrow as pa
+import pyarrow.feather as paf
+
+from read_data import _data_exists, _read_data, load_spending
+
+
+# columns that can be summed over brands; the remaining numeric columns are
+# brand-specific averages and are left empty in the overall table
+SUM_COLUMNS = ["claim_count", "total_spending", "user_count", "unit_count",
+               "user_count_non_lowincome", "user_count_lowincome"]
+BRAND_COLUMNS = ["unit_cost_wavg", "out_of_pocket_avg_lowincome",
+                 "out_of_pocket_avg_non_lowincome"]
+
+# the directory in `data_dir` the tables are written to by default
+SERVING_DIR = "serving"
+
+# the label of the rows of `spending_overall`, as in `combine_data.R`
+ALL_BRANDS = "ALL BRAND NAMES"
+
+# the out-of-pocket columns, and the labels of the subsidy status in the dashboards
+LIS_STATUS = [("out_of_pocket_avg_lowincome", "Patients Receiving Low-Income Subsidy"),
+              ("out_of_pocket_avg_non_lowincome", "Patients Receiving No Subsidy")]
+
+
+def spending_overall(spending):
+    """
+    Summarize the spending data over all brands of each generic drug,
+    one row per generic and year, with `drugname_brand` set to
+    "ALL BRAND NAMES" (the same as `combine_data.R`).
+    """
+    overall = spending.groupby(["drugname_generic", "year"], sort=True)[SUM_COLUMNS].sum()
+    overall = overall.reset_index()
+    overall["total_spending_per_user"] = overall["total_spending"] / overall["user_count"]
+    overall["drugname_brand"] = ALL_BRANDS
+    for col in BRAND_COLUMNS:
+        overall[col] = np.nan
+    return overall
+
+
+def add_generic_num(spending):
+    """
+    Number the brands of each generic drug (starting at 1) in descending order
+    of total users over all years. This is what the dashboards used to compute
+    at startup.
+    """
+    users = spending.groupby(["drugname_generic", "drugname_brand"])["user_count"].sum()
+    users = users.reset_index().sort_values(["drugname_generic", "user_count"],
+                                            ascending=[True, False], kind="mergesort")
+    users["generic_num"] = users.groupby("drugname_generic").cumcount() + 1
+    return spending.merge(users[["drugname_generic", "drugname_brand", "generic_num"]],
+                          on=["drugname_generic", "drugname_brand"], how="left")
+
+
+def out_of_pocket_long(spending):
+    """
+    Put the average out-of-pocket costs for patients with and without a
+    low-income subsidy into one column `oop_avg`, with the status in
+    `lis_status` (an ordered categorical, read as a factor in R), so that the
+    dashboards can compare them without reshaping the data at startup.
+    """
+    tables = []
+    for col, label in LIS_STATUS:
+        df = spending[["drugname_brand", "drugname_generic", "year", col]]
+        tables.append(df.rename(columns={col: "oop_avg"}).assign(lis_status=label))
+    oop = pd.concat(tables, ignore_index=True)
+    oop["lis_status"] = pd.Categorical(oop["lis_status"], categories=[l for _, l in LIS_STATUS],
+                                       ordered=True)
+    return oop[["drugname_brand", "drugname_generic", "year", "lis_status", "oop_avg"]]
+
+
+def top_generics(spending, by, n):
+    """
+    Return the `n` generic drugs with the highest sum of column `by` over all
+    brands and years.
+    """
+    totals = spending.groupby("drugname_generic")[by].sum()
+    return totals.sort_values(ascending=False, kind="mergesort").index[:n]
+
+
+def top_by_year(spending_overall, n, metrics=("user_count", "total_spending")):
+    """
+    Rank the generic drugs within each year by each of `metrics` and keep the
+    top `n`. The result has one row per year, metric and rank.
+    """
+    tables = []
+    for metric in metrics:
+        df = spending_overall[["year", "drugname_generic", metric]]
+        df = df.sort_values(["year", metric], ascending=[True, False], kind="mergesort")
+        df = df.groupby("year").head(n).copy()
+        df["rank"] = df.groupby("year").cumcount() + 1
+        df["metric"] = metric
+        df = df.rename(columns={metric: "value"})
+        tables.append(df[["year", "metric", "rank", "drugname_generic", "value"]])
+    return pd.concat(tables, ignore_index=True)
+
+
+def class_totals(spending, drugnames):
+    """
+    Sum the spending per drug major class and year. Drugs associated with
+    several classes (`A|B` in `drugnames_withclasses`) count towards each.
+    """
+    classes = drugnames[["drugname_brand", "drugname_generic", "drug_major_class", "dmc_name"]]
+    classes = classes.assign(drug_major_class=classes["drug_major_class"].str.split("|"),
+                             dmc_name=classes["dmc_name"].str.split("|"))
+    classes = classes.explode(["drug_major_class", "dmc_name"])
+    df = spending.merge(classes, on=["drugname_brand", "drugname_generic"], how="inner")
+    totals = df.groupby(["drug_major_class", "dmc_name", "year"])[SUM_COLUMNS].sum()
+    totals = totals.reset_index()
+    totals["total_spending_per_user"] = totals["total_spending"] / totals["user_count"]
+    return totals
+
+
+def table_names(top_n=100, classes=True):
+    """
+    The names of the tables `materialize_serving_tables` writes, in order;
+    `class_totals` only if `classes` is True.
+    """
+    names = ["spending", "spending_overall"]
+    for label in ["byuser", "byspending"]:
+        name = "top%i_%s"%(top_n, label)
+        names += [name, name + "_oop", name + "_overall"]
+    names.append("top_by_year")
+    if classes:
+        names.append("class_totals")
+    return names
+
+
+def _write_table(df, out_dir, name, sort_by, manifest):
+    """
+    Sort `df`, write it to an uncompressed Feather (Arrow IPC) file, which
+    can be memory-mapped without copying, and add an entry to `manifest`.
+    """
+    df = df.sort_values(sort_by, kind="mergesort").reset_index(drop=True)
+    fname = name + ".feather"
+    paf.write_feather(pa.Table.from_pandas(df, preserve_index=False),
+                      os.path.join(out_dir, fname), compression="uncompressed")
+    manifest["tables"][name] = {"file": fname, "rows": len(df), "columns": list(df.columns),
+                                "sorted_by": list(sort_by)}
+    return
+
+
+def materialize_serving_tables(data_dir="../data/", out_dir=None, file_format="feather", top_n=100):
+    """
+    Precompute the tables for the dashboards from the output of `read_data.py`.
+
+    Parameters
+    ----------
+    data_dir : string, optional, default: "../data/"
+        The directory that contains the spending files (and optionally
+        `drugnames_withclasses`).
+
+    out_dir : string, optional, default: None
+        The directory to write the tables and manifest to. If None,
+        use `<data_dir>/serving/`.
+
+    file_format : string, optional, default: "feather"
+        The file format of the input files, "csv" or "feather". Output files
+        are always Feather.
+
+    top_n : int, optional, default: 100
+        The number of drugs in the top-N tables.
+
+    Returns
+    -------
+    manifest : dict
+        The contents of `manifest.json`
+    """
+    if out_dir is None:
+        out_dir = os.path.join(data_dir, SERVING_DIR)
+
+    try:
+        os.stat(out_dir)
+    except FileNotFoundError:
+        os.mkdir(out_dir)
+
+    spending = load_spending(data_dir, file_format)
+    # the serving tables are small, so store names as plain strings (sorted
+    # alphabetically) rather than as ids into the drug name dictionary
+    for col in ["drugname_brand", "drugname_generic"]:
+        spending[col] = spending[col].astype(object)
+    spending = add_generic_num(spending)
+    overall = spending_overall(spending)
+
+    manifest = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "years": sorted(int(y) for y in spending["year"].unique()),
+                "top_n": top_n, "tables": {}}
+
+    drug_keys = ["drugname_generic", "drugname_brand", "year"]
+    overall_keys = ["drugname_generic", "year"]
+
+    _write_table(spending, out_dir, "spending", drug_keys, manifest)
+    _write_table(overall, out_dir, "spending_overall", overall_keys, manifest)
+
+    for metric, label in [("user_count", "byuser"), ("total_spending", "byspending")]:
+        top = top_generics(spending, metric, top_n)
+        name = "top%i_%s"%(top_n, label)
+        top_spending = spending[spending["drugname_generic"].isin(top)]
+        _write_table(top_spending, out_dir, name, drug_keys, manifest)
+        _write_table(out_of_pocket_long(top_spending), out_dir, name + "_oop",
+                     drug_keys + ["lis_status"], manifest)
+        _write_table(overall[overall["drugname_generic"].isin(top)], out_dir, name + "_overall",
+                     overall_keys, manifest)
+
+    _write_table(top_by_year(overall, top_n), out_dir, "top_by_year",
+                 ["year", "metric", "rank"], manifest)
+
+    if _data_exists(data_dir, "drugnames_withclasses", file_format):
+        drugnames = _read_data(data_dir, "drugnames_withclasses", file_format)
+        _write_table(class_totals(spending, drugnames), out_dir, "class_totals",
+                     ["drug_major_class", "year"], manifest)
+
+    with open(os.path.join(out_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    return manifest
+
+
+# if script is called from the command, line, code below is executed.
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Precompute the tables served by the dashboards.")
+
+    parser.add_argument("-d", "--data-dir", action="store", required=False, default="../data/",
+                        dest="data_dir", help="Optional path to the data directory. Default: '../data/'")
+    parser.add_argument("-o", "--out-dir", action="store", required=False, default=None,
+                        dest="out_dir", help="Directory for the serving tables. " +
+                                             "Default: '<data-dir>/serving/'")
+    parser.add_argument("-f", "--file-format", action="store", required=False, default="feather",
+                        dest="file_format", help="File format of the input files. {'csv' | 'feather'}")
+    parser.add_argument("-n", "--top-n", action="store", type=int, required=False, default=100,
+                        dest="top_n", help="Number of drugs in the top-N tables. Default: 100")
+
+    clargs = parser.parse_args()
+
+    manifest = materialize_serving_tables(clargs.data_dir, out_dir=clargs.out_dir,
+                                          file_format=clargs.file_format, top_n=clargs.top_n)
+    print("Wrote %i tables."%len(manifest["tables"]))
@@ -0,0 +1,217 @@
+"""
+Stage-level timing and metrics for the data wrangling pipeline.
+
+The functions in `read_data.py` wrap each of their steps (download, unzip,
+parse, name matching, write, ...) in `stage` blocks, and report the files and
+rows they read and write with `record_read` and `record_write`. Nothing is
+recorded until `configure` is called (the `--metrics` and `--profile-dir`
+command line options of `read_data.py` do that), so the hooks cost next to
+nothing in normal use.
+
+For every stage, one JSON object is written per line to the metrics file:
+
+    {"stage": "download_partd.parse", "parent": "download_partd", "start": ...,
+     "wall_seconds": 12.3, "bytes_read": 5324800, "bytes_written": 0,
+     "rows_in": 4501, "rows_out": 0, "peak_rss_mb": 812.4, "rss_growth_mb": 640.1,
+     "status": "ok"}
+
+`bytes_*` and `rows_*` of a stage include those of its sub-stages. `peak_rss_mb`
+is the high-water mark of the process at the end of the stage, and
+`rss_growth_mb` is how much the stage raised it.
+"""
+import os # file sizes
+import sys # platform-dependent units of ru_maxrss
+import time # wall time
+import json # write metrics as JSON lines
+import resource # peak resident set size
+import cProfile # profile top-level stages
+from contextlib import contextmanager
+from functools import wraps
+
+
+# the active configuration; metrics are only recorded if `_config["enabled"]` is True
+_config = {"enabled": False, "metrics_file": None, "profile_dir": None, "profiler": "cprofile"}
+
+# the profilers that can be used for `profile_dir`, see `configure`
+PROFILERS = ["cprofile", "pyinstrument"]
+
+# stack of the stages that are currently running, innermost last
+_stack = []
+
+
+def configure(metrics_file=None, profile_dir=None, profiler="cprofile"):
+    """
+    Switch on metrics and/or profiling.
+
+    Parameters
+    ----------
+    metrics_file : string, optional, default: None
+        Append one JSON line per stage to this file. If "-", write to stdout.
+
+    profile_dir : string, optional, default: None
+        If given, profile every top-level stage and write the profile to
+        `<profile_dir>/<stage>.prof` (cProfile) or `<profile_dir>/<stage>.html`
+        (pyinstrument).
+
+    profiler : string, optional, default: "cprofile"
+        The profiler to use, "cprofile" or "pyinstrument" (requires the
+        `pyinstrument` package)
+    """
+    if profile_dir is not None:
+        try:
+            os.stat(profile_dir)
+        except FileNotFoundError:
+            os.makedirs(profile_dir)
+
+    if profiler not in PROFILERS:
+        raise ValueError("Profiler must be one of %s."%PROFILERS)
+
+    _config["metrics_file"] = metrics_file
+    _config["profile_dir"] = profile_dir
+    _config["profiler"] = profiler
+    _config["enabled"] = metrics_file is not None or profile_dir is not None
+    return
+
+
+def _max_rss_mb():
+    """
+    The peak resident set size of the process in megabytes.
+    """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == "darwin":
+        return maxrss / 1024.0**2
+    return maxrss / 1024.0
+
+
+def _emit(record):
+    if _config["metrics_file"] is None:
+        return
+    line = json.dumps(record) + "\n"
+    if _config["metrics_file"] == "-":
+        sys.stdout.write(line)
+    else:
+        with open(_config["metrics_file"], "a") as f:
+            f.write(line)
+    return
+
+
+def _start_profiler():
+    if _config["profiler"] == "pyinstrument":
+        # optional dependency, only needed if asked for
+        import pyinstrument
+        profiler = pyinstrument.Profiler()
+        profiler.start()
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    return profiler
+
+
+def _stop_profiler(profiler, name):
+    if _config["profiler"] == "pyinstrument":
+        profiler.stop()
+        with open(os.path.join(_config["profile_dir"], name + ".html"), "w") as f:
+            f.write(profiler.output_html())
+    else:
+        profiler.disable()
+        profiler.dump_stats(os.path.join(_config["profile_dir"], name + ".prof"))
+    return
+
+
+@contextmanager
+def stage(name):
+    """
+    Context manager that records the metrics of the code it wraps as stage
+    `name`. Stages can be nested; the name of a nested stage is prefixed
+    with the name of its parent, e.g. "download_partd.parse".
+    """
+    if not _config["enabled"]:
+        yield
+        return
+
+    parent = _stack[-1]["stage"] if len(_stack) > 0 else None
+    full_name = name if parent is None else parent + "." + name
+    record = {"stage": full_name, "parent": parent, "start": time.time(),
+              "bytes_read": 0, "bytes_written": 0, "rows_in": 0, "rows_out": 0}
+    _stack.append(record)
+
+    profiler = None
+    if _config["profile_dir"] is not None and parent is None:
+        profiler = _start_profiler()
+
+    rss_before = _max_rss_mb()
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        record["wall_seconds"] = time.perf_counter() - start
+        if profiler is not None:
+            _stop_profiler(profiler, full_name)
+        record["peak_rss_mb"] = _max_rss_mb()
+        record["rss_growth_mb"] = record["peak_rss_mb"] - rss_before
+        record["status"] = status
+        _stack.pop()
+
+        # counts of a sub-stage also count for its parent
+        if len(_stack) > 0:
+            for key in ["bytes_read", "bytes_written", "rows_in", "rows_out"]:
+                _stack[-1][key] += record[key]
+
+        _emit(record)
+
+
+def timed(name=None):
+    """
+    Decorator that runs the decorated function as a stage called `name`
+    (default: the name of the function).
+    """
+    def decorator(func):
+        stage_name = func.__name__ if name is None else name
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def record_read(path=None, rows=0, nbytes=None):
+    """
+    Add a read of `rows` rows from the file `path` (or of `nbytes` bytes)
+    to the current stage.
+    """
+    if not _config["enabled"] or len(_stack) == 0:
+        return
+    if nbytes is None:
+        nbytes = _file_size(path) if path is not None else 0
+    _stack[-1]["bytes_read"] += nbytes
+    _stack[-1]["rows_in"] += rows
+    return
+
+
+def record_write(path=None, rows=0, nbytes=None):
+    """
+    Add a write of `rows` rows to the file `path` (or of `nbytes` bytes)
+    to the current stage.
+    """
+    if not _config["enabled"] or len(_stack) == 0:
+        return
+    if nbytes is None:
+        nbytes = _file_size(path) if path is not None else 0
+    _stack[-1]["bytes_written"] += nbytes
+    _stack[-1]["rows_out"] += rows
+    return
@@ -0,0 +1,158 @@
+"""
+A global dictionary of drug names, shared by all artifacts in the data directory.
+
+Every normalized brand name, generic name, and name token used to match drugs
+against RxNorm gets an integer id: its position in the dictionary. The
+dictionary is append-only, so ids are stable across releases, and it is
+stored as `drugname_dictionary.feather` next to the data.
+
+Feather artifacts store their name columns as categoricals (Arrow dictionary
+columns) whose categories are the names the file uses, in dictionary order,
+so each name is stored once per file and `drugname_dictionary.feather` is
+the only full copy of all names. `ids` maps such a column to global ids by
+looking up only its categories, so joins between artifacts can compare
+integers rather than strings.
+"""
+import os # check whether the dictionary exists
+
+import numpy as np
+import pandas as pd
+
+
+# name of the dictionary file (without extension) in the data directory
+DICTIONARY_NAME = "drugname_dictionary"
+
+# name columns that are dictionary-encoded in the Part D artifacts
+NAME_COLUMNS = ["drugname_brand", "drugname_generic"]
+
+
+def normalize_names(names):
+    """
+    Normalize a Series of drug names the same way `read_data.download_partd`
+    does: strip whitespace and make them lowercase.
+    """
+    return names.astype(str).str.strip().str.lower()
+
+
+def name_tokens(name):
+    """
+    The tokens we try to find in RxNorm for a drug name: drugs with two names
+    are split by a slash, and anything after the first space (like "hcl" or
+    "er") is dropped, since it usually doesn't exist in the RxNorm table.
+    """
+    return [part.split(" ")[0] for part in name.split("/")]
+
+
+def load_dictionary(data_dir):
+    """
+    Load the dictionary from `data_dir`.
+
+    Returns
+    -------
+    dictionary : pd.Index
+        The names; the id of a name is its position. Empty if there is no
+        dictionary yet.
+    """
+    # imported here, so that CSV data directories don't need feather
+    import feather
+
+    path = data_dir + DICTIONARY_NAME + ".feather"
+    if not os.path.isfile(path):
+        return pd.Index([], dtype=object)
+    df = feather.read_dataframe(path)
+    return pd.Index(df["name"].values, dtype=object)
+
+
+def update_dictionary(data_dir, names):
+    """
+    Add the names in `names` that aren't in the dictionary yet to the end of
+    it, and write it back to `data_dir` if anything changed.
+
+    Parameters
+    ----------
+    data_dir : string
+        The data directory
+
+    names : iterable of strings
+        Normalized names
+
+    Returns
+    -------
+    dictionary : pd.Index
+        The updated dictionary
+    """
+    # imported here, see `load_dictionary`
+    import feather
+
+    dictionary = load_dictionary(data_dir)
+    names = local_dictionary(names)
+    new = names[dictionary.get_indexer(names) < 0]
+    if len(new) == 0:
+        return dictionary
+
+    dictionary = dictionary.append(pd.Index(new, dtype=object))
+    df = pd.DataFrame({"id": np.arange(len(dictionary), dtype=np.int32),
+                       "name": np.asarray(dictionary, dtype=object)})
+    feather.write_dataframe(df, data_dir + DICTIONARY_NAME + ".feather")
+    return dictionary
+
+
+def local_dictionary(names):
+    """
+    A dictionary of the unique names in `names`, in order of appearance, that
+    isn't stored anywhere; for looking up names in CSV data directories, which
+    have no global dictionary.
+    """
+    return pd.Index(pd.unique(pd.Series(list(names), dtype=object).dropna()), dtype=object)
+
+
+def all_names(drugnames):
+    """
+    All names (brand, generic, and their RxNorm tokens) in a drug names table.
+    """
+    names = []
+    for col in NAME_COLUMNS:
+        values = pd.unique(drugnames[col].astype(object))
+        names.extend(values)
+        for v in values:
+            names.extend(name_tokens(v))
+    return names
+
+
+def ids(values, dictionary):
+    """
+    Look up the ids of `values` in `dictionary`. For categorical input,
+    only the categories are looked up.
+
+    Returns
+    -------
+    ids : np.ndarray of int32
+        The ids; -1 for values that aren't in the dictionary
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        cat_ids = dictionary.get_indexer(values.cat.categories.astype(object))
+        codes = values.cat.codes.values
+        return np.where(codes >= 0, cat_ids[codes], -1).astype(np.int32)
+    return dictionary.get_indexer(values.astype(object)).astype(np.int32)
+
+
+def encode(values, dictionary):
+    """
+    Encode `values` as a categorical whose categories are the values that
+    occur in it, in the order of the dictionary. Values that aren't in the
+    dictionary become missing values.
+    """
+    value_ids = ids(values, dictionary)
+    used = np.unique(value_ids[value_ids >= 0])
+    codes = np.where(value_ids >= 0, np.searchsorted(used, value_ids), -1)
+    return pd.Categorical.from_codes(codes, categories=dictionary[used])
+
+
+def encode_names(df, dictionary, columns=NAME_COLUMNS):
+    """
+    Return a copy of `df` with the name columns in `columns` dictionary-encoded.
+    """
+    df = df.copy()
+    for col in columns:
+        df[col] = encode(df[col], dictionary)
+    return df
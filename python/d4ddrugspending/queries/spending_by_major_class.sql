@@ -0,0 +1,12 @@
+-- Total Part D spending per year and drug major class (see `make_drug_table`)
+SELECT d.drug_major_class,
+       d.dmc_name,
+       s.year,
+       sum(s.total_spending) AS total_spending,
+       sum(s.user_count) AS user_count
+FROM spending s
+JOIN drugnames_withclasses d
+  ON s.drugname_brand = d.drugname_brand
+ AND s.drugname_generic = d.drugname_generic
+GROUP BY d.drug_major_class, d.dmc_name, s.year
+ORDER BY d.drug_major_class, s.year;
@@ -0,0 +1,9 @@
+-- The 25 generic drugs with the highest total Part D spending in the most recent year
+SELECT drugname_generic,
+       sum(total_spending) AS total_spending,
+       sum(user_count) AS user_count
+FROM spending
+WHERE year = (SELECT max(year) FROM spending)
+GROUP BY drugname_generic
+ORDER BY total_spending DESC
+LIMIT 25;
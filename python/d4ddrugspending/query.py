@@ -0,0 +1,222 @@
+"""
+Embedded SQL query layer over the wrangled drug-spending data.
+
+Every artifact written by `read_data.py` (and the USP/ATC tables written by the
+scripts in `datawrangling/`) is registered as a view in an in-process DuckDB
+database. The views are backed by Arrow datasets on the files themselves, so
+DuckDB only reads the columns and row groups a query needs instead of loading
+whole tables into pandas first.
+
+Views
+-----
+* `drugnames`, `drugnames_withclasses`, `puf`, `rxnorm`, `drug_major_class`,
+  `drug_class`: one view per file of the same name
+* `spending_<year>`: one view per `spending-<year>` file
+* `spending`: all years stacked, with an extra `year` column
+* `usp_drug_classification`, `atc_codes`: if the CSV files exist in `data_dir`
+
+Example
+-------
+>>> from query import query
+>>> query("SELECT year, sum(total_spending) FROM spending GROUP BY year ORDER BY year")
+
+From the command line, saved queries (`.sql` files in `queries/`) can be run by name:
+
+    python query.py run top_spending
+"""
+import os # find data files and saved queries
+import argparse # argument parsing for command line options
+
+import duckdb
+import pyarrow.csv as pacsv
+import pyarrow.dataset as ds
+
+from read_data import OptionUndefinedError, spending_years
+
+
+# artifacts written by `read_data.py` that map one-to-one onto a view
+ARTIFACTS = ["drugnames", "drugnames_withclasses", "puf", "rxnorm",
+             "drug_major_class", "drug_class"]
+
+# comma-separated tables written by the scripts in `datawrangling/`
+EXTERNAL_TABLES = {"usp_drug_classification": "usp_drug_classification.csv",
+                   "atc_codes": "atc-codes.csv"}
+
+# directory with saved queries for the command line interface
+QUERY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "queries")
+
+# connections, cached by data directory and file format
+_connections = {}
+
+
+def _dataset(path, file_format):
+    """
+    Open a file as an Arrow dataset without reading it. CSV files written by
+    `read_data.py` are tab-separated and have a `#` in front of the first
+    column name, which we strip here.
+    """
+    if file_format == "feather":
+        return ds.dataset(path, format="feather")
+    elif file_format == "csv":
+        with open(path, "r") as f:
+            header = f.readline().rstrip("\n")
+        names = [h.strip("#") for h in header.split("\t")]
+        fmt = ds.CsvFileFormat(parse_options=pacsv.ParseOptions(delimiter="\t"),
+                               read_options=pacsv.ReadOptions(column_names=names, skip_rows=1))
+        return ds.dataset(path, format=fmt)
+    else:
+        raise OptionUndefinedError()
+
+
+def connect(data_dir="../data/", file_format="feather"):
+    """
+    Make a DuckDB connection with views for all artifacts found in `data_dir`.
+    Connections are cached, so repeated calls with the same arguments are cheap;
+    files written after the first call aren't picked up unless `refresh` is
+    called first.
+
+    Parameters
+    ----------
+    data_dir : string, optional, default: "../data/"
+        The directory that contains the data.
+
+    file_format : string, optional, default: "feather"
+        The file format of the artifacts, "csv" or "feather".
+
+    Returns
+    -------
+    con : duckdb.DuckDBPyConnection
+        The connection
+    """
+    key = (os.path.abspath(data_dir), file_format)
+    if key in _connections:
+        return _connections[key]
+
+    con = duckdb.connect(":memory:")
+
+    for name in ARTIFACTS:
+        path = os.path.join(data_dir, name + "." + file_format)
+        if os.path.isfile(path):
+            con.register(name, _dataset(path, file_format))
+
+    years = spending_years(data_dir, file_format)
+    for year in years:
+        path = os.path.join(data_dir, "spending-%i.%s"%(year, file_format))
+        con.register("spending_%i"%year, _dataset(path, file_format))
+    if len(years) > 0:
+        union = " UNION ALL BY NAME ".join("SELECT *, %i AS year FROM spending_%i"%(year, year)
+                                           for year in years)
+        con.execute("CREATE VIEW spending AS " + union)
+
+    for name, fname in EXTERNAL_TABLES.items():
+        path = os.path.join(data_dir, fname)
+        if os.path.isfile(path):
+            con.register(name, ds.dataset(path, format="csv"))
+
+    _connections[key] = con
+    return con
+
+
+def refresh(data_dir="../data/", file_format="feather"):
+    """
+    Drop the cached connection for `data_dir`, so that the next query sees
+    files that were added or rewritten since.
+    """
+    con = _connections.pop((os.path.abspath(data_dir), file_format), None)
+    if con is not None:
+        con.close()
+    return
+
+
+def query(sql, data_dir="../data/", file_format="feather", output="pandas"):
+    """
+    Run a SQL query against the views over the artifacts in `data_dir`.
+
+    Parameters
+    ----------
+    sql : string
+        The query
+
+    data_dir : string, optional, default: "../data/"
+        The directory that contains the data.
+
+    file_format : string, optional, default: "feather"
+        The file format of the artifacts, "csv" or "feather".
+
+    output : string, optional, default: "pandas"
+        "pandas" to return a pandas DataFrame, "arrow" to return a pyarrow Table
+
+    Returns
+    -------
+    result : pd.DataFrame or pyarrow.Table
+        The query result
+    """
+    res = connect(data_dir, file_format).execute(sql)
+    if output == "pandas":
+        return res.df()
+    elif output == "arrow":
+        return res.fetch_arrow_table()
+    else:
+        raise OptionUndefinedError()
+
+
+def saved_queries(query_dir=QUERY_DIR):
+    """
+    List the names of the saved queries (`.sql` files) in `query_dir`.
+    """
+    return sorted(os.path.splitext(f)[0] for f in os.listdir(query_dir) if f.endswith(".sql"))
+
+
+def run_saved_query(name, data_dir="../data/", file_format="feather", output="pandas",
+                    query_dir=QUERY_DIR):
+    """
+    Run a saved query, given either by its name in `query_dir` or by the path
+    to a `.sql` file.
+    """
+    path = name if os.path.isfile(name) else os.path.join(query_dir, name + ".sql")
+    with open(path, "r") as f:
+        sql = f.read()
+    return query(sql, data_dir=data_dir, file_format=file_format, output=output)
+
+
+# if script is called from the command, line, code below is executed.
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Run SQL queries against the drug spending data.")
+
+    parser.add_argument("-d", "--data-dir", action="store", required=False, default="../data/",
+                        dest="data_dir", help="Optional path to the data directory. Default: '../data/'")
+    parser.add_argument("-f", "--file-format", action="store", required=False, default="feather",
+                        dest="file_format", help="File format of the data files. {'csv' | 'feather'}")
+    parser.add_argument("-o", "--output", action="store", required=False, default=None,
+                        dest="output", help="Optional CSV file to write the result to.")
+
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser("run", help="Run a saved query.")
+    run_parser.add_argument("name", help="Name of a query in %s, or path to a .sql file."%QUERY_DIR)
+
+    sql_parser = subparsers.add_parser("sql", help="Run a SQL statement.")
+    sql_parser.add_argument("sql", help="The SQL statement.")
+
+    subparsers.add_parser("list", help="List the saved queries.")
+    subparsers.add_parser("views", help="List the views over the data files.")
+
+    clargs = parser.parse_args()
+
+    if clargs.command == "list":
+        print("\n".join(saved_queries()))
+    elif clargs.command == "views":
+        print(query("SHOW TABLES", data_dir=clargs.data_dir, file_format=clargs.file_format))
+    else:
+        if clargs.command == "run":
+            result = run_saved_query(clargs.name, data_dir=clargs.data_dir,
+                                     file_format=clargs.file_format)
+        else:
+            result = query(clargs.sql, data_dir=clargs.data_dir, file_format=clargs.file_format)
+
+        if clargs.output is None:
+            print(result.to_string())
+        else:
+            result.to_csv(clargs.output, index=False)
@@ -1,18 +1,161 @@
-import requests # to download the dataset
 import zipfile # to extract from archive
 import shutil # to write the dataset to file
 import os # rename file to something more type-able
+import sys # command line arguments
 import argparse # argument parsing for command line options
+import importlib # lazy imports
+import re # normalize column headers
+from collections import OrderedDict
 
-import pandas as pd
-import numpy as np
+import metrics # stage timing and metrics, see `metrics.configure`
+
+
+class _LazyModule(object):
+    """
+    Stand-in for a module that is only imported when one of its attributes
+    is first used. This keeps `import read_data` and the command line
+    (e.g. `--help`) fast, because pandas, numpy, feather and requests are
+    only imported once a stage actually needs them.
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+requests = _LazyModule("requests") # to download the dataset
+pd = _LazyModule("pandas")
+np = _LazyModule("numpy")
+feather = _LazyModule("feather")
 
-import feather
 
 # custom exception for undefined option
 class OptionUndefinedError(Exception):
-    def __init__(self, expression):
+    def __init__(self, expression=None):
         print("Option for output file format not recognized!")
+        Exception.__init__(self, expression)
+
+
+# custom exception for a Part D workbook that doesn't match its registered schema
+class SchemaMismatchError(Exception):
+    pass
+
+
+# Header names (normalized, see `_partd_header_key`) of the metric columns that
+# are repeated for every year in the Part D workbook, and the generic column
+# names we store them under.
+PARTD_METRIC_COLUMNS = OrderedDict([
+    ("claim count", "claim_count"),
+    ("total spending", "total_spending"),
+    ("beneficiary count", "user_count"),
+    ("total annual spending per user", "total_spending_per_user"),
+    ("unit count", "unit_count"),
+    ("average cost per unit (weighted)", "unit_cost_wavg"),
+    ("beneficiary count no lis", "user_count_non_lowincome"),
+    ("average beneficiary cost share no lis", "out_of_pocket_avg_non_lowincome"),
+    ("beneficiary count lis", "user_count_lowincome"),
+    ("average beneficiary cost share lis", "out_of_pocket_avg_lowincome"),
+])
+
+# Registry of CMS Part D releases, keyed by the release year. To ingest a
+# new release, add an entry here; the year column groups are located by
+# their header names, so no column offsets are needed.
+PARTD_RELEASES = {
+    2015: {
+        "url": "https://www.cms.gov/Research-Statistics-Data-and-Systems/" +
+               "Statistics-Trends-and-Reports/Information-on-Prescription-Drugs/" +
+               "Downloads/Part_D_All_Drugs_2015.zip",
+        "workbook": "Medicare_Drug_Spending_PartD_All_Drugs_YTD_2015_12_06_2016.xlsx",
+        "sheet": "Data",
+        "skiprows": 3,
+        "years": [2011, 2012, 2013, 2014, 2015],
+        "name_headers": ["brand name", "generic name"],
+        "metric_headers": list(PARTD_METRIC_COLUMNS.keys()),
+    },
+}
+
+# URLs for the CMS prescription drug profiles, the RxNorm data and the drug class tables
+PUF_URL = "https://www.cms.gov/Research-Statistics-Data-and-Systems/" + \
+          "Statistics-Trends-and-Reports/BSAPUFS/Downloads/2010_PD_Profiles_PUF.zip"
+RXNORM_URL = "https://download.nlm.nih.gov/rxnorm/RxNorm_full_prescribe_01032017.zip"
+DRUG_CLASSES_URL = "https://www.cms.gov/Research-Statistics-Data-and-Systems/" + \
+                   "Statistics-Trends-and-Reports/BSAPUFS/Downloads/2010_PD_Profiles_PUF_DUG.zip"
+
+
+def _data_exists(data_dir, name, file_format="feather"):
+    """
+    Check whether the data set `name` exists in `data_dir` in format `file_format`.
+    """
+    return os.path.isfile(data_dir + name + "." + file_format)
+
+
+def _read_data(data_dir, name, file_format="feather"):
+    """
+    Read the data set `name` (without file extension) from `data_dir`.
+    CSV files are expected to be in the format written by `_write_data`.
+    """
+    with metrics.stage("read"):
+        if file_format == "feather":
+            df = feather.read_dataframe(data_dir + name + ".feather")
+        elif file_format == "csv":
+            df = pd.read_csv(data_dir + name + ".csv", sep="\t", header=0)
+            df.columns = df.columns.str.strip("#")
+        else:
+            raise OptionUndefinedError()
+
+        metrics.record_read(data_dir + name + "." + file_format, rows=len(df))
+
+    return df
+
+
+def _check_data(artifacts):
+    """
+    Run the checks in `validate.py` on `artifacts`, an OrderedDict from the
+    names of data sets to DataFrames, and raise a `validate.ValidationError`
+    for the first one that fails. Stages that write several data sets check
+    all of them before writing any, so that a stage that fails a check
+    leaves the data directory as it was.
+    """
+    with metrics.stage("validate"):
+        # imported here, so that the command line doesn't need pandas at startup
+        import validate
+        for name, df in artifacts.items():
+            validate.check(df, name)
+    return
+
+
+def _write_data(df, data_dir, name, output_format="feather", check=True):
+    """
+    Write the DataFrame `df` to the data set `name` (without file extension)
+    in `data_dir`, in format `output_format`. Unless `check=False` (because
+    `_check_data` already ran on it), the data is checked first, and nothing
+    is written if it fails a check.
+    """
+    if check:
+        _check_data(OrderedDict([(name, df)]))
+
+    with metrics.stage("write"):
+        if output_format == "csv":
+            # get all the column names for the file header
+            hdr = list(df.columns)
+            # add a `#` to the first element of the list so header 
+            # won't be confused for data
+            hdr[0] = "#" + hdr[0]
+            df.to_csv(data_dir + name + ".csv", sep="\t", header=hdr, index=False)
+        elif output_format == "feather":
+            # write the results to a feather file:
+            feather.write_dataframe(df, data_dir + name + ".feather")
+        else:
+            raise OptionUndefinedError()
+
+        metrics.record_write(data_dir + name + "." + output_format, rows=len(df))
+
+    return
+
 
 
 def _download_data(url, data_dir="../data/", data_name="dataset", zipped_data=False):
@@ -39,27 +182,193 @@ def _download_data(url, data_dir="../data/", data_name="dataset", zipped_data=Fa
     except FileNotFoundError:
         os.mkdir(data_dir)
 
-    # open a connection to the URL
-    response = requests.get(url, stream=True)
+    with metrics.stage("download"):
+        # open a connection to the URL
+        response = requests.get(url, stream=True)
 
-    # store file to disk
-    with open(data_dir + data_name, 'wb') as ds_zipout:
-        shutil.copyfileobj(response.raw, ds_zipout)
+        # store file to disk
+        with open(data_dir + data_name, 'wb') as ds_zipout:
+            shutil.copyfileobj(response.raw, ds_zipout)
+
+        metrics.record_write(data_dir + data_name)
 
     # if it's a zip file, then unzip:   
     if zipped_data:
-        zip = zipfile.ZipFile(data_dir + data_name, 'r')
+        with metrics.stage("unzip"):
+            zip = zipfile.ZipFile(data_dir + data_name, 'r')
+            metrics.record_read(data_dir + data_name)
 
-        # get list of file names in zip file:
-        ds_filenames = zip.namelist()
-        # loop through file names and extract each
-        for f in ds_filenames:
-            zip.extract(f, path=data_dir)
+            # get list of file names in zip file:
+            ds_filenames = zip.namelist()
+            # loop through file names and extract each
+            for f in ds_filenames:
+                zip.extract(f, path=data_dir)
+                metrics.record_write(nbytes=zip.getinfo(f).file_size)
 
     return 
 
 
-def download_partd(data_dir="../data/", output_format="feather"):
+def _partd_header_key(header):
+    """
+    Normalize a column header from the Part D workbook so that it can be
+    matched against the header names in `PARTD_RELEASES`: strip the `.1`, `.2`
+    suffixes pandas adds to duplicate column names, collapse whitespace
+    (including line breaks inside Excel cells) and make it lowercase.
+    """
+    header = re.sub(r"\.\d+$", "", str(header))
+    return " ".join(header.split()).lower()
+
+
+def _partd_release(release=None):
+    """
+    Look up a CMS Part D release in `PARTD_RELEASES`.
+
+    Parameters
+    ----------
+    release : int, optional, default: None
+        The release; if None, the most recent one
+
+    Returns
+    -------
+    release : int
+        The release
+    schema : dict
+        Its entry in `PARTD_RELEASES`
+
+    Raises
+    ------
+    ValueError
+        If there is no such release.
+    """
+    if release is None:
+        release = max(PARTD_RELEASES)
+    if release not in PARTD_RELEASES:
+        raise ValueError("Unknown Part D release %s, must be one of %s."%(release,
+                                                                         sorted(PARTD_RELEASES)))
+    return release, PARTD_RELEASES[release]
+
+
+def _partd_column_groups(columns, release):
+    """
+    Locate the columns with drug names and the per-year column groups in
+    the Part D workbook using the header names registered for `release`.
+
+    Every occurrence of the first metric header (e.g. "Claim Count") starts
+    a new year group; groups are assigned to the years in the release schema
+    in the order in which they appear in the workbook. Columns whose header
+    isn't registered (like 2015's "Annual Change in Average Cost Per Unit")
+    are ignored.
+
+    Parameters
+    ----------
+    columns : iterable of strings
+        The column headers as parsed from the workbook
+
+    release : dict
+        The entry in `PARTD_RELEASES` describing the workbook
+
+    Returns
+    -------
+    name_cols : list of int
+        The positions of the brand and generic name columns
+
+    groups : list of (int, list of int) tuples
+        For each year, the positions of the columns in the same order as
+        `PARTD_METRIC_COLUMNS`
+    """
+    keys = [_partd_header_key(c) for c in columns]
+
+    name_cols = []
+    for header in release["name_headers"]:
+        if header not in keys:
+            raise SchemaMismatchError("Column '%s' not found in Part D workbook."%header)
+        name_cols.append(keys.index(header))
+
+    metric_headers = release["metric_headers"]
+    first_metric = metric_headers[0]
+
+    positions = []
+    for i, k in enumerate(keys):
+        if i in name_cols:
+            continue
+        if k == first_metric:
+            positions.append({})
+        if k in metric_headers and len(positions) > 0:
+            positions[-1].setdefault(k, i)
+
+    if len(positions) != len(release["years"]):
+        raise SchemaMismatchError("Found %i year column groups in Part D workbook, "%len(positions) +
+                                  "but the schema lists %i years."%len(release["years"]))
+
+    groups = []
+    for year, pos in zip(release["years"], positions):
+        missing = [h for h in metric_headers if h not in pos]
+        if len(missing) > 0:
+            raise SchemaMismatchError("Columns %s missing for year %i."%(missing, year))
+        groups.append((year, [pos[h] for h in metric_headers]))
+
+    return name_cols, groups
+
+
+def _partd_year_tables(partd, drugnames, groups, years):
+    """
+    Reshape the wide Part D workbook into one table per year.
+
+    The metric columns of all years are converted to a single float array of
+    shape (drug, year * metric) and reshaped to (drug, year, metric) without
+    copying, so the wide frame is copied once instead of once per year (plus
+    once per column for the numeric casts). Each year's table is then a
+    selection of the rows of `drugnames` and of that year's slice of the array.
+
+    Parameters
+    ----------
+    partd : pd.DataFrame
+        The workbook as parsed by pandas
+
+    drugnames : pd.DataFrame
+        The normalized brand and generic names, one row per row of `partd`
+
+    groups : list of (int, list of int) tuples
+        The column positions for each year, from `_partd_column_groups`
+
+    years : list of int
+        The years to make tables for
+
+    Returns
+    -------
+    partd_years : dict of pd.DataFrame
+        The table for each year, without the rows that have no data at all
+    """
+    groups = [(year, cols) for year, cols in groups if year in years]
+    metric_columns = list(PARTD_METRIC_COLUMNS.values())
+
+    # Cast all metric columns to floats at once (like `pd.to_numeric`, values
+    # that aren't numbers raise an error)
+    block = partd.iloc[:, [c for _, cols in groups for c in cols]]
+    if not all(pd.api.types.is_numeric_dtype(dtype) for dtype in block.dtypes):
+        block = block.apply(pd.to_numeric)
+    values = block.to_numpy(dtype=np.float64)
+    del block
+    values = values.reshape(len(partd), len(groups), len(metric_columns))
+
+    # Drop any rows in each year that have absolutely no data
+    nonnull_rows = ~np.isnan(values).all(axis=2)
+
+    partd_years = {}
+    for k, (year, _) in enumerate(groups):
+        rows = nonnull_rows[:, k]
+        df = drugnames[rows].reset_index(drop=True)
+        # columns are easier to type and more generic w.r.t. year
+        for j, col in enumerate(metric_columns):
+            df[col] = values[rows, k, j]
+        df.index = np.arange(1, len(df) + 1)
+        partd_years[year] = df
+
+    return partd_years
+
+
+@metrics.timed()
+def download_partd(data_dir="../data/", output_format="feather", release=None, overwrite=False):
     """
     Download the Medicare Part D expenditure data from the CMS website.
     This function will dowload the data, load the original Excel file into 
@@ -69,6 +378,12 @@ def download_partd(data_dir="../data/", output_format="feather"):
     as one file per year with the actual data. The file type of the output files 
     is determined by the `output_format` keyword argument.
 
+    The layout of each CMS release is described by an entry in `PARTD_RELEASES`.
+    Years that already have a spending file in `data_dir` are not re-processed
+    unless `overwrite=True`, so ingesting a new release only appends the new
+    years to the spending store; drug names new to the release are appended
+    to the existing drug names file.
+
     Parameters
     ----------
     data_dir : string
@@ -79,27 +394,42 @@ def download_partd(data_dir="../data/", output_format="feather"):
             * "cvs": return comma-separated values in a simple ASCII file
             * "feather": return a `.feather` file (required `feather` Python package!)
 
+    release : int, optional, default: None
+       The CMS release to ingest, a key in `PARTD_RELEASES`. If None, use the
+       most recent release.
+
+    overwrite : bool, optional, default: False
+       If True, re-process and overwrite years that already exist in `data_dir`.
+
     """
+    release, schema = _partd_release(release)
 
+    # figure out which years we still need to process
+    years = [year for year in schema["years"]
+             if overwrite or not _data_exists(data_dir, "spending-" + str(year), output_format)]
+    if len(years) == 0:
+        print("All years in the %i Part D release already exist, nothing to do."%release)
+        return
 
-    # URL for the CMS Part D data 
-    url = 'https://www.cms.gov/Research-Statistics-Data-and-Systems/'+ \
-          'Statistics-Trends-and-Reports/Information-on-Prescription-Drugs/'+ \
-          'Downloads/Part_D_All_Drugs_2015.zip'
-   
     # download data from CMS:
-    _download_data(url, data_dir=data_dir, data_name="part_d.zip", zipped_data=True)
+    _download_data(schema["url"], data_dir=data_dir, data_name="part_d_%i.zip"%release,
+                   zipped_data=True)
      
     # data is in a form of an Excel sheet (because of course it is)
     # we need to make sure we read the right work sheet (i.e. the one with the data):
-    xls = pd.ExcelFile(data_dir + "Medicare_Drug_Spending_PartD_All_Drugs_YTD_2015_12_06_2016.xlsx")
-    partd = xls.parse('Data', skiprows=3)
-    partd.index = np.arange(1, len(partd) + 1)
+    with metrics.stage("parse"):
+        xls = pd.ExcelFile(data_dir + schema["workbook"])
+        partd = xls.parse(schema["sheet"], skiprows=schema["skiprows"])
+        partd.index = np.arange(1, len(partd) + 1)
+        metrics.record_read(data_dir + schema["workbook"], rows=len(partd))
+
+    # find the name columns and the column group for each year by their headers
+    name_cols, groups = _partd_column_groups(partd.columns, schema)
 
     # First part: get out the drug names (generic + brand) and store them to a file
 
     # Capture only the drug names (we'll need this later)
-    partd_drugnames = partd.iloc[:, :2]
+    partd_drugnames = partd.iloc[:, name_cols]
     partd_drugnames.columns = ['drugname_brand', 'drugname_generic']
 
     # Strip extraneous whitespace from drug names
@@ -110,97 +440,43 @@ def download_partd(data_dir="../data/", output_format="feather"):
     partd_drugnames["drugname_generic"] = partd_drugnames["drugname_generic"].str.lower()
     partd_drugnames["drugname_brand"] = partd_drugnames["drugname_brand"].str.lower()
 
+    # if we already hold drug names from an earlier release, only append
+    # the ones that are new in this release
+    all_drugnames = partd_drugnames
+    if _data_exists(data_dir, "drugnames", output_format):
+        old_drugnames = _read_data(data_dir, "drugnames", output_format)
+        all_drugnames = pd.concat([old_drugnames, partd_drugnames], ignore_index=True)
+        all_drugnames = all_drugnames.drop_duplicates(["drugname_brand", "drugname_generic"])
+        all_drugnames.index = np.arange(len(all_drugnames))
 
-    if output_format == "csv":
-        # get all the column names for the file header
-        hdr = list(partd_drugnames.columns)
-        # add a `#` to the first element of the list so header 
-        # won't be confused for data
-        hdr[0] = "#" + hdr[0]
-        partd_drugnames.to_csv(data_dir + "drugnames.csv", sep="\t", header=hdr,
-                               index=False) 
-    elif output_format == "feather":
-        # write the results to a feather file:
-        feather.write_dataframe(partd_drugnames, data_dir + 'drugnames.feather')
-    else:
-        raise OptionUndefinedError()
-
-    # Separate column groups by year
-    cols_by_year = [
-        { 'year': 2011, 'start': 2, 'end': 12 },
-        { 'year': 2012, 'start': 12, 'end': 22 },
-        { 'year': 2013, 'start': 22, 'end': 32 },
-        { 'year': 2014, 'start': 32, 'end': 42 },
-        { 'year': 2015, 'start': 42, 'end': 53 },
-    ]
-
-    partd_years = {}
-
-    col_brandname = 0
-    col_genericname = 1
-    for cols in cols_by_year:
-        year, start, end = cols['year'], cols['start'], cols['end']
-
-        partd_years[year] = pd.concat([partd_drugnames,
-                                       partd.iloc[:, start:end]],
-                                      axis=1)
-
-    # Remove 2015's extra column for "Annual Change in Average Cost Per Unit" (we can calculate it, anyhow)
-    partd_years[2015] = partd_years[2015].drop(partd_years[2015].columns[-1], axis=1)
-
-    # Drop any rows in each year that have absolutely no data, then reset their row indices
-    for year in partd_years:
-        nonnull_rows = partd_years[year].iloc[:, 2:].apply(lambda x: x.notnull().any(), axis=1)
-        partd_years[year] = partd_years[year][nonnull_rows]
-        partd_years[year].index = np.arange(1, len(partd_years[year]) + 1) 
-
-    # Make columns easier to type and more generic w.r.t. year
-    generic_columns = [
-        "drugname_brand",
-        "drugname_generic",
-        "claim_count",
-        "total_spending",
-        "user_count",
-        "total_spending_per_user",
-        "unit_count",
-        "unit_cost_wavg",
-        "user_count_non_lowincome",
-        "out_of_pocket_avg_non_lowincome",
-        "user_count_lowincome",
-        "out_of_pocket_avg_lowincome"
-    ]
+    with metrics.stage("reshape"):
+        partd_years = _partd_year_tables(partd, partd_drugnames, groups, years)
 
+    # one file (partition) per year
+    artifacts = OrderedDict([("drugnames", all_drugnames)])
     for year in partd_years:
-        partd_years[year].columns = generic_columns
+        artifacts["spending-" + str(year)] = partd_years[year]
 
-    # Cast all column data to appropriate numeric types
+    # check all files before writing any of them or extending the drug name
+    # dictionary, so that a release that fails a check changes nothing
+    _check_data(artifacts)
 
-    # Suppress SettingWithCopyWarnings because I think it's
-    # tripping on the fact that we have a dict of DataFrames
-    pd.options.mode.chained_assignment = None
-    for year in partd_years:
-        # Ignore the first two columns, which are strings and contain drug names
-        for col in partd_years[year].columns[2:]:
-            partd_years[year].loc[:, col] = pd.to_numeric(partd_years[year][col])
-    pd.options.mode.chained_assignment = 'warn'
+    # feather files store the drug names as ids into the global drug name
+    # dictionary (see `namedict.py`), which we extend with the new names here;
+    # each file is encoded separately, so that it only holds the names it uses
+    if output_format == "feather":
+        # imported here, so that the command line doesn't need pandas at startup
+        import namedict
+        dictionary = namedict.update_dictionary(data_dir, namedict.all_names(all_drugnames))
+        for name in artifacts:
+            artifacts[name] = namedict.encode_names(artifacts[name], dictionary)
 
-
-    if output_format == "csv":
-        for year in partd_years:
-            hdr = list(partd_years[year].columns)
-            hdr[0] = "#" + hdr[0]
-            partd_years[year].to_csv(data_dir + "spending-" + str(year) + ".csv", sep="\t", header=hdr,      
-                                     index=False)
-    elif output_format == "feather":
-        # Serialize data for each year to feather file for use in both Python and R
-        for year in partd_years:
-            feather.write_dataframe(partd_years[year], data_dir + 'spending-' + str(year) + '.feather')
-
-    else:
-        raise OptionUndefinedError()
+    for name in artifacts:
+        _write_data(artifacts[name], data_dir, name, output_format, check=False)
 
     return
 
+@metrics.timed()
 def download_puf(data_dir="../data/", all_columns=True , output_format="feather"):
     """
     Download the CMS prescription drug profiles.
@@ -226,15 +502,13 @@ def download_puf(data_dir="../data/", all_columns=True , output_format="feather"
             * "feather": return a `.feather` file (required `feather` Python package!)
         
     """
-    url = "https://www.cms.gov/Research-Statistics-Data-and-Systems/"+\
-          "Statistics-Trends-and-Reports/BSAPUFS/Downloads/2010_PD_Profiles_PUF.zip"
-
-    
     # download data from CMS:
-    _download_data(url, data_dir=data_dir, data_name="puf.zip", zipped_data=True)
+    _download_data(PUF_URL, data_dir=data_dir, data_name="puf.zip", zipped_data=True)
 
     # read CSV into DataFrame
-    puf = pd.read_csv(data_dir + "2010_PD_Profiles_PUF.csv")
+    with metrics.stage("parse"):
+        puf = pd.read_csv(data_dir + "2010_PD_Profiles_PUF.csv")
+        metrics.record_read(data_dir + "2010_PD_Profiles_PUF.csv", rows=len(puf))
 
     # if we don't want to save all columns, drop those except for the three columns 
     # we're interested in.
@@ -245,22 +519,11 @@ def download_puf(data_dir="../data/", all_columns=True , output_format="feather"
                  "AVE_DAYS_SUPPLY", "AVE_TOT_DRUG_COST", "AVE_PTNT_PAY_AMT",
                  "PDE_CNT", "BENE_CNT_CAT"], axis=1, inplace=True)
 
-    if output_format == "csv":
-        # get all the column names for the file header
-        hdr = list(puf.columns)
-        # add a `#` to the first element of the list so header 
-        # won't be confused for data
-        hdr[0] = "#" + hdr[0]
-        puf.to_csv(data_dir + "puf.csv", sep="\t", header=hdr,
-                               index=False)
-    elif output_format == "feather":
-        # write the results to a feather file:
-        feather.write_dataframe(puf, data_dir + 'puf.feather')
-    else:
-        raise OptionUndefinedError()
+    _write_data(puf, data_dir, "puf", output_format)
 
     return 
 
+@metrics.timed()
 def download_rxnorm(data_dir="../data/", output_format="feather"):
     """
     Download RxNorm data for *currently prescribable* drugs. The RxNorm data 
@@ -281,11 +544,8 @@ def download_rxnorm(data_dir="../data/", output_format="feather"):
             * "feather": return a `.feather` file (required `feather` Python package!)
 
     """
-    # URL to the data file
-    url = "https://download.nlm.nih.gov/rxnorm/RxNorm_full_prescribe_01032017.zip"
-
     # download data from NIH:
-    _download_data(url, data_dir=data_dir, data_name="rxnorm.zip", zipped_data=True)
+    _download_data(RXNORM_URL, data_dir=data_dir, data_name="rxnorm.zip", zipped_data=True)
 
 
     # Column names as copied from the NIH website
@@ -293,28 +553,24 @@ def download_rxnorm(data_dir="../data/", output_format="feather"):
          "SAUI", "SCUI", "SDUI", "SAB", "TTY", "CODE", "STR", "SRL", "SUPPRESS", "CVF"]
 
     # we only want column 0 (the RXCUI identifier) and 14 (the commonly used name)
-    rxnorm = pd.read_csv(data_dir + "rrf/RXNCONSO.RRF", sep="|", names=names, index_col=False,
-                         usecols=[0,14])
+    with metrics.stage("parse"):
+        rxnorm = pd.read_csv(data_dir + "rrf/RXNCONSO.RRF", sep="|", names=names, index_col=False,
+                             usecols=[0,14])
+        metrics.record_read(data_dir + "rrf/RXNCONSO.RRF", rows=len(rxnorm))
  
     # make all strings lowercase
     rxnorm["STR"] = rxnorm["STR"].str.lower()
 
-    if output_format == "csv":
-        # get all the column names for the file header
-        hdr = list(rxnorm.columns)
-        # add a `#` to the first element of the list so header 
-        # won't be confused for data
-        hdr[0] = "#" + hdr[0]
-        rxnorm.to_csv(data_dir + "rxnorm.csv", sep="\t", header=hdr,
-                               index=False)
-    elif output_format == "feather":
-        # write the results to a feather file:
-        feather.write_dataframe(rxnorm, data_dir + 'rxnorm.feather')
-    else:
-        raise OptionUndefinedError()
+    # the same names appear many times, so store them as a categorical
+    # (an Arrow dictionary column in feather files)
+    if output_format == "feather":
+        rxnorm["STR"] = rxnorm["STR"].astype("category")
+
+    _write_data(rxnorm, data_dir, "rxnorm", output_format)
 
     return
 
+@metrics.timed()
 def download_drug_class_ids(data_dir="../data/", output_format="feather"):
     """
     Download the table associating major and minor classes with alphanumeric codes.
@@ -332,45 +588,86 @@ def download_drug_class_ids(data_dir="../data/", output_format="feather"):
             * "feather": return a `.feather` file (required `feather` Python package!)
     """
 
-    url = "https://www.cms.gov/Research-Statistics-Data-and-Systems/" + \
-          "Statistics-Trends-and-Reports/BSAPUFS/Downloads/2010_PD_Profiles_PUF_DUG.zip"
-    
     # download data from CMS:
-    _download_data(url, data_dir=data_dir, data_name="drug_classes_dataset.zip", zipped_data=True)
+    _download_data(DRUG_CLASSES_URL, data_dir=data_dir, data_name="drug_classes_dataset.zip", zipped_data=True)
 
-    # read drug major classes
-    drug_major_class = pd.read_csv(data_dir+"DRUG_MAJOR_CLASS_TABLE.csv")
+    with metrics.stage("parse"):
+        # read drug major classes
+        drug_major_class = pd.read_csv(data_dir+"DRUG_MAJOR_CLASS_TABLE.csv")
+        metrics.record_read(data_dir+"DRUG_MAJOR_CLASS_TABLE.csv", rows=len(drug_major_class))
  
-    # read drug minor classes
-    drug_class = pd.read_csv(data_dir+"DRUG_CLASS_TABLE.csv")
+        # read drug minor classes
+        drug_class = pd.read_csv(data_dir+"DRUG_CLASS_TABLE.csv")
+        metrics.record_read(data_dir+"DRUG_CLASS_TABLE.csv", rows=len(drug_class))
 
     # replace NaN values in drug_class table
     drug_class.replace(to_replace=np.nan, value="N/A", inplace=True)
 
-    if output_format == "csv":
-        # get all the column names for the file header
-        hdr_dmc = list(drug_major_class.columns)
-        hdr_dc = list(drug_class.columns)
-        # add a `#` to the first element of the list so header 
-        # won't be confused for data
-        hdr_dmc[0] = "#" + hdr_dmc[0]
-        hdr_dc[0] = "#" + hdr_dc[0]
-
-        drug_major_class.to_csv(data_dir + "drug_major_class.csv", sep="\t", header=hdr_dmc,
-                               index=False)
-        drug_class.to_csv(data_dir + "drug_class.csv", sep="\t", header=hdr_dc,
-                          index=False)
-
-    elif output_format == "feather":
-        # write the results to a feather file:
-        feather.write_dataframe(drug_major_class, data_dir + 'drug_major_class.feather')
-        feather.write_dataframe(drug_class, data_dir + 'drug_class.feather')
-    else:
-        raise OptionUndefinedError()
+    # check both tables before writing either of them
+    _check_data(OrderedDict([("drug_major_class", drug_major_class), ("drug_class", drug_class)]))
+
+    _write_data(drug_major_class, data_dir, "drug_major_class", output_format, check=False)
+    _write_data(drug_class, data_dir, "drug_class", output_format, check=False)
 
     return
 
 
+def spending_years(data_dir="../data/", file_format="feather"):
+    """
+    Find the years for which a Part D spending file exists in `data_dir`.
+
+    Parameters
+    ----------
+    data_dir : string, optional, default: "../data/"
+        The directory that contains the data.
+
+    file_format : string, optional, default: "feather"
+        The file format of the spending files, "csv" or "feather".
+
+    Returns
+    -------
+    years : list of int
+        The years, in ascending order
+    """
+    pattern = re.compile(r"^spending-(\d{4})\." + file_format + "$")
+    years = [int(m.group(1)) for m in map(pattern.match, os.listdir(data_dir)) if m is not None]
+    return sorted(years)
+
+
+def load_spending(data_dir="../data/", file_format="feather", years=None):
+    """
+    Load the per-year Part D spending files written by `download_partd`
+    and stack them into a single table with an additional `year` column.
+
+    Parameters
+    ----------
+    data_dir : string, optional, default: "../data/"
+        The directory that contains the data.
+
+    file_format : string, optional, default: "feather"
+        The file format of the spending files, "csv" or "feather".
+
+    years : list of int, optional, default: None
+        The years to load. If None, load all years found in `data_dir`.
+
+    Returns
+    -------
+    spending : pd.DataFrame
+        The spending data for all years, in the order of `years`
+    """
+    if years is None:
+        years = spending_years(data_dir, file_format)
+
+    spending = []
+    for year in years:
+        df = _read_data(data_dir, "spending-" + str(year), file_format)
+        df["year"] = year
+        spending.append(df)
+
+    return pd.concat(spending, ignore_index=True)
+
+
+@metrics.timed()
 def make_drug_table(data_dir="../data/", data_local=True, file_format="feather"):
     """ 
     Make a table that associates:
@@ -391,7 +688,8 @@ def make_drug_table(data_dir="../data/", data_local=True, file_format="feather")
     data_local : bool, optional, default: True
         If True, code assumes that the data exists locally. If this is not 
         the case, the function will exit with an error. If False, data will  
-        be downloaded to the directory specified in `data_dir`. 
+        be downloaded to the directory specified in `data_dir`, unless it is
+        already there and up to date.
 
     file_format : string, optional, default: "feather"
        The file format for the input files. If `data_local=False`, also the file format for the 
@@ -400,107 +698,98 @@ def make_drug_table(data_dir="../data/", data_local=True, file_format="feather")
             * "feather": return a `.feather` file (required `feather` Python package!)
 
     """ 
-    # if data_local is False, download all the necessary data
+    # if data_local is False, download the necessary data, skipping data
+    # sets that are already up to date (see `build.py`)
     if not data_local:
-        download_partd(data_dir, output_format=file_format)
-        download_puf(data_dir, all_columns=False, output_format=file_format)
-        download_rxnorm(data_dir, output_format=file_format)
-        download_drug_class_ids(data_dir, output_format=file_format)
-
-    # assert that data directory and all necessary files exist.
-    assert os.path.isdir(data_dir), "Data directory does not exist!"
-    assert (os.path.isfile(data_dir+"drugnames.feather") | os.path.isfile(data_dir+"drugnames.csv")), \
-            "Drugnames file does not exist!"
-    assert (os.path.isfile(data_dir+"puf.feather") | os.path.isfile(data_dir+"puf.csv")), \
-            "Prescription drug profile data file does not exist!"
-    assert (os.path.isfile(data_dir+"rxnorm.feather") | os.path.isfile(data_dir+"rxnorm.csv")), \
-            "RxNorm data file does not exist!"
-    assert (os.path.isfile(data_dir+"drug_major_class.feather") | os.path.isfile(data_dir+"drug_major_class.csv")), \
-            "Drug major class file does not exist."
-    assert (os.path.isfile(data_dir+"drug_class.feather") | os.path.isfile(data_dir+"drug_class.csv")), \
-            "Drug class file does not exist."
-
-    if file_format == "feather":
-        # load data files from disk
-        drugnames = feather.read_dataframe(data_dir + "drugnames.feather")
-        puf = feather.read_dataframe(data_dir + "puf.feather")
-        rxnorm = feather.read_dataframe(data_dir + "rxnorm.feather")
-        drug_major_class = feather.read_dataframe(data_dir + "drug_major_class.feather")
-        drug_class = feather.read_dataframe(data_dir + "drug_class.feather")
-
-    elif file_format == "csv":
-        drugnames = pd.read_csv(data_dir + "drugnames.csv", sep="\t", header=0)
-        drugnames.columns = drugnames.columns.str.strip("#")
-
-        puf = pd.read_csv(data_dir + "puf.csv", sep="\t", header=0)
-        puf.columns = puf.columns.str.strip("#")
-
-        rxnorm = pd.read_csv(data_dir + "rxnorm.csv", sep="\t", header=0)
-        rxnorm.columns = rxnorm.columns.str.strip("#")
-      
-        drug_major_class = pd.read_csv(data_dir + "drug_major_class.csv", sep="\t", header=0)
-        drug_major_class.columns = drug_major_class.columns.str.strip("#")
-
-        drug_class = pd.read_csv(data_dir + "drug_class.csv", sep="\t", header=0)
-        drug_class.columns = drug_class.columns.str.strip("#")
+        # imported here, because `build` itself imports this module
+        import build
+        build.build(["partd", "puf", "rxnorm", "drug_classes"], data_dir=data_dir,
+                    file_format=file_format)
+
+    # make sure that the data directory and all necessary files exist
+    if not os.path.isdir(data_dir):
+        raise FileNotFoundError("Data directory %s does not exist!"%data_dir)
+    missing = [name for name in ["drugnames", "puf", "rxnorm", "drug_major_class", "drug_class"]
+               if not _data_exists(data_dir, name, file_format)]
+    if len(missing) > 0:
+        raise FileNotFoundError("Data files missing in %s: %s"%(data_dir,
+                                ", ".join(name + "." + file_format for name in missing)))
+
+    # load data files from disk
+    drugnames = _read_data(data_dir, "drugnames", file_format)
+    puf = _read_data(data_dir, "puf", file_format)
+    rxnorm = _read_data(data_dir, "rxnorm", file_format)
+    drug_major_class = _read_data(data_dir, "drug_major_class", file_format)
+    drug_class = _read_data(data_dir, "drug_class", file_format)
+
+    if file_format == "csv":
         drug_class.drug_class = drug_class.drug_class.astype(str)
-        drug_class.drug_class_desc = drug_class.drug_class_desc.astype(str)
- 
-    else:
-        raise OptionUndefinedError()
+        # pandas reads the "N/A" that `download_drug_class_ids` wrote for
+        # missing descriptions back as NaN, so put it back
+        drug_class.drug_class_desc = drug_class.drug_class_desc.fillna("N/A").astype(str)
 
     drugnames["RXCUI"] = "0.0"    
 
     # associate drug names with RXCUI codes
     # NOTE: THIS IS A BIT HACKY! 
  
-    # loop over indices in list of drug names
-    for idx in drugnames.index:
-
-        # sometimes, we might have more than one RXCUI 
-        # associated with a drug, because the names can 
-        # be a bit ambivalent, so make a list
-        rxcui = []
-
-        # we are going to look for RXCUI codes for both the 
-        # generic name of the drug and the brand name of the drug
-        # because sometimes one might be associated and the other
-        # one isn't
-        for c in ["drugname_generic", "drugname_brand"]:
-
-            # get out the correct row in the table
-            d = drugnames.loc[idx, c]
-            # sometimes a drug has two names, split by a slash
-            # we are going to try and find RXCUI codes for both
-            dsplit = d.split("/")
-
-            # loop over drug names
-            for di in dsplit:
-                # sometimes, a drug has a suffix attached to it
-                # since this doesn't usually exist in the RxNorm table,
-                # we strip anything after a free space
-                displit = di.split(" ")
-                v = rxnorm[rxnorm["STR"] == displit[0]]
-
-                # include all unique RXCUI codes in the list
-                if len(v) > 0:
-                    rxcui.extend(v["RXCUI"].unique())
-                else:
-                    continue
-
-        # if there are more than one RXCUI identifier for a drug,
-        # make a string containing all codes, separated by a '|'
-        if len(rxcui) > 1:
-            rxcui_str = "|".join(np.array(rxcui, dtype=str))
-
-        elif len(rxcui) == 1:
-            rxcui_str = str(rxcui[0])
+    with metrics.stage("match_rxcui"):
+        # imported here, so that the command line doesn't need pandas at startup
+        import namedict
+
+        # make sure all names and name tokens have an id in the global
+        # drug name dictionary, and look up the ids of the RxNorm names; like
+        # `download_partd`, only feather data directories have a dictionary,
+        # for CSV we number the names of this table
+        if file_format == "feather":
+            dictionary = namedict.update_dictionary(data_dir, namedict.all_names(drugnames))
         else:
-            # if there is no RXCUI code associated, include a 0
-            rxcui_str = '0.0'
-
-        # associate string with RXCUI codes with the correct row
-        drugnames.loc[idx, "RXCUI"] = rxcui_str
+            dictionary = namedict.local_dictionary(namedict.all_names(drugnames))
+        str_ids = namedict.ids(rxnorm["STR"], dictionary)
+
+        # group all RXCUI codes by name id once, so that we don't need to
+        # scan the RxNorm table for every drug; the codes of each name stay
+        # in the order in which they appear in the table
+        rx = pd.DataFrame({"id": str_ids, "RXCUI": rxnorm["RXCUI"].values})
+        rxcui_by_id = rx[rx["id"] >= 0].groupby("id", sort=False)["RXCUI"].unique().to_dict()
+
+        # loop over indices in list of drug names
+        for idx in drugnames.index:
+
+            # sometimes, we might have more than one RXCUI 
+            # associated with a drug, because the names can 
+            # be a bit ambivalent, so make a list
+            rxcui = []
+
+            # we are going to look for RXCUI codes for both the 
+            # generic name of the drug and the brand name of the drug
+            # because sometimes one might be associated and the other
+            # one isn't
+            for c in ["drugname_generic", "drugname_brand"]:
+
+                # sometimes a drug has two names, split by a slash, and
+                # sometimes a drug has a suffix attached to it; we are
+                # going to try and find RXCUI codes for all name tokens
+                for token in namedict.name_tokens(drugnames.loc[idx, c]):
+
+                    # include all unique RXCUI codes in the list
+                    v = rxcui_by_id.get(dictionary.get_loc(token))
+                    if v is not None:
+                        rxcui.extend(v)
+
+            # if there are more than one RXCUI identifier for a drug,
+            # make a string containing all codes, separated by a '|'
+            if len(rxcui) > 1:
+                rxcui_str = "|".join(np.array(rxcui, dtype=str))
+
+            elif len(rxcui) == 1:
+                rxcui_str = str(rxcui[0])
+            else:
+                # if there is no RXCUI code associated, include a 0
+                rxcui_str = '0.0'
+
+            # associate string with RXCUI codes with the correct row
+            drugnames.loc[idx, "RXCUI"] = rxcui_str
 
     # number of drugs that I can't find RXCUI codes for:
     n_missing = len(drugnames[drugnames["RXCUI"] == '0.0'])
@@ -516,130 +805,273 @@ def make_drug_table(data_dir="../data/", data_local=True, file_format="feather")
     # make sure RXCUI codes are all strings:
     drugnames["RXCUI"] = drugnames["RXCUI"].astype(str)
 
-    # loop over drug names again
-    for idx in drugnames.index:
+    with metrics.stage("match_classes"):
+        # loop over drug names again
+        for idx in drugnames.index:
 
-        # get out the RxCUI codes for this entry
-        drug_rxcui = drugnames.loc[idx, "RXCUI"].split("|")
+            # get out the RxCUI codes for this entry
+            drug_rxcui = drugnames.loc[idx, "RXCUI"].split("|")
         
-        # the same way that one drug may have multiple RXCUI codes,
-        # it may also have multiple classes, so make an empty list for them
-        dmc, dc = [], []
-
-        # if there are multiple RXCUIs, we'll need to loop over them:
-        for rxcui in drug_rxcui:
-            # find the right entry in the prescription drug profile data for 
-            # this RXCUI
-            r = puf[puf["RXNORM_RXCUI"] == np.float(rxcui)]
-
-            # there will be duplicates, so let's pick only the set of unique IDs
-            rxc = r.loc[r.index, "RXNORM_RXCUI"].unique()
-
-            # add drug classes for this RXCUI to list
-            dmc.extend(r.loc[r.index, "DRUG_MAJOR_CLASS"].unique())
-            dc.extend(r.loc[r.index, "DRUG_CLASS"].unique())
-
-        # multiple RXCUIs might have the same class, and we only care
-        # about unique entires
-        dmc = np.unique(dmc)
-        dc = np.unique(dc)
-
-        # if there is at least one drug class associated with the drug, 
-        # make a string of all associated drug classes separated by `|`
-        # and store in correct row and column
-        if len(dmc) != 0:
-            drugnames.loc[idx, "drug_major_class"] = "|".join(dmc)
-            dmc_name = np.hstack([drug_major_class.loc[drug_major_class["drug_major_class"] == d, 
-                                                       "drug_major_class_desc"].values for d in dmc])
-            drugnames.loc[idx, "dmc_name"] = "|".join(dmc_name)
-
-        # if there is no class associated, this entry will be zero
-        else:
-            drugnames.loc[idx, "drug_major_class"] = "0"
-            drugnames.loc[idx, "dmc_name"] = "0"
-
-        # same procedure as if-statement just above
-        if len(dc) != 0:
-            drugnames.loc[idx, "drug_class"] = "|".join(dc)
-            dc_name = np.hstack([drug_class.loc[drug_class["drug_class"] == d, 
-                                                "drug_class_desc"].values for d in dc])   
-
-            drugnames.loc[idx, "dc_name"] = "|".join(dc_name)
-        else:
-            drugnames.loc[idx, "drug_class"] = "0"
-            drugnames.loc[idx, "dc_name"] = "0"
-
-
-    if file_format == "csv":
-        # get all the column names for the file header
-        hdr = list(drugnames.columns)
-        # add a `#` to the first element of the list so header 
-        # won't be confused for data
-        hdr[0] = "#" + hdr[0]
-        drugnames.to_csv(data_dir + "drugnames_withclasses.csv", sep="\t", header=hdr,
-                               index=False)
-    elif file_format == "feather":
-        # write the results to a feather file:
-        feather.write_dataframe(drugnames, data_dir + 'drugnames_withclasses.feather')
-    else:
-        raise OptionUndefinedError()
+            # the same way that one drug may have multiple RXCUI codes,
+            # it may also have multiple classes, so make an empty list for them
+            dmc, dc = [], []
+
+            # if there are multiple RXCUIs, we'll need to loop over them:
+            for rxcui in drug_rxcui:
+                # find the right entry in the prescription drug profile data for 
+                # this RXCUI
+                r = puf[puf["RXNORM_RXCUI"] == float(rxcui)]
+
+                # there will be duplicates, so let's pick only the set of unique IDs
+                rxc = r.loc[r.index, "RXNORM_RXCUI"].unique()
+
+                # add drug classes for this RXCUI to list
+                dmc.extend(r.loc[r.index, "DRUG_MAJOR_CLASS"].unique())
+                dc.extend(r.loc[r.index, "DRUG_CLASS"].unique())
+
+            # multiple RXCUIs might have the same class, and we only care
+            # about unique entires
+            dmc = np.unique(dmc)
+            dc = np.unique(dc)
+
+            # if there is at least one drug class associated with the drug, 
+            # make a string of all associated drug classes separated by `|`
+            # and store in correct row and column
+            if len(dmc) != 0:
+                drugnames.loc[idx, "drug_major_class"] = "|".join(dmc)
+                dmc_name = np.hstack([drug_major_class.loc[drug_major_class["drug_major_class"] == d, 
+                                                           "drug_major_class_desc"].values for d in dmc])
+                drugnames.loc[idx, "dmc_name"] = "|".join(dmc_name)
+
+            # if there is no class associated, this entry will be zero
+            else:
+                drugnames.loc[idx, "drug_major_class"] = "0"
+                drugnames.loc[idx, "dmc_name"] = "0"
+
+            # same procedure as if-statement just above
+            if len(dc) != 0:
+                drugnames.loc[idx, "drug_class"] = "|".join(dc)
+                dc_name = np.hstack([drug_class.loc[drug_class["drug_class"] == d, 
+                                                    "drug_class_desc"].values for d in dc])   
+
+                drugnames.loc[idx, "dc_name"] = "|".join(dc_name)
+            else:
+                drugnames.loc[idx, "drug_class"] = "0"
+                drugnames.loc[idx, "dc_name"] = "0"
+
+    _write_data(drugnames, data_dir, "drugnames_withclasses", file_format)
 
     return
 
 
-# if script is called from the command, line, code below is executed.
-if __name__ == "__main__":
+# data sets that can be downloaded from the command line, with a short description
+DATASETS = OrderedDict([
+    ("partd", "Medicare Part D data set"),
+    ("puf", "prescription drug profile data"),
+    ("rxnorm", "RxNorm data"),
+    ("drug-classes", "drug class ID tables for PUF data"),
+])
+
 
-    # make an argument parser object to parse command line arguments
+def _make_parser():
+    """
+    Make the parser for the command line interface.
+    """
     parser = argparse.ArgumentParser(description="Download and wrangle Medicare drug use data.")
 
-    # define possible command line arguments
+    # options that apply to all subcommands
     parser.add_argument("-d", "--data-dir", action="store", required=False, default="../data/",
                         dest="data_dir", help="Optional path to the data directory where data is " +
                                               "stored/retrieved. Default: '../data/'")
     parser.add_argument("-f", "--output-format", action="store", required=False, default="feather",
                         dest="output_format", help="File format for output files. {'csv' | 'feather'}")
-
+    parser.add_argument("--metrics", action="store", required=False, default=None,
+                        dest="metrics_file", help="Optional file to append per-stage metrics to, " +
+                                                  "as JSON lines. Use '-' for stdout.")
+    parser.add_argument("--profile-dir", action="store", required=False, default=None,
+                        dest="profile_dir", help="Optional directory to write a profile of " +
+                                                 "each stage to.")
+    parser.add_argument("--profiler", action="store", required=False, default="cprofile",
+                        choices=metrics.PROFILERS, dest="profiler",
+                        help="Profiler for --profile-dir. Default: cprofile")
+
+    # the flags of earlier versions of this script, still accepted so that
+    # existing cron jobs keep working
     parser.add_argument("-a", "--download-all", action="store_true", dest="dl_all",
-                        help="If this flag is set, download all data sets")
+                        help=argparse.SUPPRESS)
     parser.add_argument("--download-partd", action="store_true", dest="dl_partd",
-                        help="If this flag is set, download Medicare Part D data set.")
+                        help=argparse.SUPPRESS)
     parser.add_argument("--download-rxnorm", action="store_true", dest="dl_rxnorm",
-                        help="If this flag is set, download RxNorm data.")
+                        help=argparse.SUPPRESS)
     parser.add_argument("--download-puf", action="store_true", dest="dl_puf",
-                        help="If this flag is set, download prescription drug profile data.")
+                        help=argparse.SUPPRESS)
     parser.add_argument("--download-drug-classes", action="store_true", dest="dl_drugclass",
-                        help="If this flag is set, download drug class ID tables for PUF data.")
+                        help=argparse.SUPPRESS)
     parser.add_argument("--make-drug-table", action="store_true", dest="make_dtable",
-                        help="If this flag is set, make a table associating drug names in "+  
-                             "the Part D data with RxNorm IDs and drug classes from the PUF data.")
- 
-    # parse arguments
-    clargs = parser.parse_args()
+                        help=argparse.SUPPRESS)
+
+    subparsers = parser.add_subparsers(dest="command", metavar="COMMAND")
+
+    dl_parser = subparsers.add_parser("download", help="Download and wrangle one or more data sets.")
+    dl_parser.add_argument("datasets", nargs="+", metavar="DATASET",
+                           choices=list(DATASETS.keys()) + ["all"],
+                           help="Data sets to download: " +
+                                ", ".join("'%s' (%s)"%(k, v) for k, v in DATASETS.items()) +
+                                ", or 'all'.")
+    _add_partd_arguments(dl_parser, "If this flag is set, re-process Part D years that already exist.")
+
+    subparsers.add_parser("make-drug-table", help="Make a table associating drug names in " +
+                                                  "the Part D data with RxNorm IDs and drug " +
+                                                  "classes from the PUF data.")
+
+    mat_parser = subparsers.add_parser("materialize", help="Precompute the tables served by the " +
+                                                           "Shiny dashboards (see materialize.py).")
+    mat_parser.add_argument("-o", "--out-dir", action="store", required=False, default=None,
+                            dest="out_dir", help="Directory for the tables. " +
+                                                 "Default: '<data-dir>/serving/'")
+    mat_parser.add_argument("-n", "--top-n", action="store", type=int, required=False, default=100,
+                            dest="top_n", help="Number of drugs in the top-N tables. Default: 100")
+
+    build_parser = subparsers.add_parser("build", help="Bring all data sets up to date, skipping " +
+                                                       "those that haven't changed (see build.py).")
+    build_parser.add_argument("targets", nargs="*", metavar="STAGE",
+                              help="Stages to build (with their upstream stages), see build.py. " +
+                                   "Default: all")
+    build_parser.add_argument("--check-remote", action="store_true", dest="check_remote",
+                              help="Ask the servers whether the source files have changed.")
+    build_parser.add_argument("--snapshot", action="store_true", dest="snapshot",
+                              help="Keep a snapshot of the artifacts of every stage that ran.")
+    build_parser.add_argument("-n", "--dry-run", action="store_true", dest="dry_run",
+                              help="Only show which stages would run.")
+    _add_partd_arguments(build_parser, "If this flag is set, run all stages, even those " +
+                                       "that are up to date.")
+
+    # the earlier flags could be combined with these two; they get their own
+    # dest, so that the defaults of the subcommands don't override them
+    parser.add_argument("--partd-release", action="store", type=int, required=False, default=None,
+                        choices=sorted(PARTD_RELEASES), dest="legacy_partd_release",
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--overwrite", action="store_true", dest="legacy_overwrite",
+                        help=argparse.SUPPRESS)
+
+    return parser
+
+
+def _add_partd_arguments(parser, overwrite_help):
+    parser.add_argument("--partd-release", action="store", type=int, required=False, default=None,
+                        choices=sorted(PARTD_RELEASES), dest="partd_release",
+                        help="CMS Part D release to download. Default: most recent.")
+    parser.add_argument("--overwrite", action="store_true", dest="overwrite", help=overwrite_help)
+    return
+
+
+def download(datasets, data_dir="../data/", output_format="feather", partd_release=None,
+             overwrite=False):
+    """
+    Download and wrangle several data sets in one go.
 
+    Parameters
+    ----------
+    datasets : list of strings
+        Keys of `DATASETS`, or "all"
+
+    data_dir : string, optional, default: "../data/"
+        The path to the directory where the data should be stored.
+
+    output_format : string, optional, default: "feather"
+        The file format for the output files, "csv" or "feather".
+
+    partd_release, overwrite :
+        Passed on to `download_partd`
+    """
+    if "all" in datasets:
+        datasets = list(DATASETS.keys())
+
+    for dataset in DATASETS:
+        if dataset not in datasets:
+            continue
+        print("Downloading %s ..."%DATASETS[dataset])
+        if dataset == "partd":
+            download_partd(data_dir, output_format=output_format, release=partd_release,
+                           overwrite=overwrite)
+        elif dataset == "puf":
+            download_puf(data_dir, all_columns=True, output_format=output_format)
+        elif dataset == "rxnorm":
+            download_rxnorm(data_dir, output_format=output_format)
+        elif dataset == "drug-classes":
+            download_drug_class_ids(data_dir, output_format=output_format)
+
+    return
+
+
+def main(argv=None):
+    """
+    Entry point for the command line interface. Run `python read_data.py -h`
+    for the available commands.
+    """
+    parser = _make_parser()
+    clargs = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    metrics.configure(metrics_file=clargs.metrics_file, profile_dir=clargs.profile_dir,
+                      profiler=clargs.profiler)
+
+    # translate the flags of earlier versions into the new commands
+    datasets = []
     if clargs.dl_all:
-        print("You have chosen to download all data.")
-        print("Downloading Medicare Part D data ...")
-        download_partd(clargs.data_dir, output_format=clargs.output_format)
-        print("Downloading Prescription Drug Profile data ...")
-        download_puf(clargs.data_dir, all_columns=True, output_format=clargs.output_format)
-        print("Downloading RxNorm data ...")
-        download_rxnorm(clargs.data_dir, output_format=clargs.output_format)
-        print("Download drug class IDs ...")
-        download_drug_class_ids(clargs.data_dir, output_format=clargs.output_format)
-        print("All done!")
-    elif clargs.dl_partd:
-        download_partd(clargs.data_dir, output_format=clargs.output_format)
-    elif clargs.dl_rxnorm:
-        download_rxnorm(clargs.data_dir, output_format=clargs.output_format)
-    elif clargs.dl_puf:
-        download_puf(clargs.data_dir, all_columns=True, output_format=clargs.output_format)
-    elif clargs.dl_drugclass:
-        download_drug_class_ids(clargs.data_dir, output_format=clargs.output_format)
+        datasets = ["all"]
     else:
-        print("No data to be downloaded.")
+        for flag, dataset in [("dl_partd", "partd"), ("dl_puf", "puf"), ("dl_rxnorm", "rxnorm"),
+                              ("dl_drugclass", "drug-classes")]:
+            if getattr(clargs, flag):
+                datasets.append(dataset)
+    if clargs.command == "download":
+        datasets = clargs.datasets
+
+    # the options can come before the subcommand (earlier versions) or after it
+    partd_release = getattr(clargs, "partd_release", None)
+    if partd_release is None:
+        partd_release = clargs.legacy_partd_release
+    overwrite = getattr(clargs, "overwrite", False) or clargs.legacy_overwrite
+
+    if clargs.command is None and len(datasets) == 0 and not clargs.make_dtable:
+        parser.print_help()
+        return 1
+
+    if len(datasets) > 0:
+        download(datasets, clargs.data_dir, output_format=clargs.output_format,
+                 partd_release=partd_release, overwrite=overwrite)
+        print("All done!")
 
-    if clargs.make_dtable:
+    if clargs.command == "make-drug-table" or clargs.make_dtable:
         print("Combining data sets to associate drug names with IDs and classes ...")
         make_drug_table(clargs.data_dir, data_local=True, file_format=clargs.output_format)
 
+    if clargs.command == "materialize":
+        # imported here, because `materialize` itself imports this module
+        import materialize
+        manifest = materialize.materialize_serving_tables(clargs.data_dir, out_dir=clargs.out_dir,
+                                                          file_format=clargs.output_format,
+                                                          top_n=clargs.top_n)
+        print("Wrote %i tables."%len(manifest["tables"]))
+
+    if clargs.command == "build":
+        # imported here, because `build` itself imports this module
+        import build
+        for target in clargs.targets:
+            if target not in build.STAGES:
+                parser.error("Unknown stage '%s', must be one of %s."%(target, build.STAGE_ORDER))
+        ran = build.build(clargs.targets or None, data_dir=clargs.data_dir,
+                          file_format=clargs.output_format, release=partd_release, force=overwrite,
+                          check_remote=clargs.check_remote, dry_run=clargs.dry_run,
+                          snapshot=clargs.snapshot)
+        for stage, reason in ran:
+            print("%s %s (%s)"%("would run" if clargs.dry_run else "ran", stage, reason))
+        if len(ran) == 0:
+            print("Everything is up to date.")
+
+    return 0
+
+
+# if script is called from the command, line, code below is executed.
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,343 @@
+"""
+Immutable, versioned snapshots of the artifacts in the data directory.
+
+The functions in `read_data.py` overwrite their artifacts in place, so a new
+CMS or RxNorm release replaces the previous one. A snapshot keeps the
+artifacts of one stage (see `build.STAGES`) for one source release:
+
+    <data_dir>/snapshots/<stage>-<release>/
+        manifest.json
+        drugnames.feather, spending-2011.feather, ...
+
+Files in snapshot directories are hard links to read-only copies in
+`<data_dir>/snapshots/objects/`, named by their content hash, so a file that
+didn't change between releases is stored only once. A snapshot directory has
+the same layout as the data directory, so it can be read with
+`read_data._read_data` or queried with `query.query(sql, data_dir=...)`.
+
+`diff` compares two snapshots of the same stage. Rows are matched on their
+keys (brand and generic name for the Part D artifacts, RXCUI for RxNorm and
+the PUF, class codes for the class tables) by joining on hashes of the keys
+and of the remaining columns, instead of comparing the full frames:
+
+    python snapshots.py create rxnorm --release 2017-01-03
+    python snapshots.py list
+    python snapshots.py diff partd-2015 partd-2016
+"""
+import os # file system
+import stat # make objects read-only
+import json # manifests
+import time # timestamps for the manifests
+import shutil # copy files into the object store
+import hashlib # release tags
+import argparse # argument parsing for command line options
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import build
+import validate
+from read_data import _partd_release, _read_data
+
+
+# the columns that identify a row, for every kind of artifact (see
+# `validate.artifact_kind`); the remaining columns are compared
+DIFF_KEYS = {
+    "drugnames": ["drugname_brand", "drugname_generic"],
+    "spending": ["drugname_brand", "drugname_generic"],
+    "drugnames_withclasses": ["drugname_brand", "drugname_generic"],
+    "rxnorm": ["RXCUI"],
+    "puf": ["RXNORM_RXCUI"],
+    "drug_major_class": ["drug_major_class"],
+    "drug_class": ["drug_class"],
+}
+
+
+# custom exception for an attempt to change an existing snapshot
+class SnapshotExistsError(Exception):
+    pass
+
+
+def _snapshot_root(data_dir):
+    return os.path.join(data_dir, "snapshots")
+
+
+def snapshot_dir(data_dir, snapshot):
+    """
+    The directory of `snapshot`, with a trailing slash, so that it can be
+    passed to the functions in `read_data.py` as `data_dir`.
+    """
+    return os.path.join(_snapshot_root(data_dir), snapshot, "")
+
+
+def _store_object(data_dir, path, sha1, ext):
+    """
+    Copy the file at `path` into the object store, unless an object with the
+    same content exists already, and return the path of the object.
+    """
+    objects = os.path.join(_snapshot_root(data_dir), "objects")
+    try:
+        os.stat(objects)
+    except FileNotFoundError:
+        os.makedirs(objects)
+
+    obj = os.path.join(objects, sha1 + ext)
+    if not os.path.isfile(obj):
+        tmp = obj + ".tmp"
+        shutil.copyfile(path, tmp)
+        os.chmod(tmp, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        os.replace(tmp, obj)
+    return obj
+
+
+def _load_manifest(path):
+    with open(os.path.join(path, "manifest.json"), "r") as f:
+        return json.load(f)
+
+
+def snapshot(data_dir="../data/", stage="partd", release=None, file_format="feather", cache=None):
+    """
+    Make a snapshot of the current artifacts of `stage` in `data_dir`.
+
+    Parameters
+    ----------
+    data_dir : string, optional, default: "../data/"
+        The data directory
+
+    stage : string, optional, default: "partd"
+        The stage whose artifacts to keep, a key in `build.STAGES`
+
+    release : string or int, optional, default: None
+        The source release, e.g. "2017-01-03" for an RxNorm release. For
+        "partd", the CMS release (see `read_data.PARTD_RELEASES`), which
+        defaults to the most recent one; for all other stages, the default
+        is a short hash of the artifacts.
+
+    file_format : string, optional, default: "feather"
+        The file format of the artifacts, "csv" or "feather".
+
+    cache : build.HashCache, optional, default: None
+        Cache of file hashes; if None, the one in `data_dir` is used.
+
+    Returns
+    -------
+    name : string
+        The name of the snapshot, `<stage>-<release>`
+
+    Raises
+    ------
+    SnapshotExistsError
+        If a snapshot with the same name but different files exists.
+    """
+    save_cache = cache is None
+    if cache is None:
+        cache = build.HashCache(data_dir)
+
+    partd_release = None
+    if stage == "partd":
+        partd_release = _partd_release(None if release is None else int(release))[0]
+        release = partd_release
+
+    files = OrderedDict()
+    for name in build.outputs(stage, partd_release):
+        sha1 = cache.hash(build.artifact_path(data_dir, name, file_format))
+        if sha1 is None:
+            raise FileNotFoundError("Can't make a snapshot of %s, %s is missing."%(
+                stage, os.path.relpath(build.artifact_path(data_dir, name, file_format), data_dir)))
+        files[name] = sha1
+    if save_cache:
+        cache.save()
+
+    if release is None:
+        release = hashlib.sha1(json.dumps(files).encode("utf-8")).hexdigest()[:10]
+
+    name = "%s-%s"%(stage, release)
+    path = snapshot_dir(data_dir, name)
+    if os.path.isdir(path):
+        if _load_manifest(path)["files"] != files:
+            raise SnapshotExistsError("Snapshot %s exists already and has different files."%name)
+        return name
+
+    # build the snapshot in a temporary directory, so that it appears complete or not at all
+    tmp = path.rstrip(os.sep) + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for artifact, sha1 in files.items():
+        source = build.artifact_path(data_dir, artifact, file_format)
+        obj = _store_object(data_dir, source, sha1, os.path.splitext(source)[1])
+        # artifacts in subdirectories (the serving tables) keep their place
+        link = build.artifact_path(tmp, artifact, file_format)
+        try:
+            os.stat(os.path.dirname(link))
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(link))
+        try:
+            os.link(obj, link)
+        except OSError:
+            # file systems without hard links get a copy
+            shutil.copyfile(obj, link)
+
+    manifest = {"name": name, "stage": stage, "release": str(release), "file_format": file_format,
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "files": files}
+    with open(os.path.join(tmp, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.rename(tmp, path)
+
+    return name
+
+
+def list_snapshots(data_dir="../data/"):
+    """
+    The manifests of all snapshots in `data_dir`, oldest first.
+    """
+    root = _snapshot_root(data_dir)
+    if not os.path.isdir(root):
+        return []
+    manifests = []
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if os.path.isfile(os.path.join(path, "manifest.json")):
+            manifests.append(_load_manifest(path))
+    return sorted(manifests, key=lambda m: (m["created"], m["name"]))
+
+
+def _group_hashes(df, key):
+    """
+    Hash the key columns and the remaining columns of each row of `df`, and
+    combine the row hashes of rows with the same key (order-independently,
+    by summing them modulo 2**64).
+
+    Returns
+    -------
+    hashes : pd.Series
+        One combined hash of the values per key, indexed by the key hash
+    first : pd.Series
+        The position of the first row with each key, indexed by the key hash
+    """
+    key_hash = pd.util.hash_pandas_object(df[key], index=False).values
+    values = [col for col in df.columns if col not in key]
+    if len(values) > 0:
+        row_hash = pd.util.hash_pandas_object(df[values], index=False).values
+    else:
+        row_hash = np.zeros(len(df), dtype=np.uint64)
+
+    hashes = pd.Series(row_hash, index=key_hash).groupby(level=0).sum()
+    first = pd.Series(np.arange(len(df)), index=key_hash).groupby(level=0).first()
+    return hashes, first
+
+
+def diff_frames(a, b, key):
+    """
+    Compare two versions of a table whose rows are identified by `key`.
+
+    Parameters
+    ----------
+    a, b : pd.DataFrame
+        The old and the new version
+
+    key : list of strings
+        The key columns
+
+    Returns
+    -------
+    diff : dict of pd.DataFrame
+        The keys that were "added" in `b`, "removed" from `a`, and whose
+        other columns "changed"
+    """
+    hashes_a, first_a = _group_hashes(a, key)
+    hashes_b, first_b = _group_hashes(b, key)
+
+    added = hashes_b.index.difference(hashes_a.index)
+    removed = hashes_a.index.difference(hashes_b.index)
+    both = hashes_a.index.intersection(hashes_b.index)
+    changed = both[hashes_a[both].values != hashes_b[both].values]
+
+    def keys(df, first, idx):
+        return df[key].iloc[np.sort(first[idx].values)].reset_index(drop=True)
+
+    return {"added": keys(b, first_b, added), "removed": keys(a, first_a, removed),
+            "changed": keys(b, first_b, changed)}
+
+
+def diff(snapshot_a, snapshot_b, data_dir="../data/"):
+    """
+    Compare two snapshots of the same stage.
+
+    Artifacts whose files have the same hash are not read. For the others,
+    the rows are matched on their keys (see `DIFF_KEYS`), e.g. drugs for the
+    Part D artifacts and RXCUIs for RxNorm.
+
+    Returns
+    -------
+    diffs : OrderedDict
+        For every artifact in either snapshot, a dict with the "status"
+        ("unchanged", "changed", "added" or "removed"), and for changed
+        artifacts the output of `diff_frames`
+    """
+    manifest_a = _load_manifest(snapshot_dir(data_dir, snapshot_a))
+    manifest_b = _load_manifest(snapshot_dir(data_dir, snapshot_b))
+    if manifest_a["file_format"] != manifest_b["file_format"]:
+        raise ValueError("Can't compare snapshots with different file formats.")
+    file_format = manifest_a["file_format"]
+
+    diffs = OrderedDict()
+    for name in sorted(set(manifest_a["files"]) | set(manifest_b["files"])):
+        sha1_a = manifest_a["files"].get(name)
+        sha1_b = manifest_b["files"].get(name)
+        if sha1_a is None:
+            diffs[name] = {"status": "added"}
+        elif sha1_b is None:
+            diffs[name] = {"status": "removed"}
+        elif sha1_a == sha1_b:
+            diffs[name] = {"status": "unchanged"}
+        else:
+            key = DIFF_KEYS.get(validate.artifact_kind(name))
+            if key is None:
+                diffs[name] = {"status": "changed"}
+            else:
+                a = _read_data(snapshot_dir(data_dir, snapshot_a), name, file_format)
+                b = _read_data(snapshot_dir(data_dir, snapshot_b), name, file_format)
+                diffs[name] = dict(status="changed", **diff_frames(a, b, key))
+    return diffs
+
+
+# if script is called from the command, line, code below is executed.
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Keep and compare snapshots of the data directory.")
+
+    parser.add_argument("-d", "--data-dir", action="store", required=False, default="../data/",
+                        dest="data_dir", help="Optional path to the data directory. Default: '../data/'")
+
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    create_parser = subparsers.add_parser("create", help="Make a snapshot of a stage's artifacts.")
+    create_parser.add_argument("stage", choices=build.STAGE_ORDER, help="The stage.")
+    create_parser.add_argument("-r", "--release", action="store", default=None, dest="release",
+                               help="The source release. Default: the Part D release, or a hash.")
+    create_parser.add_argument("-f", "--file-format", action="store", default="feather",
+                               dest="file_format", help="File format of the artifacts. {'csv' | 'feather'}")
+
+    subparsers.add_parser("list", help="List the snapshots.")
+
+    diff_parser = subparsers.add_parser("diff", help="Compare two snapshots.")
+    diff_parser.add_argument("snapshot_a", help="The old snapshot.")
+    diff_parser.add_argument("snapshot_b", help="The new snapshot.")
+
+    clargs = parser.parse_args()
+
+    if clargs.command == "create":
+        print(snapshot(clargs.data_dir, clargs.stage, release=clargs.release,
+                       file_format=clargs.file_format))
+    elif clargs.command == "list":
+        for manifest in list_snapshots(clargs.data_dir):
+            print("%-30s %s  %i files"%(manifest["name"], manifest["created"], len(manifest["files"])))
+    else:
+        for name, d in diff(clargs.snapshot_a, clargs.snapshot_b, clargs.data_dir).items():
+            if "added" in d:
+                print("%-25s %s: %i added, %i removed, %i changed"%(name, d["status"], len(d["added"]),
+                                                                     len(d["removed"]), len(d["changed"])))
+            else:
+                print("%-25s %s"%(name, d["status"]))
@@ -0,0 +1,309 @@
+"""
+Seeded generators for synthetic stand-ins of the raw input files used by
+`read_data.py`, so that the pipeline can be run (and timed) without network
+access.
+
+Each generator writes its file(s) to `data_dir` under the same name that
+`read_data._download_data` would have extracted from the real archive:
+
+* `make_partd_workbook`: the CMS Part D Excel workbook
+* `make_rxnconso`: `rrf/RXNCONSO.RRF` from RxNorm
+* `make_puf`: the 2010 prescription drug profiles (`2010_PD_Profiles_PUF.csv`)
+* `make_drug_class_tables`: `DRUG_MAJOR_CLASS_TABLE.csv` and `DRUG_CLASS_TABLE.csv`
+
+The values are random, but the shapes, column layout and the overlap between
+drug names, RXCUI codes and drug classes resemble the real data, so that the
+name matching in `make_drug_table` does a realistic amount of work.
+"""
+import os # make directories
+
+import numpy as np
+import pandas as pd
+
+from read_data import PARTD_METRIC_COLUMNS, _partd_release
+
+
+# syllables to make up drug names from
+SYLLABLES = ["ab", "ac", "al", "am", "an", "ar", "ba", "ca", "ce", "ci", "co", "da", "de",
+             "di", "do", "fe", "flu", "ga", "li", "lo", "ma", "me", "mi", "mo", "na", "ne",
+             "ni", "no", "pa", "pe", "pi", "pra", "ra", "re", "ri", "ro", "sa", "se", "si",
+             "ta", "te", "ti", "to", "tra", "va", "ve", "vi", "xa", "za", "zo"]
+GENERIC_SUFFIXES = ["mab", "pril", "sartan", "statin", "olol", "azole", "cillin", "mycin",
+                    "tidine", "pine", "done", "zepam", "nib", "vir", "formin"]
+SALT_SUFFIXES = ["", "", "", " hcl", " sodium", " calcium", " er", " potassium"]
+
+# the columns of the 2010 prescription drug profiles, in the order of the CMS file
+PUF_COLUMNS = ["BENE_SEX_IDENT_CD", "BENE_AGE_CAT_CD", "DRUG_MAJOR_CLASS", "DRUG_CLASS",
+               "RXNORM_RXCUI", "PDE_DRUG_TYPE_CD", "PLAN_TYPE", "COVERAGE_TYPE",
+               "benefit_phase", "DRUG_BENEFIT_TYPE", "PRESCRIBER_TYPE", "GAP_COVERAGE",
+               "TIER_ID", "MEAN_RXHCC_SCORE", "AVE_DAYS_SUPPLY", "AVE_TOT_DRUG_COST",
+               "AVE_PTNT_PAY_AMT", "PDE_CNT", "BENE_CNT_CAT"]
+
+# the columns of RXNCONSO.RRF
+RRF_COLUMNS = ["RXCUI", "LAT", "TS", "LUI", "STT", "SUI", "ISPREF", "RXAUI",
+               "SAUI", "SCUI", "SDUI", "SAB", "TTY", "CODE", "STR", "SRL", "SUPPRESS", "CVF"]
+
+
+def _mkdir(path):
+    try:
+        os.stat(path)
+    except FileNotFoundError:
+        os.makedirs(path)
+
+
+def make_drug_names(n_generic, seed=0):
+    """
+    Make up `n_generic` unique generic drug names, and between one and four
+    brand names for each of them.
+
+    Returns
+    -------
+    names : pd.DataFrame
+        Columns `drugname_brand` and `drugname_generic`, in upper case like the
+        CMS data
+    """
+    rng = np.random.RandomState(seed)
+
+    generics = set()
+    while len(generics) < n_generic:
+        n_syl = rng.randint(1, 4)
+        name = "".join(rng.choice(SYLLABLES, size=n_syl)) + rng.choice(GENERIC_SUFFIXES)
+        generics.add(name)
+    generics = sorted(generics)
+
+    brands, generic_col = [], []
+    for i, generic in enumerate(generics):
+        salt = rng.choice(SALT_SUFFIXES)
+        # some drugs are combinations of two generics, split by a slash
+        if i > 0 and rng.rand() < 0.1:
+            generic = generic + "/" + generics[rng.randint(0, i)]
+        n_brands = rng.randint(1, 5)
+        for j in range(n_brands):
+            if j == 0:
+                brand = generic.split("/")[0]
+            else:
+                brand = "".join(rng.choice(SYLLABLES, size=rng.randint(2, 4)))
+            brands.append(brand.upper())
+            generic_col.append((generic + salt).upper())
+
+    return pd.DataFrame({"drugname_brand": brands, "drugname_generic": generic_col})
+
+
+def make_partd_workbook(data_dir, n_generic=1500, release=None, seed=0):
+    """
+    Write a synthetic version of the CMS Part D workbook for `release` (a key
+    in `read_data.PARTD_RELEASES`), with the same header rows, the metric
+    columns repeated for every year, and an extra "Annual Change" column for
+    the last year. About 10% of the values are missing, and some drugs have
+    no data at all in the first years.
+
+    Returns
+    -------
+    drugnames : pd.DataFrame
+        The drug names in the workbook
+    """
+    release, schema = _partd_release(release)
+    rng = np.random.RandomState(seed)
+
+    names = make_drug_names(n_generic, seed=seed)
+    n = len(names)
+
+    columns = {"Brand Name": names["drugname_brand"].values,
+               "Generic Name": names["drugname_generic"].values}
+    headers = list(columns.keys())
+
+    # drugs enter the market in different years
+    first_year = rng.choice(schema["years"], size=n, p=None)
+
+    for k, year in enumerate(schema["years"]):
+        on_market = first_year <= year
+        users = np.where(on_market, np.round(rng.lognormal(6, 2, size=n)), np.nan)
+        claims = np.round(users * rng.uniform(1, 12, size=n))
+        units = claims * rng.uniform(10, 90, size=n)
+        unit_cost = rng.lognormal(0, 2, size=n)
+        spending = units * unit_cost
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # some drugs have no users
+            spending_per_user = spending / users
+        lowincome = np.round(users * rng.uniform(0, 1, size=n))
+        values = {
+            "claim_count": claims,
+            "total_spending": spending,
+            "user_count": users,
+            "total_spending_per_user": spending_per_user,
+            "unit_count": units,
+            "unit_cost_wavg": unit_cost,
+            "user_count_non_lowincome": users - lowincome,
+            "out_of_pocket_avg_non_lowincome": rng.lognormal(3, 1.5, size=n),
+            "user_count_lowincome": lowincome,
+            "out_of_pocket_avg_lowincome": rng.lognormal(1, 1, size=n),
+        }
+        for header, col in PARTD_METRIC_COLUMNS.items():
+            v = np.where(on_market, values[col], np.nan)
+            v[rng.rand(n) < 0.1] = np.nan
+            # pandas can't have duplicate column names, so we add the year
+            # here and write the header row ourselves below
+            columns["%s|%i"%(header, year)] = v
+            headers.append(header.title())
+
+        if k == len(schema["years"]) - 1:
+            columns["annual change|%i"%year] = rng.normal(0, 0.2, size=n)
+            headers.append("Annual Change in Average Cost Per Unit")
+
+    df = pd.DataFrame(columns)
+
+    _mkdir(data_dir)
+    path = os.path.join(data_dir, schema["workbook"])
+    with pd.ExcelWriter(path) as writer:
+        # the CMS workbook has a few lines of title and notes above the header
+        preamble = pd.DataFrame([["Medicare Part D Drug Spending (synthetic data)"], [""], [""]])
+        preamble.to_excel(writer, sheet_name=schema["sheet"], header=False, index=False)
+        pd.DataFrame([headers]).to_excel(writer, sheet_name=schema["sheet"], header=False,
+                                         index=False, startrow=schema["skiprows"])
+        df.to_excel(writer, sheet_name=schema["sheet"], header=False, index=False,
+                    startrow=schema["skiprows"] + 1)
+
+    return names
+
+
+def make_rxnconso(data_dir, drugnames, n_rows=100000, match_fraction=0.8, seed=0):
+    """
+    Write a synthetic `rrf/RXNCONSO.RRF`. A fraction `match_fraction` of the
+    generic and brand names in `drugnames` get one or more RXCUI codes; the
+    remaining rows are filled with made-up names that don't match any drug.
+
+    Returns
+    -------
+    rxnorm : pd.DataFrame
+        The RXCUI and STR columns that were written
+    """
+    rng = np.random.RandomState(seed)
+
+    candidates = set()
+    for c in ["drugname_generic", "drugname_brand"]:
+        for name in drugnames[c].str.lower():
+            for part in name.split("/"):
+                candidates.add(part.split(" ")[0])
+    candidates = sorted(candidates)
+    matched = [c for c in candidates if rng.rand() < match_fraction]
+
+    # every matched name appears a few times, with a few different codes
+    strs = list(np.repeat(matched, rng.randint(1, 6, size=len(matched))))
+    n_fill = max(n_rows - len(strs), 0)
+    strs += ["".join(rng.choice(SYLLABLES, size=rng.randint(3, 6))) + " " +
+             str(rng.randint(1, 1000)) + " mg" for _ in range(n_fill)]
+    strs = np.array(strs, dtype=object)
+    rng.shuffle(strs)
+
+    n = len(strs)
+    rxcui = rng.randint(1, 2000000, size=n)
+    # names are upper- and mixed-case in RxNorm
+    upper = rng.rand(n) < 0.5
+    strs = np.where(upper, np.char.upper(strs.astype(str)), np.char.capitalize(strs.astype(str)))
+
+    df = pd.DataFrame({c: "" for c in RRF_COLUMNS}, index=np.arange(n))
+    df["RXCUI"] = rxcui
+    df["LAT"] = "ENG"
+    df["RXAUI"] = np.arange(n) + 1000000
+    df["SAB"] = "RXNORM"
+    df["TTY"] = rng.choice(["IN", "BN", "SCD", "SBD", "PIN"], size=n)
+    df["CODE"] = rxcui
+    df["STR"] = strs
+    df["SUPPRESS"] = "N"
+
+    _mkdir(os.path.join(data_dir, "rrf"))
+    path = os.path.join(data_dir, "rrf", "RXNCONSO.RRF")
+    # RRF files are pipe-separated, with a trailing pipe at the end of each line
+    df["_end"] = ""
+    df.to_csv(path, sep="|", header=False, index=False)
+
+    return df[["RXCUI", "STR"]]
+
+
+def make_drug_class_tables(data_dir, n_major=30, n_minor=300, seed=0):
+    """
+    Write synthetic versions of `DRUG_MAJOR_CLASS_TABLE.csv` and
+    `DRUG_CLASS_TABLE.csv`, with VA-style alphanumeric class codes.
+
+    Returns
+    -------
+    drug_major_class, drug_class : pd.DataFrame
+        The two tables
+    """
+    rng = np.random.RandomState(seed)
+
+    letters = np.array(list("ABCDEFGHIJKLMNOPQRSTUVWXYZ"))
+    major = sorted(set("".join(rng.choice(letters, size=2)) for _ in range(n_major * 3)))[:n_major]
+    drug_major_class = pd.DataFrame({
+        "drug_major_class": major,
+        "drug_major_class_desc": ["MAJOR CLASS %s"%m for m in major]})
+
+    minor = ["%s%03i"%(rng.choice(major), rng.randint(0, 1000)) for _ in range(n_minor)]
+    minor = sorted(set(minor))
+    desc = ["CLASS %s"%m for m in minor]
+    # a few classes have no description, which `download_drug_class_ids` fills in
+    desc = [d if rng.rand() > 0.05 else np.nan for d in desc]
+    drug_class = pd.DataFrame({"drug_class": minor, "drug_class_desc": desc})
+
+    _mkdir(data_dir)
+    drug_major_class.to_csv(os.path.join(data_dir, "DRUG_MAJOR_CLASS_TABLE.csv"), index=False)
+    drug_class.to_csv(os.path.join(data_dir, "DRUG_CLASS_TABLE.csv"), index=False)
+
+    return drug_major_class, drug_class
+
+
+def make_puf(data_dir, rxnorm, drug_class, n_rows=500000, seed=0):
+    """
+    Write a synthetic `2010_PD_Profiles_PUF.csv` with `n_rows` rows. RXCUI
+    codes are drawn from `rxnorm`, and every RXCUI is consistently assigned
+    to one drug class from `drug_class`.
+    """
+    rng = np.random.RandomState(seed)
+
+    codes = np.unique(rxnorm["RXCUI"].values)
+    code_class = drug_class["drug_class"].values[rng.randint(0, len(drug_class), size=len(codes))]
+
+    idx = rng.randint(0, len(codes), size=n_rows)
+    dc = code_class[idx]
+    pde = rng.randint(1, 200, size=n_rows)
+
+    df = pd.DataFrame({
+        "BENE_SEX_IDENT_CD": rng.randint(1, 3, size=n_rows),
+        "BENE_AGE_CAT_CD": rng.randint(1, 7, size=n_rows),
+        "DRUG_MAJOR_CLASS": [c[:2] for c in dc],
+        "DRUG_CLASS": dc,
+        "RXNORM_RXCUI": codes[idx].astype(float),
+        "PDE_DRUG_TYPE_CD": rng.randint(1, 3, size=n_rows),
+        "PLAN_TYPE": rng.randint(1, 4, size=n_rows),
+        "COVERAGE_TYPE": rng.randint(1, 3, size=n_rows),
+        "benefit_phase": rng.choice(["DD", "PP", "CC", "NN"], size=n_rows),
+        "DRUG_BENEFIT_TYPE": rng.randint(1, 4, size=n_rows),
+        "PRESCRIBER_TYPE": rng.randint(1, 6, size=n_rows),
+        "GAP_COVERAGE": rng.randint(0, 3, size=n_rows),
+        "TIER_ID": rng.randint(1, 7, size=n_rows),
+        "MEAN_RXHCC_SCORE": np.round(rng.lognormal(0, 0.5, size=n_rows), 3),
+        "AVE_DAYS_SUPPLY": rng.randint(1, 91, size=n_rows),
+        "AVE_TOT_DRUG_COST": np.round(rng.lognormal(3.5, 1.2, size=n_rows), 2),
+        "AVE_PTNT_PAY_AMT": np.round(rng.lognormal(2, 1, size=n_rows), 2),
+        "PDE_CNT": pde,
+        "BENE_CNT_CAT": rng.randint(1, 4, size=n_rows),
+    }, columns=PUF_COLUMNS)
+
+    _mkdir(data_dir)
+    df.to_csv(os.path.join(data_dir, "2010_PD_Profiles_PUF.csv"), index=False)
+
+    return
+
+
+def make_all(data_dir, scale=1.0, seed=0):
+    """
+    Write synthetic versions of all raw input files to `data_dir`. At
+    `scale=1` the sizes are roughly those of the real files, except for the
+    PUF, which is a tenth of its real size.
+    """
+    n_generic = max(int(1500 * scale), 10)
+    names = make_partd_workbook(data_dir, n_generic=n_generic, seed=seed)
+    rxnorm = make_rxnconso(data_dir, names, n_rows=max(int(300000 * scale), 100), seed=seed)
+    _, drug_class = make_drug_class_tables(data_dir, seed=seed)
+    make_puf(data_dir, rxnorm, drug_class, n_rows=max(int(1000000 * scale), 100), seed=seed)
+    return
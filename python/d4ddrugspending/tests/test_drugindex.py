@@ -0,0 +1,45 @@
+import os
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import pandas as pd
+import pytest
+
+import drugindex
+from read_data import _write_data
+
+
+@pytest.fixture
+def index(tmp_path):
+    data_dir = str(tmp_path) + os.sep
+    _write_data(pd.DataFrame({"drugname_brand": ["lipitor", "atorvastatin calcium"],
+                              "drugname_generic": ["atorvastatin calcium"] * 2}),
+                data_dir, "drugnames", "feather")
+    return drugindex.DrugIndex(data_dir)
+
+
+def test_lookup_shares_the_cache_between_spellings(index):
+    assert [r["drugname_brand"] for r in index.lookup("Lipitor")] == ["lipitor"]
+    assert index.lookup(" LIPITOR ") == index.lookup("lipitor")
+    info = index.cache_info()
+    assert (info.misses, info.hits) == (1, 2)
+
+
+@pytest.mark.parametrize("limit, status", [("1", 200), ("0", 200), ("-1", 400), ("abc", 400)])
+def test_prefix_limit(index, limit, status):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), drugindex._make_handler(index))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        url = "http://127.0.0.1:%i/prefix?q=a&limit=%s"%(server.server_port, limit)
+        try:
+            code = urllib.request.urlopen(url).status
+        except urllib.error.HTTPError as e:
+            code = e.code
+        assert code == status
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
@@ -0,0 +1,185 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import benchmark
+import read_data
+import synthetic_data
+import validate
+
+
+@pytest.fixture
+def partd_dir(tmp_path, monkeypatch):
+    """
+    A data directory with a small synthetic Part D workbook, which
+    `download_partd` reads instead of downloading the real one.
+    """
+    monkeypatch.setattr(read_data, "_download_data", benchmark._no_download)
+    data_dir = str(tmp_path) + os.sep
+    synthetic_data.make_partd_workbook(data_dir, n_generic=30)
+    return data_dir
+
+
+def test_download_partd_writes_nothing_if_a_year_fails_a_check(partd_dir, monkeypatch):
+    year_tables = read_data._partd_year_tables
+    last_year = max(read_data.PARTD_RELEASES[max(read_data.PARTD_RELEASES)]["years"])
+
+    def bad_year_tables(*args):
+        partd_years = year_tables(*args)
+        partd_years[last_year]["total_spending"] = -1.0
+        return partd_years
+
+    monkeypatch.setattr(read_data, "_partd_year_tables", bad_year_tables)
+    before = sorted(os.listdir(partd_dir))
+
+    with pytest.raises(validate.ValidationError, match="spending-%i"%last_year):
+        read_data.download_partd(partd_dir)
+
+    assert sorted(os.listdir(partd_dir)) == before
+
+
+def test_unknown_partd_release_names_the_known_releases(tmp_path):
+    with pytest.raises(ValueError, match=str(sorted(read_data.PARTD_RELEASES))):
+        read_data.download_partd(str(tmp_path) + os.sep, release=2099)
+
+
+def _parse_partd(data_dir):
+    """
+    Parse the workbook and normalize the drug names like `download_partd`.
+    """
+    schema = read_data.PARTD_RELEASES[max(read_data.PARTD_RELEASES)]
+    partd = pd.ExcelFile(data_dir + schema["workbook"]).parse(schema["sheet"],
+                                                              skiprows=schema["skiprows"])
+    partd.index = np.arange(1, len(partd) + 1)
+    name_cols, groups = read_data._partd_column_groups(partd.columns, schema)
+    drugnames = partd.iloc[:, name_cols].copy()
+    drugnames.columns = ["drugname_brand", "drugname_generic"]
+    for col in drugnames.columns:
+        drugnames[col] = drugnames[col].str.strip().str.lower()
+    return partd, drugnames, groups
+
+
+def _concat_year_tables(partd, drugnames, groups, years):
+    """
+    The reshape `download_partd` did before `_partd_year_tables`: one concat
+    per year, dropping rows without data with a row-wise apply.
+    """
+    partd_years = {}
+    for year, cols in groups:
+        if year not in years:
+            continue
+        df = pd.concat([drugnames, partd.iloc[:, cols]], axis=1)
+        nonnull_rows = df.iloc[:, 2:].apply(lambda x: x.notnull().any(), axis=1)
+        df = df[nonnull_rows]
+        df.index = np.arange(1, len(df) + 1)
+        df.columns = ["drugname_brand", "drugname_generic"] + \
+                     list(read_data.PARTD_METRIC_COLUMNS.values())
+        for col in df.columns[2:]:
+            df[col] = pd.to_numeric(df[col])
+        partd_years[year] = df
+    return partd_years
+
+
+@pytest.mark.parametrize("n_years", [None, 2])
+def test_partd_year_tables_match_the_concat_reshape(partd_dir, tmp_path, n_years):
+    partd, drugnames, groups = _parse_partd(partd_dir)
+    years = [year for year, _ in groups][:n_years]
+
+    # the workbook has an extra column after the last year, and drugs without
+    # any data in the first years
+    assert len(partd.columns) > 2 + len(groups) * len(read_data.PARTD_METRIC_COLUMNS)
+    assert partd.iloc[:, groups[0][1]].isnull().all(axis=1).any()
+
+    expected = _concat_year_tables(partd, drugnames, groups, years)
+    result = read_data._partd_year_tables(partd, drugnames, groups, years)
+
+    assert list(result) == list(expected)
+    for year in expected:
+        pd.testing.assert_frame_equal(result[year], expected[year])
+
+        # and the files written from them are the same
+        for name, tables in [("expected", expected), ("result", result)]:
+            read_data._write_data(tables[year], str(tmp_path) + os.sep, name, "csv", check=False)
+        with open(os.path.join(str(tmp_path), "expected.csv"), "rb") as f:
+            expected_csv = f.read()
+        with open(os.path.join(str(tmp_path), "result.csv"), "rb") as f:
+            assert f.read() == expected_csv
+
+
+@pytest.fixture
+def downloads(monkeypatch):
+    """
+    Replace the download functions with ones that record their arguments.
+    """
+    calls = []
+    for dataset, func in [("partd", "download_partd"), ("puf", "download_puf"),
+                          ("rxnorm", "download_rxnorm"), ("drug-classes", "download_drug_class_ids")]:
+        def record(data_dir, dataset=dataset, **kwargs):
+            calls.append((dataset, kwargs))
+        monkeypatch.setattr(read_data, func, record)
+    return calls
+
+
+def test_main_options_after_the_download_command(downloads):
+    assert read_data.main(["download", "partd", "puf", "--overwrite"]) == 0
+    assert [d for d, _ in downloads] == ["partd", "puf"]
+    assert downloads[0][1]["overwrite"] is True
+
+
+def test_main_overwrite_with_the_earlier_flags(downloads):
+    assert read_data.main(["--overwrite", "--download-partd"]) == 0
+    assert downloads == [("partd", {"output_format": "feather", "release": None, "overwrite": True})]
+
+
+def test_main_download_all_with_the_earlier_flag(downloads):
+    assert read_data.main(["-a"]) == 0
+    assert [d for d, _ in downloads] == list(read_data.DATASETS)
+    assert downloads[0][1]["overwrite"] is False
+
+
+def test_main_options_before_the_download_command(downloads):
+    release = max(read_data.PARTD_RELEASES)
+    assert read_data.main(["--partd-release", str(release), "--overwrite", "download", "partd"]) == 0
+    assert downloads == [("partd", {"output_format": "feather", "release": release,
+                                    "overwrite": True})]
+
+
+def test_main_build_forwards_its_options(monkeypatch):
+    import build
+    calls = []
+    monkeypatch.setattr(build, "build", lambda *args, **kwargs: calls.append((args, kwargs)) or [])
+
+    assert read_data.main(["build", "puf", "rxnorm", "--overwrite", "--check-remote",
+                           "--snapshot", "-n"]) == 0
+
+    args, kwargs = calls[0]
+    assert args == (["puf", "rxnorm"],)
+    assert kwargs["force"] and kwargs["check_remote"] and kwargs["snapshot"] and kwargs["dry_run"]
+
+    with pytest.raises(SystemExit):
+        read_data.main(["build", "nonsense"])
+
+
+def test_main_rejects_unknown_profilers(capsys):
+    with pytest.raises(SystemExit):
+        read_data.main(["--profiler", "yappi", "build"])
+    assert "invalid choice: 'yappi'" in capsys.readouterr().err
+
+
+def test_make_drug_table_from_csv_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(read_data, "_download_data", benchmark._no_download)
+    data_dir = str(tmp_path) + os.sep
+    synthetic_data.make_all(data_dir, scale=0.002)
+    for func in [read_data.download_partd, read_data.download_rxnorm,
+                 read_data.download_drug_class_ids]:
+        func(data_dir, output_format="csv")
+    read_data.download_puf(data_dir, all_columns=False, output_format="csv")
+
+    read_data.make_drug_table(data_dir, file_format="csv")
+
+    drugnames = read_data._read_data(data_dir, "drugnames_withclasses", "csv")
+    # classes without a description keep the "N/A" of the drug class table
+    assert drugnames["dc_name"].notnull().all()
+    assert not os.path.exists(data_dir + "drugname_dictionary.feather")
@@ -0,0 +1,96 @@
+import os
+
+import pandas as pd
+
+import snapshots
+from read_data import _read_data, _write_data
+
+
+def _make_rxnorm(data_dir):
+    rxnorm = pd.DataFrame({"RXCUI": ["1191", "161", "5640"],
+                           "STR": ["aspirin", "acetaminophen", "ibuprofen"]})
+    _write_data(rxnorm, data_dir, "rxnorm", "feather")
+    return rxnorm
+
+
+def test_snapshot_of_a_data_dir_that_was_never_built(tmp_path):
+    data_dir = str(tmp_path) + os.sep
+    rxnorm = _make_rxnorm(data_dir)
+
+    name = snapshots.snapshot(data_dir, "rxnorm", release="2017-01-03")
+
+    assert name == "rxnorm-2017-01-03"
+    assert os.path.isfile(os.path.join(data_dir, ".build", "hashes.json"))
+    manifests = snapshots.list_snapshots(data_dir)
+    assert [m["name"] for m in manifests] == [name]
+    kept = _read_data(snapshots.snapshot_dir(data_dir, name), "rxnorm", "feather")
+    pd.testing.assert_frame_equal(kept, rxnorm)
+
+
+def test_snapshot_again_with_the_same_files(tmp_path):
+    data_dir = str(tmp_path) + os.sep
+    _make_rxnorm(data_dir)
+
+    first = snapshots.snapshot(data_dir, "rxnorm", release="2017-01-03")
+    second = snapshots.snapshot(data_dir, "rxnorm", release="2017-01-03")
+
+    assert first == second
+    assert len(snapshots.list_snapshots(data_dir)) == 1
+
+
+def test_diff_frames_finds_added_removed_and_changed_keys():
+    a = pd.DataFrame({"RXCUI": ["1", "2", "3"], "STR": ["a", "b", "c"]})
+    b = pd.DataFrame({"RXCUI": ["4", "3", "2"], "STR": ["d", "c", "B"]})
+
+    d = snapshots.diff_frames(a, b, ["RXCUI"])
+
+    assert d["added"]["RXCUI"].tolist() == ["4"]
+    assert d["removed"]["RXCUI"].tolist() == ["1"]
+    assert d["changed"]["RXCUI"].tolist() == ["2"]
+
+
+def test_diff_frames_hashes_categorical_and_object_names_alike():
+    names = {"drugname_brand": ["lipitor", "zocor"], "drugname_generic": ["atorvastatin", "simvastatin"]}
+    a = pd.DataFrame(dict(names, total_spending=[1.0, 2.0]))
+    b = a.copy()
+    for col in names:
+        b[col] = pd.Categorical(b[col], categories=sorted(set(b[col]) | {"unused"}))
+
+    d = snapshots.diff_frames(a, b, snapshots.DIFF_KEYS["spending"])
+
+    assert all(len(keys) == 0 for keys in d.values())
+
+
+def test_diff_frames_compares_all_rows_of_duplicate_keys():
+    # the PUF has many rows per RXCUI
+    a = pd.DataFrame({"RXNORM_RXCUI": ["1", "1", "2", "2"], "PDE_CNT": [10, 20, 30, 40]})
+    key = snapshots.DIFF_KEYS["puf"]
+
+    reordered = snapshots.diff_frames(a, a.iloc[::-1].reset_index(drop=True), key)
+    assert all(len(keys) == 0 for keys in reordered.values())
+
+    b = a.copy()
+    b.loc[3, "PDE_CNT"] = 41
+    changed = snapshots.diff_frames(a, b, key)
+    assert changed["changed"]["RXNORM_RXCUI"].tolist() == ["2"]
+    assert len(changed["added"]) == 0 and len(changed["removed"]) == 0
+
+
+def test_diff_of_two_snapshots(tmp_path):
+    data_dir = str(tmp_path) + os.sep
+    rxnorm = _make_rxnorm(data_dir)
+    old = snapshots.snapshot(data_dir, "rxnorm", release="2017-01-03")
+
+    rxnorm = rxnorm[rxnorm["RXCUI"] != "161"]
+    rxnorm.loc[rxnorm["RXCUI"] == "1191", "STR"] = "aspirin 81"
+    _write_data(rxnorm, data_dir, "rxnorm", "feather")
+    new = snapshots.snapshot(data_dir, "rxnorm", release="2017-02-06")
+
+    diffs = snapshots.diff(old, new, data_dir)
+
+    assert list(diffs) == ["rxnorm"]
+    assert diffs["rxnorm"]["status"] == "changed"
+    assert diffs["rxnorm"]["removed"]["RXCUI"].tolist() == ["161"]
+    assert diffs["rxnorm"]["changed"]["RXCUI"].tolist() == ["1191"]
+    assert len(diffs["rxnorm"]["added"]) == 0
+    assert snapshots.diff(old, old, data_dir)["rxnorm"] == {"status": "unchanged"}
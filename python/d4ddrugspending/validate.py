@@ -0,0 +1,256 @@
+"""
+Schema and data-quality checks for the artifacts written by `read_data.py`.
+
+Every artifact is checked with a few vectorized rules before `read_data.py`
+writes it, and stages that write several artifacts (the Part D years, the
+two drug class tables) check all of them before writing any, so a bad CMS or
+RxNorm release never replaces a good file. The first artifact that breaks a
+rule stops the pipeline with a
+`ValidationError` that lists, for every failed check, how many rows broke it
+and a few example rows:
+
+    spending-2014: 2 checks failed
+      negative_values: 3 rows, e.g. rows 17, 204, 1288
+      spending_per_user: 41 rows, e.g. rows 5, 9, 63, 71, 112
+
+The checks can also be run on a data directory after the fact:
+
+    python validate.py -d ../data/
+"""
+import os # list artifacts in the data directory
+import re # artifact names
+import sys # exit status
+import argparse # argument parsing for command line options
+from collections import OrderedDict
+
+import numpy as np
+
+from read_data import PARTD_METRIC_COLUMNS
+
+
+# relative tolerance for `total_spending_per_user == total_spending / user_count`
+SPENDING_PER_USER_RTOL = 0.01
+
+# number of example rows shown per failed check
+N_EXAMPLES = 5
+
+NAME_COLUMNS = ["drugname_brand", "drugname_generic"]
+METRIC_COLUMNS = list(PARTD_METRIC_COLUMNS.values())
+
+
+class ValidationError(Exception):
+    """
+    An artifact broke one or more checks; `violations` has the details.
+    """
+    def __init__(self, artifact, violations):
+        self.artifact = artifact
+        self.violations = violations
+        Exception.__init__(self, format_report(artifact, violations))
+
+
+def _missing_names(df):
+    return df[NAME_COLUMNS].isnull().any(axis=1).values
+
+
+def _duplicate_drugs(df):
+    return df.duplicated(NAME_COLUMNS, keep=False).values
+
+
+def _negative_values(df):
+    return (df[METRIC_COLUMNS] < 0).any(axis=1).values
+
+
+def _spending_per_user(df):
+    spending = df["total_spending"].values.astype(float)
+    users = df["user_count"].values.astype(float)
+    per_user = df["total_spending_per_user"].values.astype(float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        expected = spending / users
+    known = ~np.isnan(per_user) & ~np.isnan(expected) & (users > 0)
+    bad = np.zeros(len(df), dtype=bool)
+    bad[known] = ~np.isclose(per_user[known], expected[known], rtol=SPENDING_PER_USER_RTOL)
+    return bad
+
+
+def _unique_mapping(key, value):
+    """
+    Rows whose `key` is associated with more than one `value` in the table.
+    """
+    def check(df):
+        pairs = df[[key, value]].dropna().drop_duplicates()
+        ambiguous = pairs.loc[pairs[key].duplicated(), key]
+        return df[key].isin(ambiguous).values
+    return check
+
+
+def _duplicated(column):
+    def check(df):
+        return df.duplicated(column, keep=False).values
+    return check
+
+
+def _missing(columns):
+    def check(df):
+        return df[columns].isnull().any(axis=1).values
+    return check
+
+
+def _parallel_lists(codes, names):
+    """
+    Rows where the `|`-separated lists in `codes` and `names` have different lengths.
+    """
+    def check(df):
+        return (df[codes].astype(str).str.count(r"\|").values !=
+                df[names].astype(str).str.count(r"\|").values)
+    return check
+
+
+# for every kind of artifact: the columns it must have, and the checks that
+# return a boolean array which is True for the rows that break them
+SCHEMAS = OrderedDict([
+    ("drugnames", {"columns": NAME_COLUMNS,
+                   "checks": [("missing_names", _missing_names),
+                              ("duplicate_drugs", _duplicate_drugs)]}),
+    ("spending", {"columns": NAME_COLUMNS + METRIC_COLUMNS,
+                  "checks": [("missing_names", _missing_names),
+                             ("duplicate_drugs", _duplicate_drugs),
+                             ("negative_values", _negative_values),
+                             ("spending_per_user", _spending_per_user)]}),
+    ("puf", {"columns": ["RXNORM_RXCUI", "DRUG_MAJOR_CLASS", "DRUG_CLASS"],
+             "checks": [("rxcui_major_class_unique",
+                         _unique_mapping("RXNORM_RXCUI", "DRUG_MAJOR_CLASS")),
+                        ("rxcui_class_unique", _unique_mapping("RXNORM_RXCUI", "DRUG_CLASS"))]}),
+    ("rxnorm", {"columns": ["RXCUI", "STR"],
+                "checks": [("missing_values", _missing(["RXCUI", "STR"]))]}),
+    ("drug_major_class", {"columns": ["drug_major_class", "drug_major_class_desc"],
+                          "checks": [("missing_codes", _missing(["drug_major_class"])),
+                                     ("duplicate_codes", _duplicated("drug_major_class"))]}),
+    ("drug_class", {"columns": ["drug_class", "drug_class_desc"],
+                    "checks": [("missing_codes", _missing(["drug_class"])),
+                               ("duplicate_codes", _duplicated("drug_class"))]}),
+    ("drugnames_withclasses", {"columns": NAME_COLUMNS + ["RXCUI", "drug_major_class", "dmc_name",
+                                                          "drug_class", "dc_name"],
+                               "checks": [("missing_names", _missing_names),
+                                          ("duplicate_drugs", _duplicate_drugs),
+                                          ("major_class_names", _parallel_lists("drug_major_class",
+                                                                                "dmc_name")),
+                                          ("class_names", _parallel_lists("drug_class", "dc_name"))]}),
+])
+
+
+def artifact_kind(name):
+    """
+    The key in `SCHEMAS` for the artifact `name` (e.g. "spending" for
+    "spending-2013"), or None if there are no checks for it.
+    """
+    kind = re.sub(r"-\d{4}$", "", name)
+    return kind if kind in SCHEMAS else None
+
+
+def validate(df, name):
+    """
+    Run the checks for the artifact `name` on `df`.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The artifact
+
+    name : string
+        The name of the artifact (without file extension), e.g. "spending-2013"
+
+    Returns
+    -------
+    violations : list of dicts
+        One entry per failed check, with the name of the check, the number
+        of rows that broke it and the index labels of up to `N_EXAMPLES` of
+        them. Empty if the artifact passed all checks (or has none).
+    """
+    kind = artifact_kind(name)
+    if kind is None:
+        return []
+    schema = SCHEMAS[kind]
+
+    missing = [col for col in schema["columns"] if col not in df.columns]
+    if len(missing) > 0:
+        return [{"check": "missing_columns", "rows": 0, "examples": missing}]
+
+    violations = []
+    for check_name, func in schema["checks"]:
+        bad = func(df)
+        n_bad = int(np.count_nonzero(bad))
+        if n_bad > 0:
+            examples = [x.item() if hasattr(x, "item") else x for x in df.index[bad][:N_EXAMPLES]]
+            violations.append({"check": check_name, "rows": n_bad, "examples": examples})
+    return violations
+
+
+def check(df, name):
+    """
+    Like `validate`, but raise a `ValidationError` if any check failed.
+    """
+    violations = validate(df, name)
+    if len(violations) > 0:
+        raise ValidationError(name, violations)
+    return
+
+
+def format_report(artifact, violations):
+    """
+    A compact, human-readable summary of the violations of one artifact.
+    """
+    lines = ["%s: %i check%s failed"%(artifact, len(violations), "" if len(violations) == 1 else "s")]
+    for v in violations:
+        if v["check"] == "missing_columns":
+            lines.append("  missing_columns: %s"%", ".join(map(str, v["examples"])))
+        else:
+            lines.append("  %s: %i rows, e.g. rows %s"%(v["check"], v["rows"],
+                                                       ", ".join(map(str, v["examples"]))))
+    return "\n".join(lines)
+
+
+def validate_data_dir(data_dir="../data/", file_format="feather"):
+    """
+    Run the checks on all artifacts in `data_dir`.
+
+    Returns
+    -------
+    results : OrderedDict
+        The violations (see `validate`) for each artifact that has checks,
+        in alphabetical order
+    """
+    # imported here, so that `_write_data` can import this module
+    from read_data import _read_data
+
+    results = OrderedDict()
+    suffix = "." + file_format
+    for fname in sorted(os.listdir(data_dir)):
+        name = fname[:-len(suffix)]
+        if not fname.endswith(suffix) or artifact_kind(name) is None:
+            continue
+        results[name] = validate(_read_data(data_dir, name, file_format), name)
+    return results
+
+
+# if script is called from the command, line, code below is executed.
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Check the artifacts in the data directory.")
+
+    parser.add_argument("-d", "--data-dir", action="store", required=False, default="../data/",
+                        dest="data_dir", help="Optional path to the data directory. Default: '../data/'")
+    parser.add_argument("-f", "--file-format", action="store", required=False, default="feather",
+                        dest="file_format", help="File format of the data files. {'csv' | 'feather'}")
+
+    clargs = parser.parse_args()
+
+    results = validate_data_dir(clargs.data_dir, clargs.file_format)
+    n_failed = 0
+    for name, violations in results.items():
+        if len(violations) > 0:
+            n_failed += 1
+            print(format_report(name, violations))
+        else:
+            print("%s: ok"%name)
+
+    sys.exit(1 if n_failed > 0 else 0)
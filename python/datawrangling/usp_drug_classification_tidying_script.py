@@ -10,6 +10,7 @@ Created on Sun Feb  5 13:15:04 2017
 """
 import requests # download data from data.world
 import os # check that file exists
+import re # parse KEGG IDs
 import numpy as np, pandas as pd # data tidying 
 
 def download_from_url(url, out_file):
@@ -39,7 +40,8 @@ def tidy_usp_dc_from_kegg(fname, fout):
     """
 
     # Check that the raw data exists.
-    assert(os.path.isfile(fname))
+    if not os.path.isfile(fname):
+        raise IOError("Raw data file %s does not exist." % fname)
 
     with open(fname, 'r') as f:
         all_lines = f.readlines()
@@ -60,9 +62,10 @@ def tidy_usp_dc_from_kegg(fname, fout):
             # "C<drug> [DG:DG12345]". But drugs sometimes have spaces
             # in them, so we can't just split on white space.
             current_drug = line[1:].split('[')[0].strip()
-            try:
-                current_drug_id = line[1:].split(':')[1].strip(']\n')
-            except:
+            kegg_id = re.search(r'\[[A-Z]+:(\w+)\]', line)
+            if kegg_id is not None:
+                current_drug_id = kegg_id.group(1)
+            else:
                 current_drug_id = np.nan
         elif line.startswith('D'):
             line = line[1:].strip()